@@ -0,0 +1,218 @@
+"""
+模拟 ComfyUI 的轻量服务，供基准测试代替 python_embeded\\python.exe 启动，不需要显卡。
+
+用法与 ComfyUI 的 main.py 相同，未知参数会被忽略：
+    python fake_comfyui.py --listen 127.0.0.1 --port 8188 --cuda-device 0 --boot-seconds 3
+
+模拟的行为：
+  - 启动前按 --boot-seconds 打印导入和节点加载日志后才监听端口
+  - /system_stats、/object_info、/queue、/history、/prompt、/interrupt、/view、/assets/*
+  - /ws 推送 status、execution_start、executing、progress、executed、execution_success
+  - 执行任务时在 stderr 打印 tqdm 风格的进度条
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response
+import uvicorn
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--listen", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8188)
+parser.add_argument("--cuda-device", default="0")
+# 端口开始监听之前的启动耗时（秒）
+parser.add_argument("--boot-seconds", type=float, default=3.0)
+# 每个任务的执行耗时（秒）和步数
+parser.add_argument("--job-seconds", type=float, default=2.0)
+parser.add_argument("--steps", type=int, default=20)
+# /view 返回的图片大小（MB）和 /object_info 的大小（KB）
+parser.add_argument("--view-mb", type=float, default=8.0)
+parser.add_argument("--object-info-kb", type=int, default=512)
+args, _ = parser.parse_known_args()
+
+app = FastAPI()
+
+queue_running = []
+queue_pending = []
+history = {}
+# clientId -> WebSocket
+clients = {}
+work_available = asyncio.Event()
+interrupted = set()
+next_number = 0
+
+VIEW_BODY = b"\x89PNG\r\n\x1a\n" + bytes(int(args.view_mb * 1024 * 1024))
+OBJECT_INFO = {
+    f"FakeNode{i}": {"input": {"required": {"value": ["INT", {"default": i}]}}, "output": ["INT"], "category": "fake"}
+    for i in range(max(1, args.object_info_kb * 1024 // 100))
+}
+
+async def send(message, client_id=None):
+    """与 ComfyUI 一致：有 client_id 时只发给对应客户端，否则广播"""
+    text = json.dumps(message)
+    targets = [clients[client_id]] if client_id in clients else list(clients.values()) if client_id is None else []
+    for ws in targets:
+        try:
+            await ws.send_text(text)
+        except Exception:
+            pass
+
+def queue_status():
+    return {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": len(queue_running) + len(queue_pending)}}}}
+
+async def worker():
+    """依次执行队列中的任务，推送进度"""
+    while True:
+        await work_available.wait()
+        if not queue_pending:
+            work_available.clear()
+            continue
+        queue_pending.sort(key=lambda item: item[0])
+        item = queue_pending.pop(0)
+        queue_running.append(item)
+        number, prompt_id, prompt, extra, _ = item
+        client_id = extra.get("client_id")
+        started = int(time.time() * 1000)
+        messages = [["execution_start", {"prompt_id": prompt_id, "timestamp": started}]]
+        await send(queue_status())
+        await send({"type": "execution_start", "data": {"prompt_id": prompt_id, "timestamp": started}}, client_id)
+        await send({"type": "executing", "data": {"node": "3", "prompt_id": prompt_id}}, client_id)
+        outcome = "execution_success"
+        for step in range(1, args.steps + 1):
+            if prompt_id in interrupted:
+                outcome = "execution_interrupted"
+                break
+            await asyncio.sleep(args.job_seconds / args.steps)
+            filled = step * 10 // args.steps
+            sys.stderr.write(f"\r{step * 100 // args.steps:3d}%|{'#' * filled}{' ' * (10 - filled)}| {step}/{args.steps}")
+            sys.stderr.flush()
+            await send({"type": "progress", "data": {"value": step, "max": args.steps, "prompt_id": prompt_id, "node": "3"}}, client_id)
+        sys.stderr.write("\n")
+        interrupted.discard(prompt_id)
+        finished = int(time.time() * 1000)
+        messages.append([outcome, {"prompt_id": prompt_id, "timestamp": finished}])
+        output = {"images": [{"filename": f"{prompt_id}.png", "subfolder": "", "type": "output"}]}
+        if outcome == "execution_success":
+            await send({"type": "executed", "data": {"node": "9", "output": output, "prompt_id": prompt_id}}, client_id)
+        await send({"type": outcome, "data": {"prompt_id": prompt_id, "timestamp": finished}}, client_id)
+        await send({"type": "executing", "data": {"node": None, "prompt_id": prompt_id}}, client_id)
+        history[prompt_id] = {
+            "prompt": item,
+            "outputs": {"9": output} if outcome == "execution_success" else {},
+            "status": {"status_str": "success" if outcome == "execution_success" else "error",
+                       "completed": outcome == "execution_success", "messages": messages},
+        }
+        queue_running.remove(item)
+        await send(queue_status())
+
+@app.on_event("startup")
+async def startup():
+    asyncio.create_task(worker())
+
+@app.get("/system_stats")
+async def system_stats():
+    return {"system": {"os": sys.platform, "python_version": sys.version, "comfyui_version": "fake"},
+            "devices": [{"name": f"cuda:{args.cuda_device} Fake GPU", "type": "cuda", "index": int(args.cuda_device)}]}
+
+@app.get("/object_info")
+async def object_info():
+    return OBJECT_INFO
+
+@app.get("/queue")
+async def get_queue():
+    return {"queue_running": queue_running, "queue_pending": queue_pending}
+
+@app.post("/queue")
+async def edit_queue(request: Request):
+    body = await request.json()
+    if body.get("clear"):
+        queue_pending.clear()
+    delete = set(body.get("delete", []))
+    queue_pending[:] = [item for item in queue_pending if item[1] not in delete]
+    return Response(status_code=200)
+
+@app.post("/prompt")
+async def post_prompt(request: Request):
+    global next_number
+    body = await request.json()
+    if not isinstance(body.get("prompt"), dict):
+        return JSONResponse({"error": {"type": "invalid_prompt", "message": "no prompt"}, "node_errors": {}}, status_code=400)
+    prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+    next_number += 1
+    number = -next_number if body.get("front") else next_number
+    extra = dict(body.get("extra_data") or {})
+    if body.get("client_id"):
+        extra["client_id"] = body["client_id"]
+    queue_pending.append([number, prompt_id, body["prompt"], extra, ["9"]])
+    work_available.set()
+    await send(queue_status())
+    return {"prompt_id": prompt_id, "number": number, "node_errors": {}}
+
+@app.post("/interrupt")
+async def interrupt(request: Request):
+    body = {}
+    try:
+        body = await request.json()
+    except Exception:
+        pass
+    for item in queue_running:
+        if not body.get("prompt_id") or body["prompt_id"] == item[1]:
+            interrupted.add(item[1])
+    return Response(status_code=200)
+
+@app.get("/history")
+async def get_history(max_items: int = 0):
+    items = list(history.items())
+    if max_items:
+        items = items[-max_items:]
+    return dict(items)
+
+@app.get("/history/{prompt_id}")
+async def get_history_item(prompt_id: str):
+    return {prompt_id: history[prompt_id]} if prompt_id in history else {}
+
+@app.get("/view")
+async def view(filename: str = "", type: str = "output"):
+    return Response(VIEW_BODY, media_type="image/png")
+
+@app.get("/assets/{name}")
+async def asset(name: str):
+    # 模拟前端打包出的带哈希文件名的脚本
+    body = ("// " + name + "\n" + "export const x = 1;\n" * 20000).encode()
+    return Response(body, media_type="application/javascript" if name.endswith(".js") else "text/css")
+
+@app.websocket("/ws")
+async def ws(websocket: WebSocket, clientId: str = ""):
+    await websocket.accept()
+    client_id = clientId or uuid.uuid4().hex
+    clients[client_id] = websocket
+    try:
+        status = queue_status()
+        status["data"]["sid"] = client_id
+        await websocket.send_text(json.dumps(status))
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if clients.get(client_id) is websocket:
+            del clients[client_id]
+
+def boot():
+    """模拟 ComfyUI 启动时的导入和自定义节点加载"""
+    print("Total VRAM 24564 MB, total RAM 65406 MB", flush=True)
+    print(f"Device: cuda:{args.cuda_device} Fake GPU", flush=True)
+    steps = 10
+    for i in range(steps):
+        time.sleep(args.boot_seconds / steps)
+        print(f"   {args.boot_seconds / steps:.1f} seconds: custom_nodes/fake_node_{i}", flush=True)
+    print(f"Starting server\n\nTo see the GUI go to: http://{args.listen}:{args.port}", flush=True)
+
+if __name__ == "__main__":
+    boot()
+    uvicorn.run(app, host=args.listen, port=args.port, log_level="warning", access_log=False)
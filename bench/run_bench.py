@@ -0,0 +1,513 @@
+"""
+控制器性能基准测试。用 fake_comfyui.py 代替真实的 ComfyUI，在普通 Linux 机器（包括 CI）上即可运行。
+
+    python bench/run_bench.py                       # 运行并把结果写入 bench/results/
+    python bench/run_bench.py --output result.json  # 指定结果文件
+    python bench/run_bench.py --compare old.json new.json
+
+测量项目：
+  - lifecycle       启动 / 重启 / 停止从提交到 /ws/status 报告完成的耗时
+  - ws_fanout       一次状态变化送达 N 个 /ws/status 客户端的延迟
+  - status_http     /status/{id} 的吞吐量和延迟
+  - proxy_view      经 /m/{id}/view 代理大图片的吞吐量
+  - proxy_overhead  /prompt、/view、/object_info 直连实例端口和经 /m/{id}/ 的延迟，以及代理增加的开销
+  - loop_lag        各阶段控制器事件循环的调度延迟（来自 /metrics 直方图）
+  - hammer          并发猛击启动/停止/重启接口，检查同一实例从不出现两个进程、重复请求合并到同一操作；
+                    违反时以非零状态退出，可作为 CI 检查：python bench/run_bench.py --only hammer
+
+结果为 JSON，耗时单位统一为毫秒，可以用 --compare 对比两次结果。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import psutil
+import websockets
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKE_COMFYUI = os.path.join(BENCH_DIR, "fake_comfyui.py")
+# 结果文件格式版本，字段有不兼容的变化时加一
+SCHEMA_VERSION = 1
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def summarize(samples):
+    """耗时样本（秒）的统计，输出毫秒"""
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return {
+        "n": len(ordered),
+        "mean": round(statistics.fmean(ordered) * 1000, 3),
+        "p50": round(pct(50) * 1000, 3),
+        "p95": round(pct(95) * 1000, 3),
+        "p99": round(pct(99) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+class Controller:
+    """以子进程方式运行控制器，使用临时配置"""
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.workdir = tempfile.mkdtemp(prefix="comfy_web_bench_")
+        self.machine_ids = [f"bench{i}" for i in range(opts.instances)]
+        # 猛击测试用的卡死实例：永远启动不完，看门狗关闭，2 秒启动超时
+        self.hung_id = "benchhung"
+        config = {
+            "python": sys.executable,
+            "main": FAKE_COMFYUI,
+            "args": ["--boot-seconds", str(opts.boot_seconds), "--job-seconds", str(opts.job_seconds),
+                     "--view-mb", str(opts.view_mb)],
+            "listen": "127.0.0.1",
+            "instances": [{"id": mid, "port": free_port(), "gpu": i} for i, mid in enumerate(self.machine_ids)] + [
+                {"id": self.hung_id, "port": free_port(), "gpu": opts.instances, "watchdog": False,
+                 "startup_timeout": 2, "extra_args": ["--boot-seconds", "3600"]},
+            ],
+            # 猛击测试要看到并发启动，不能被启动调度排队掩盖
+            "launch_concurrency": 0,
+            "prewarm_rate_mb": 0,
+        }
+        self.ports = {spec["id"]: spec["port"] for spec in config["instances"]}
+        self.config_path = os.path.join(self.workdir, "comfy_web.json")
+        with open(self.config_path, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+        self.process = None
+
+    async def __aenter__(self):
+        env = dict(os.environ, COMFY_WEB_CONFIG=self.config_path)
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "comfy_web:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--no-access-log", "--log-level", "warning"],
+            cwd=REPO_DIR, env=env,
+        )
+        async with httpx.AsyncClient() as client:
+            for _ in range(200):
+                try:
+                    if (await client.get(f"{self.url}/instances")).status_code == 200:
+                        return self
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.05)
+        raise RuntimeError("控制器没有启动")
+
+    async def __aexit__(self, *exc):
+        async with httpx.AsyncClient(base_url=self.url, timeout=30) as client:
+            for mid in self.machine_ids + [self.hung_id]:
+                try:
+                    await client.get(f"/stop/{mid}")
+                except httpx.HTTPError:
+                    pass
+            await asyncio.sleep(1)
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class StatusWatcher:
+    """订阅 /ws/status，保存每台机器的最新状态"""
+
+    def __init__(self, url):
+        self.url = url.replace("http://", "ws://") + "/ws/status"
+        self.states = {}
+        self.changed = asyncio.Condition()
+        self.task = None
+
+    async def __aenter__(self):
+        self.ws = await websockets.connect(self.url, max_size=None)
+        self.task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.task.cancel()
+        await self.ws.close()
+
+    async def _run(self):
+        async for raw in self.ws:
+            message = json.loads(raw)
+            async with self.changed:
+                if message.get("type") == "snapshot":
+                    self.states = dict(message["machines"])
+                elif message.get("type") == "delta":
+                    self.states[message["machine"]] = message["state"]
+                self.changed.notify_all()
+
+    async def wait_for(self, machine_id, predicate, timeout=120):
+        async def check():
+            async with self.changed:
+                await self.changed.wait_for(lambda: predicate(self.states.get(machine_id)))
+        await asyncio.wait_for(check(), timeout)
+
+async def bench_lifecycle(ctl, client, watcher, rounds):
+    """启动、重启、停止的端到端耗时"""
+    results = {"start": [], "restart": [], "stop": []}
+    for _ in range(rounds):
+        for mid in ctl.machine_ids:
+            started = time.perf_counter()
+            await client.get(f"/start/{mid}")
+            await watcher.wait_for(mid, lambda s: s and s["status"] == "running")
+            results["start"].append(time.perf_counter() - started)
+
+            boot = watcher.states[mid]["boot"]
+            started = time.perf_counter()
+            await client.get(f"/restart/{mid}")
+            await watcher.wait_for(mid, lambda s: s and s["status"] == "running" and s["boot"] != boot)
+            results["restart"].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await client.get(f"/stop/{mid}")
+            await watcher.wait_for(mid, lambda s: s and s["status"] == "stopped")
+            results["stop"].append(time.perf_counter() - started)
+    return {name: summarize(samples) for name, samples in results.items()}
+
+async def bench_ws_fanout(ctl, client, clients, events):
+    """注册表变化（增删一个实例）送达所有客户端的延迟"""
+    url = ctl.url.replace("http://", "ws://") + "/ws/status"
+    sockets = await asyncio.gather(*(websockets.connect(url, max_size=None) for _ in range(clients)))
+    # 读掉连接时的快照
+    await asyncio.gather(*(ws.recv() for ws in sockets))
+    latencies = []
+
+    async def receive(ws, machine_id, started):
+        while True:
+            message = json.loads(await ws.recv())
+            if message.get("type") == "delta" and message["machine"] == machine_id:
+                return time.perf_counter() - started
+
+    port = free_port()
+    try:
+        for i in range(events):
+            machine_id = "fanout"
+            started = time.perf_counter()
+            if i % 2 == 0:
+                await client.post("/instances", json={"id": machine_id, "port": port, "gpu": 0})
+            else:
+                await client.delete(f"/instances/{machine_id}")
+            latencies += await asyncio.gather(*(receive(ws, machine_id, started) for ws in sockets))
+        if events % 2:
+            await client.delete("/instances/fanout")
+    finally:
+        await asyncio.gather(*(ws.close() for ws in sockets))
+    return {"clients": clients, "events": events, "latency": summarize(latencies)}
+
+async def bench_status_http(ctl, client, duration, concurrency):
+    """并发请求 /status/{id} 的吞吐量"""
+    latencies = []
+    deadline = time.perf_counter() + duration
+    mid = ctl.machine_ids[0]
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await client.get(f"/status/{mid}")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {"concurrency": concurrency, "requests_per_second": round(len(latencies) / elapsed, 1),
+            "latency": summarize(latencies)}
+
+async def bench_proxy_view(ctl, client, watcher, requests):
+    """经反向代理下载大图片的吞吐量"""
+    mid = ctl.machine_ids[0]
+    await client.get(f"/start/{mid}")
+    await watcher.wait_for(mid, lambda s: s and s["status"] == "running")
+    latencies = []
+    total = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        t = time.perf_counter()
+        response = await client.get(f"/m/{mid}/view", params={"filename": "bench.png"})
+        total += len(response.content)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    await client.get(f"/stop/{mid}")
+    await watcher.wait_for(mid, lambda s: s and s["status"] == "stopped")
+    return {"requests": requests, "megabytes_per_second": round(total / elapsed / 1024 / 1024, 1),
+            "latency": summarize(latencies)}
+
+async def bench_proxy_overhead(ctl, client, watcher, requests):
+    """同一实例的三个接口分别直连和经代理请求，比较延迟"""
+    mid = ctl.machine_ids[0]
+    await client.get(f"/start/{mid}")
+    await watcher.wait_for(mid, lambda s: s and s["status"] == "running")
+    endpoints = {
+        "prompt": ("POST", "/prompt", {"json": {"prompt": {"1": {"class_type": "FakeNode0", "inputs": {}}}}}),
+        "view": ("GET", "/view", {"params": {"filename": "bench.png"}}),
+        "object_info": ("GET", "/object_info", {}),
+    }
+    bases = {"direct": f"http://127.0.0.1:{ctl.ports[mid]}", "proxied": f"{ctl.url}/m/{mid}"}
+    results = {}
+    async with httpx.AsyncClient(timeout=120) as raw:
+        for name, (method, path, kwargs) in endpoints.items():
+            samples = {"direct": [], "proxied": []}
+            # 两种方式交替请求，实例负载的变化对两边的影响相同；先各请求一次预热连接和缓存
+            for i in range(requests + 1):
+                for way, base in bases.items():
+                    started = time.perf_counter()
+                    response = await raw.request(method, base + path, **kwargs)
+                    response.raise_for_status()
+                    if i:
+                        samples[way].append(time.perf_counter() - started)
+            direct, proxied = summarize(samples["direct"]), summarize(samples["proxied"])
+            results[name] = {
+                "direct": direct,
+                "proxied": proxied,
+                "overhead_p50": round(proxied["p50"] - direct["p50"], 3),
+                "overhead_p95": round(proxied["p95"] - direct["p95"], 3),
+            }
+    # 清掉测试提交的任务
+    await client.get(f"/stop/{mid}")
+    await watcher.wait_for(mid, lambda s: s and s["status"] == "stopped")
+    return {"requests": requests, **results}
+
+def instance_processes(port):
+    """监听指定端口的模拟 ComfyUI 进程数"""
+    count = 0
+    for proc in psutil.process_iter(["cmdline"]):
+        cmdline = proc.info["cmdline"] or []
+        if FAKE_COMFYUI in cmdline and "--port" in cmdline and cmdline[cmdline.index("--port") + 1:][:1] == [str(port)]:
+            count += 1
+    return count
+
+async def wait_operations(client, op_ids, timeout=120):
+    """等待操作全部结束，返回 操作 id -> 操作记录"""
+    deadline = time.perf_counter() + timeout
+    done = {}
+    while len(done) < len(op_ids):
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"{len(op_ids) - len(done)} 个操作没有结束")
+        for op_id in op_ids - done.keys():
+            op = (await client.get(f"/operations/{op_id}")).json().get("operation")
+            if op and op["state"] in ("success", "error"):
+                done[op_id] = op
+        await asyncio.sleep(0.1)
+    return done
+
+async def bench_hammer(ctl, client, watcher, requests):
+    """并发发送生命周期请求，检查进程数和操作合并"""
+    violations = []
+    max_processes = 0
+    sampling = True
+
+    async def sample():
+        nonlocal max_processes
+        while sampling:
+            for mid, port in ctl.ports.items():
+                count = await asyncio.to_thread(instance_processes, port)
+                max_processes = max(max_processes, count)
+                if count > 1:
+                    violations.append(f"{mid} 同时有 {count} 个进程")
+            await asyncio.sleep(0.05)
+
+    async def storm(mid, actions):
+        responses = await asyncio.gather(*(client.get(f"/{action}/{mid}") for action in actions))
+        ops = {r.json()["operation"] for r in responses if r.json().get("status") == "success"}
+        errors = [r.json()["message"] for r in responses if r.json().get("status") != "success"]
+        violations.extend(f"{mid} 请求被拒绝: {message}" for message in errors)
+        return ops, await wait_operations(client, ops)
+
+    sampler = asyncio.create_task(sample())
+    results = {"requests": 0, "operations": 0, "failed_operations": 0}
+    started = time.perf_counter()
+    try:
+        for mid in ctl.machine_ids:
+            # 同时点击启动：只有一个进程，重复的请求合并或者直接报告已在运行，都不能失败
+            ops, done = await storm(mid, ["start"] * requests)
+            results["requests"] += requests
+            results["operations"] += len(ops)
+            violations.extend(f"{mid} 重复启动失败: {op['message']}" for op in done.values() if op["state"] == "error")
+            await watcher.wait_for(mid, lambda s: s and s["status"] == "running")
+
+            # 启动、停止、重启混在一起，全部结束后再并发停止
+            actions = [("start", "stop", "restart")[i % 3] for i in range(requests)]
+            ops, done = await storm(mid, actions)
+            results["requests"] += len(actions)
+            results["operations"] += len(ops)
+            results["failed_operations"] += sum(1 for op in done.values() if op["state"] == "error")
+            ops, _ = await storm(mid, ["stop"] * requests)
+            results["requests"] += requests
+            results["operations"] += len(ops)
+            await watcher.wait_for(mid, lambda s: s and s["status"] == "stopped")
+            if await asyncio.to_thread(instance_processes, ctl.ports[mid]):
+                violations.append(f"{mid} 停止后仍有进程")
+
+        # 启动卡死、超时后状态变为停止的实例：进程必须被结束，之后的启动停止也不能多出进程
+        mid = ctl.hung_id
+        ops, _ = await storm(mid, ["start"] * requests)
+        results["requests"] += requests
+        results["operations"] += len(ops)
+        await watcher.wait_for(mid, lambda s: s and s["status"] == "stopped" and s["boot"] is not None)
+        await asyncio.sleep(0.5)
+        if await asyncio.to_thread(instance_processes, ctl.ports[mid]):
+            violations.append(f"{mid} 启动超时后进程仍在运行")
+        actions = [("start", "stop")[i % 2] for i in range(requests)]
+        ops, _ = await storm(mid, actions)
+        results["requests"] += len(actions)
+        results["operations"] += len(ops)
+        ops, _ = await storm(mid, ["stop"] * requests)
+        results["requests"] += requests
+        results["operations"] += len(ops)
+        await watcher.wait_for(mid, lambda s: s and s["status"] == "stopped")
+        if await asyncio.to_thread(instance_processes, ctl.ports[mid]):
+            violations.append(f"{mid} 停止后仍有进程")
+    finally:
+        sampling = False
+        await sampler
+    return {
+        "elapsed": round((time.perf_counter() - started) * 1000, 1),
+        "max_processes_per_instance": max_processes,
+        "violations": violations[:20],
+        **results,
+    }
+
+async def loop_lag_histogram(client):
+    """读取 /metrics 中的事件循环延迟直方图"""
+    text = (await client.get("/metrics")).text
+    buckets = []
+    total = count = 0.0
+    for line in text.splitlines():
+        if line.startswith("comfy_controller_loop_lag_seconds_bucket"):
+            bound = line.split('le="')[1].split('"')[0]
+            buckets.append((float("inf") if bound == "+Inf" else float(bound), float(line.rsplit(" ", 1)[1])))
+        elif line.startswith("comfy_controller_loop_lag_seconds_sum"):
+            total = float(line.rsplit(" ", 1)[1])
+        elif line.startswith("comfy_controller_loop_lag_seconds_count"):
+            count = float(line.rsplit(" ", 1)[1])
+    return {"buckets": buckets, "sum": total, "count": count}
+
+def lag_between(before, after):
+    """两次直方图之差：平均值和按分桶上限估计的 p99（毫秒）"""
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {"n": 0}
+    p99 = None
+    for (bound, a), (_, b) in zip(after["buckets"], before["buckets"]):
+        if a - b >= 0.99 * count:
+            p99 = bound
+            break
+    return {
+        "n": int(count),
+        "mean": round((after["sum"] - before["sum"]) / count * 1000, 3),
+        "p99_upper_bound": None if p99 in (None, float("inf")) else round(p99 * 1000, 3),
+    }
+
+async def run(opts):
+    results = {}
+    lag = {}
+    async with Controller(opts) as ctl:
+        limits = httpx.Limits(max_connections=opts.concurrency * 2, max_keepalive_connections=opts.concurrency * 2)
+        async with httpx.AsyncClient(base_url=ctl.url, timeout=120, limits=limits) as client:
+            async with StatusWatcher(ctl.url) as watcher:
+                phases = [
+                    ("lifecycle", lambda: bench_lifecycle(ctl, client, watcher, opts.rounds)),
+                    ("ws_fanout", lambda: bench_ws_fanout(ctl, client, opts.clients, opts.events)),
+                    ("status_http", lambda: bench_status_http(ctl, client, opts.duration, opts.concurrency)),
+                    ("proxy_view", lambda: bench_proxy_view(ctl, client, watcher, opts.view_requests)),
+                    ("proxy_overhead", lambda: bench_proxy_overhead(ctl, client, watcher, opts.overhead_requests)),
+                    ("hammer", lambda: bench_hammer(ctl, client, watcher, opts.hammer_requests)),
+                ]
+                for name, phase in phases:
+                    if opts.only and name not in opts.only:
+                        continue
+                    before = await loop_lag_histogram(client)
+                    print(f"[bench] {name} ...", flush=True)
+                    results[name] = await phase()
+                    lag[name] = lag_between(before, await loop_lag_histogram(client))
+                    print(f"[bench] {name}: {json.dumps(results[name], ensure_ascii=False)}", flush=True)
+    results["loop_lag"] = lag
+    return results
+
+def flatten(value, prefix=""):
+    """把嵌套结果展开成 路径 -> 数值，供对比"""
+    flat = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flat.update(flatten(item, f"{prefix}.{key}" if prefix else key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        flat[prefix] = value
+    return flat
+
+def compare(old_path, new_path):
+    """打印两次结果中各项指标的变化"""
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    if old.get("schema") != new.get("schema"):
+        print(f"结果格式版本不同: {old.get('schema')} vs {new.get('schema')}")
+    old_flat, new_flat = flatten(old["results"]), flatten(new["results"])
+    for key in sorted(old_flat.keys() & new_flat.keys()):
+        a, b = old_flat[key], new_flat[key]
+        change = f"{(b - a) / a * 100:+.1f}%" if a else ""
+        print(f"{key:55s} {a:>12} -> {b:<12} {change}")
+
+def main():
+    parser = argparse.ArgumentParser(description="comfy_web 控制器基准测试")
+    parser.add_argument("--instances", type=int, default=2, help="模拟实例数")
+    parser.add_argument("--rounds", type=int, default=3, help="每个实例的启动/重启/停止轮数")
+    parser.add_argument("--boot-seconds", type=float, default=1.0, help="模拟 ComfyUI 的启动耗时")
+    parser.add_argument("--job-seconds", type=float, default=2.0, help="模拟任务的执行耗时")
+    parser.add_argument("--view-mb", type=float, default=8.0, help="/view 返回的图片大小（MB）")
+    parser.add_argument("--clients", type=int, default=100, help="/ws/status 客户端数")
+    parser.add_argument("--events", type=int, default=20, help="扇出测试的状态变化次数")
+    parser.add_argument("--duration", type=float, default=5.0, help="吞吐量测试时长（秒）")
+    parser.add_argument("--concurrency", type=int, default=32, help="吞吐量测试并发数")
+    parser.add_argument("--view-requests", type=int, default=20, help="代理下载次数")
+    parser.add_argument("--overhead-requests", type=int, default=50, help="代理开销测试每个接口的请求数")
+    parser.add_argument("--hammer-requests", type=int, default=30, help="猛击测试每轮的并发请求数")
+    parser.add_argument("--only", nargs="*", help="只运行指定阶段")
+    parser.add_argument("--output", help="结果文件，默认 bench/results/<时间>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="对比两次结果")
+    opts = parser.parse_args()
+
+    if opts.compare:
+        compare(*opts.compare)
+        return
+
+    results = asyncio.run(run(opts))
+    report = {
+        "schema": SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": {k: v for k, v in vars(opts).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+    output = opts.output or os.path.join(BENCH_DIR, "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[bench] 结果已写入 {output}")
+    if results.get("hammer", {}).get("violations"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
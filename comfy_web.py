@@ -1,215 +1,3784 @@
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
-import subprocess
-import threading
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+import httpx
+import websockets
 import time
+import os
+import sys
 import psutil
-import socket
 import asyncio
 import uuid
 import json
+import math
+import codecs
+import logging
+import logging.handlers
+import html
+import gzip
+import hashlib
+import hmac
+import re
+import subprocess
+import socket
+import ctypes
+import mmap
+import glob
+import bisect
+import mimetypes
+import stat
+from array import array
+from collections import OrderedDict, deque
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
 app = FastAPI()
 
-# 实例配置
-instances = {
-    "5090": {
-        "name": "5090",
-        "port": 5090,
-        "gpu": 1,
-        "process": None,
-        "status": "stopped",
-        "url": "http://localhost:5090",
-        "last_broadcast_status": None
-    },
-    "4090": {
-        "name": "4090",
-        "port": 4090,
-        "gpu": 0,
+# ---------------- 实例注册表 ----------------
+# 实例定义在配置文件 comfy_web.json 中（默认与本文件同目录，可用环境变量 COMFY_WEB_CONFIG 指定）。
+# "instances" 为列表时逐个创建；为 "auto" 时按检测到的显卡每张卡创建一个实例；
+# 没有配置文件时沿用原来的 5090/4090 两个实例。
+
+CONFIG_PATH = os.environ.get("COMFY_WEB_CONFIG") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "comfy_web.json")
+# 状态目录：启动历史、排空的任务、预热列表、实例输出文件和进程记录。
+# 放在配置文件旁的 comfy_web_run/<配置文件名>/ 下，同一目录中用不同配置文件运行的多个控制器互不干扰。
+STATE_DIR = os.path.join(os.path.dirname(CONFIG_PATH), "comfy_web_run",
+                         os.path.splitext(os.path.basename(CONFIG_PATH))[0])
+
+DEFAULT_CONFIG = {
+    "python": r".\python_embeded\python.exe",
+    "main": r".\ComfyUI\main.py",
+    "listen": "localhost",
+    # 自动发现时第一张卡使用的端口，后续依次加一
+    "base_port": 8188,
+    # 所有实例共用的启动参数
+    "args": ["--windows-standalone-build", "--multi-user", "--disable-auto-launch", "--disable-xformers"],
+    # 日志文件目录，为空时只保留在内存中
+    "log_dir": "",
+    # 重启时先在备用端口启动新进程，就绪后再切换（实例也可以单独设置 "standby"）
+    "standby": False,
+    # 不需要转换的 /view 由控制器直接读取输出目录返回
+    "direct_view": True,
+    # /object_info 和前端资源缓存的内存上限（MB）
+    "response_cache_mb": 256,
+    # 启动前预热的模型文件，可用通配符，相对路径以 ComfyUI 目录为准
+    "prewarm": [],
+    # 预热读取速度上限（MB/s），0 为不限速
+    "prewarm_rate_mb": 500,
+    # 停止和重启默认是否先排空（也可以在请求中用 ?drain=1 / ?drain=0 指定）
+    "drain": False,
+    # 排空的截止时间（秒），超时强制结束（实例也可以单独设置 "drain_timeout"）
+    "drain_timeout": 600,
+    # 控制器监听的端口
+    "port": 8000,
+    # 同时冷启动的实例数上限，0 为不限制
+    "launch_concurrency": 2,
+    # 已有实例在冷启动时，磁盘读取超过该速度（MB/s）暂不放行下一个，0 为不检查
+    "launch_disk_mb": 200,
+    # 可用内存低于该值（MB）时暂不放行，0 为不检查
+    "launch_min_free_mb": 4096,
+    # 没有任务多少秒后自动停止实例，收到请求时再启动，0 为不停止
+    "idle_timeout": 0,
+    # 空闲停止时至少保留的运行中实例数
+    "min_warm": 1,
+    # 作为节点代理时中心控制器连接 /ws/agent 使用的令牌，为空时不开放
+    "agent_token": "",
+    # 统一管理的远程节点：[{"id": "box1", "url": "http://10.0.0.2:8000", "token": "..."}]
+    "nodes": [],
+    # 是否启用看门狗（实例也可以单独用 "watchdog": false 关闭）
+    "watchdog": True,
+    "instances": [
+        {"id": "5090", "name": "5090", "port": 5090, "gpu": 1},
+        {"id": "4090", "name": "4090", "port": 4090, "gpu": 0},
+    ],
+}
+
+INSTANCE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+config = dict(DEFAULT_CONFIG)
+instances = {}
+# 每次增删实例加一，页面按版本缓存
+registry_version = 0
+
+def enumerate_nvidia_gpus():
+    """通过 nvidia-smi 列出显卡"""
+    try:
+        result = subprocess.run(
+            ["nvidia-smi", "--query-gpu=index,name", "--format=csv,noheader"],
+            capture_output=True, text=True, timeout=10,
+        )
+    except Exception:
+        return []
+    gpus = []
+    for line in result.stdout.splitlines():
+        parts = [p.strip() for p in line.split(",", 1)]
+        if len(parts) == 2 and parts[0].isdigit():
+            gpus.append({"index": int(parts[0]), "name": parts[1]})
+    return gpus
+
+# 显卡枚举函数，测试或没有 nvidia-smi 的环境可以替换
+gpu_enumerator = enumerate_nvidia_gpus
+
+def set_gpu_enumerator(func):
+    """替换显卡枚举函数，func() 返回 [{"index": int, "name": str}, ...]"""
+    global gpu_enumerator
+    gpu_enumerator = func
+
+def load_config():
+    """读取配置文件，缺省项使用默认值"""
+    cfg = dict(DEFAULT_CONFIG)
+    if os.path.exists(CONFIG_PATH):
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            cfg.update(json.load(f))
+    return cfg
+
+def save_config():
+    """把当前实例列表写回配置文件（自动发现的实例也会写成明确的列表）"""
+    cfg = dict(config)
+    cfg["instances"] = [inst["spec"] for inst in instances.values() if not inst.get("node")]
+    tmp_path = CONFIG_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cfg, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, CONFIG_PATH)
+
+def normalize_spec(spec, index=0, cfg=None):
+    """校验实例定义并补全默认值；cfg 为尚未生效的新配置时按它补全"""
+    cfg = cfg or config
+    spec = dict(spec)
+    machine_id = str(spec.get("id", ""))
+    if not INSTANCE_ID_PATTERN.match(machine_id):
+        raise ValueError(f"实例 id 不合法: {machine_id!r}")
+    spec["id"] = machine_id
+    spec.setdefault("name", machine_id)
+    spec["port"] = int(spec.get("port") or cfg["base_port"] + index)
+    spec["gpu"] = int(spec.get("gpu", index))
+    spec["extra_args"] = [str(arg) for arg in spec.get("extra_args", [])]
+    spec["env"] = {str(k): str(v) for k, v in spec.get("env", {}).items()}
+    return spec
+
+def instance_specs(cfg):
+    """根据配置得到实例定义列表"""
+    if cfg["instances"] == "auto":
+        return [
+            normalize_spec({"id": f"gpu{gpu['index']}", "name": f"GPU{gpu['index']}", "gpu": gpu["index"]}, i, cfg)
+            for i, gpu in enumerate(gpu_enumerator())
+        ]
+    return [normalize_spec(spec, i, cfg) for i, spec in enumerate(cfg["instances"])]
+
+def normalize_node(spec):
+    """校验节点定义"""
+    spec = dict(spec)
+    node_id = str(spec.get("id", ""))
+    if not INSTANCE_ID_PATTERN.match(node_id):
+        raise ValueError(f"节点 id 不合法: {node_id!r}")
+    url = str(spec.get("url", "")).rstrip("/")
+    if not url.startswith(("http://", "https://")):
+        raise ValueError(f"节点 {node_id} 的 url 必须是 http(s):// 地址")
+    spec.update(id=node_id, url=url, token=str(spec.get("token", "")))
+    return spec
+
+def node_specs(cfg):
+    """根据配置得到远程节点列表"""
+    specs = [normalize_node(spec) for spec in cfg.get("nodes") or []]
+    if len({spec["id"] for spec in specs}) != len(specs):
+        raise ValueError("节点 id 重复")
+    return specs
+
+def upstream_host():
+    """连接实例时使用的主机名"""
+    listen = config["listen"]
+    return "localhost" if listen in ("0.0.0.0", "::", "") else listen
+
+def apply_spec(inst):
+    """把实例定义同步到运行时字段（运行中的实例在下次启动时生效）"""
+    spec = inst["spec"]
+    inst["name"] = spec["name"]
+    inst["port"] = spec["port"]
+    inst["gpu"] = spec["gpu"]
+    inst["url"] = f"http://{upstream_host()}:{spec['port']}"
+
+def make_instance(spec):
+    """根据实例定义创建运行时记录"""
+    inst = {
+        "spec": spec,
         "process": None,
         "status": "stopped",
-        "url": "http://localhost:4090",
         "last_broadcast_status": None
     }
-}
+    apply_spec(inst)
+    return inst
+
+def check_port_conflict(spec):
+    """端口不能与其他实例重复"""
+    for machine_id, inst in instances.items():
+        # 远程实例在别的机器上，端口互不影响
+        if machine_id != spec["id"] and not inst.get("node") and inst["spec"]["port"] == spec["port"]:
+            raise ValueError(f"端口 {spec['port']} 已被 {machine_id} 使用")
+
+def check_registry_ports(specs):
+    """新的实例列表内端口不能重复，也不能占用保留下来、仍在旧端口运行的实例"""
+    wanted = {spec["id"] for spec in specs}
+    used = {}
+    for spec in specs:
+        if spec["port"] in used:
+            raise ValueError(f"端口 {spec['port']} 同时被 {used[spec['port']]} 和 {spec['id']} 使用")
+        used[spec["port"]] = spec["id"]
+    for machine_id, inst in instances.items():
+        if machine_id in wanted and inst["process"] is not None and not inst.get("node"):
+            owner = used.get(inst["port"])
+            if owner is not None and owner != machine_id:
+                raise ValueError(f"端口 {inst['port']} 仍被运行中的 {machine_id} 使用，不能分配给 {owner}")
+
+def init_registry():
+    """启动时根据配置文件建立注册表"""
+    global config, registry_version
+    config = load_config()
+    for spec in instance_specs(config):
+        instances[spec["id"]] = make_instance(spec)
+    # 节点定义有误时和实例定义一样在启动时报错，连接在 startup 中建立
+    node_specs(config)
+    registry_version += 1
+
+init_registry()
 
 # WebSocket连接管理器
+# 每个客户端有独立的有界发送队列和写任务，慢客户端不会拖慢其他客户端；
+# 同一台机器的连续状态更新只保留最新一条，积压过多或发送超时的客户端直接断开。
+
+# 每个客户端最多积压的消息数
+MAX_PENDING_MESSAGES = 256
+# 单条消息的发送超时（秒）
+SEND_TIMEOUT = 10
+
+def coalesce_key(message):
+    """可以合并的消息返回合并键，后到的消息覆盖先到的"""
+    if message.get("type") == "delta":
+        # 增量里带的是机器的完整状态，只保留最新一条不会丢信息
+        return ("delta", message.get("machine"))
+    if message.get("type") in ("operation", "bulk"):
+        return (message["type"], message.get("id"))
+    if message.get("type") == "launch_queue":
+        return ("launch_queue",)
+    return None
+
+class Subscriber:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.pending = OrderedDict()
+        self.ready = asyncio.Event()
+        self.counter = 0
+        self.task = None
+
+    def offer(self, message: dict):
+        """放入发送队列，积压超限时返回 False"""
+        key = coalesce_key(message)
+        if key is None:
+            self.counter += 1
+            key = ("seq", self.counter)
+        self.pending[key] = message
+        self.pending.move_to_end(key)
+        self.ready.set()
+        return len(self.pending) <= MAX_PENDING_MESSAGES
+
+    async def run(self):
+        """按顺序发送队列中的消息"""
+        while True:
+            await self.ready.wait()
+            while self.pending:
+                _, message = self.pending.popitem(last=False)
+                await asyncio.wait_for(self.websocket.send_json(message), timeout=SEND_TIMEOUT)
+            self.ready.clear()
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections = []
+        self.active_connections = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        subscriber = Subscriber(websocket)
+        self.active_connections[websocket] = subscriber
+        subscriber.task = asyncio.create_task(self._writer(subscriber))
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+    async def _writer(self, subscriber):
+        try:
+            await subscriber.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(subscriber.websocket)
+
+    def disconnect(self, websocket: WebSocket, close=False):
+        subscriber = self.active_connections.pop(websocket, None)
+        if subscriber is None:
+            return
+        if subscriber.task is not None and subscriber.task is not asyncio.current_task():
+            subscriber.task.cancel()
+        if close:
+            asyncio.create_task(self._close(websocket))
+
+    async def _close(self, websocket):
+        try:
+            await websocket.close(code=1008)
+        except Exception:
+            pass
+
+    def send(self, websocket: WebSocket, message: dict):
+        """只发给某一个客户端"""
+        subscriber = self.active_connections.get(websocket)
+        if subscriber is not None and not subscriber.offer(message):
+            self.disconnect(websocket, close=True)
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except:
-                self.disconnect(connection)
+        # 只入队不等待发送，遍历副本以便中途断开客户端
+        for websocket, subscriber in list(self.active_connections.items()):
+            if not subscriber.offer(message):
+                self.disconnect(websocket, close=True)
 
 manager = ConnectionManager()
 
+# ---------------- 状态快照与增量 ----------------
+# 每次机器状态变化分配一个单调递增的序号。新连接先收到全量快照，之后只收增量；
+# 断线重连时带上 epoch 和最后的序号，在保留范围内只补发缺失的增量。
+
+# 最多保留多少条增量用于断线续传
+MAX_DELTA_HISTORY = 1000
+
+class StateStore:
+    def __init__(self):
+        # 控制器每次启动换一个 epoch，序号只在同一个 epoch 内可比较
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.machines = {}
+        self.deltas = deque(maxlen=MAX_DELTA_HISTORY)
+
+    def machine_state(self, machine_id):
+        """对外公开的机器状态"""
+        inst = instances[machine_id]
+        if inst.get("node"):
+            return remote_state(inst)
+        return {
+            "name": inst["name"],
+            "status": inst["status"],
+            # 每次启动生成新的 boot，页面据此决定是否重新加载 iframe
+            "boot": inst.get("boot_id"),
+            # 启动中的实例最近完成的阶段
+            "phase": launch_phase(inst.get("launch")),
+            # 看门狗的处理进度，没有介入过时为 None
+            "watchdog": inst.get("watchdog"),
+            # 热备重启中的新进程：端口和启动阶段
+            "standby": inst.get("standby"),
+            # 排空进度：mode、phase、迁移和保存的任务数、截止时间
+            "drain": inst.get("drain"),
+            # 所在的远程节点，本机实例为 None
+            "node": None,
+            # 空闲停止，收到请求时自动启动
+            "idle": inst["status"] == "stopped" and inst.get("desired") == "idle",
+        }
+
+    def update(self, machine_id):
+        """重新计算机器状态，有变化时返回增量消息；实例被删除时 state 为 None"""
+        state = self.machine_state(machine_id) if machine_id in instances else None
+        if self.machines.get(machine_id) == state:
+            return None
+        self.seq += 1
+        if state is None:
+            self.machines.pop(machine_id, None)
+        else:
+            self.machines[machine_id] = state
+        delta = {"type": "delta", "epoch": self.epoch, "seq": self.seq, "machine": machine_id, "state": state}
+        self.deltas.append(delta)
+        return delta
+
+    def snapshot(self):
+        # 按注册表顺序输出
+        machines = {machine_id: self.machines[machine_id] for machine_id in instances if machine_id in self.machines}
+        return {"type": "snapshot", "epoch": self.epoch, "seq": self.seq, "machines": machines}
+
+    def deltas_since(self, epoch, seq):
+        """返回 seq 之后的增量；无法续传时返回 None"""
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.deltas or self.deltas[0]["seq"] > seq + 1:
+            return None
+        return [delta for delta in self.deltas if delta["seq"] > seq]
+
+state_store = StateStore()
+
+async def publish_state(machine_id):
+    """机器状态有变化时广播增量"""
+    delta = state_store.update(machine_id)
+    if delta is not None:
+        await manager.broadcast(delta)
+        if "." not in machine_id:
+            # 本机实例的变化同时推送给连接到本节点的控制器
+            await agent_links.broadcast(delta)
+
 # 当前选中的机器
 current_machine = "5090"
 
-def is_port_open(host, port):
-    """检查端口是否开放"""
+# ---------------- 启动时间线 ----------------
+# 每次启动按阶段记录耗时（相对启动时刻的秒数）：
+#   spawn        进程创建完成
+#   first_output 首次输出，Python 解释器和早期导入已完成
+#   port_bound   端口开始接受连接
+#   ready        /system_stats 可用，自定义节点加载完成
+#   first_prompt 第一个 prompt 被接受
+# 历史记录保存在状态目录的 launches.json，启动超时根据历史 ready 耗时推算，
+# 节点或 ComfyUI 更新后可以看出是哪个阶段变慢了。
+
+LAUNCH_PHASES = ("spawn", "first_output", "port_bound", "ready", "first_prompt")
+LAUNCH_HISTORY_PATH = os.path.join(STATE_DIR, "launches.json")
+# 每个实例保留的启动记录数
+LAUNCH_HISTORY_SIZE = 50
+# 没有历史数据时的启动超时（秒）
+DEFAULT_STARTUP_TIMEOUT = 300
+# 推算出的启动超时上下限（秒）
+MIN_STARTUP_TIMEOUT = 60
+MAX_STARTUP_TIMEOUT = 1800
+
+# machine_id -> deque[启动记录]
+launch_history = {}
+
+def load_launch_history():
+    try:
+        with open(LAUNCH_HISTORY_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+    for machine_id, records in data.items():
+        launch_history[machine_id] = deque(records, maxlen=LAUNCH_HISTORY_SIZE)
+
+def save_launch_history():
+    data = {machine_id: list(records) for machine_id, records in launch_history.items()}
+    tmp_path = LAUNCH_HISTORY_PATH + ".tmp"
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, LAUNCH_HISTORY_PATH)
+    except OSError:
+        pass
+
+def begin_launch(boot_id):
+    """开始记录一次启动"""
+    return {
+        "boot": boot_id,
+        "started_at": time.time(),
+        "phases": {},
+        "outcome": "starting",
+    }
+
+def mark_phase(launch, phase):
+    """记录阶段完成时间，同一阶段只记第一次；返回是否新记录"""
+    if launch is None or phase in launch["phases"]:
+        return False
+    launch["phases"][phase] = round(time.time() - launch["started_at"], 3)
+    return True
+
+def finish_launch(machine_id, launch, outcome):
+    """启动结束（就绪或失败）时写入历史"""
+    if launch is None or launch["outcome"] != "starting":
+        return
+    launch["outcome"] = outcome
+    launch_history.setdefault(machine_id, deque(maxlen=LAUNCH_HISTORY_SIZE)).append(launch)
+    save_launch_history()
+
+def record_first_prompt(machine_id):
+    """实例第一次成功接受 prompt"""
+    inst = instances.get(machine_id)
+    launch = inst.get("launch") if inst else None
+    if mark_phase(launch, "first_prompt") and launch["outcome"] != "starting":
+        # 记录已经在历史里（同一个对象），重新保存即可
+        save_launch_history()
+
+def startup_timeout(machine_id):
+    """根据历史 ready 耗时推算启动超时"""
+    inst = instances[machine_id]
+    if inst["spec"].get("startup_timeout"):
+        return float(inst["spec"]["startup_timeout"])
+    ready_times = [
+        record["phases"]["ready"] for record in launch_history.get(machine_id, [])
+        if record.get("outcome") == "ready" and "ready" in record["phases"]
+    ][-10:]
+    if not ready_times:
+        return DEFAULT_STARTUP_TIMEOUT
+    return min(MAX_STARTUP_TIMEOUT, max(MIN_STARTUP_TIMEOUT, max(ready_times) * 2 + 30))
+
+def launch_phase(launch):
+    """进行中的启动最近完成的阶段"""
+    if launch is None or launch["outcome"] != "starting":
+        return None
+    done = [phase for phase in LAUNCH_PHASES if phase in launch["phases"]]
+    return done[-1] if done else None
+
+load_launch_history()
+
+@app.get("/launches/{machine_id}")
+async def get_launches(machine_id: str):
+    if machine_id not in instances:
+        return JSONResponse({"status": "error", "message": f"未知实例 {machine_id}"}, status_code=404)
+    return {
+        "status": "success",
+        "phases": list(LAUNCH_PHASES),
+        "current": instances[machine_id].get("launch"),
+        "history": list(launch_history.get(machine_id, [])),
+        "startup_timeout": startup_timeout(machine_id),
+    }
+
+# ---------------- 健康探测 ----------------
+# 所有实例并发探测，用 ComfyUI 的 /system_stats 判断是否真正就绪（自定义节点加载完成后才会响应）。
+# 探测频率随状态自适应：启动中快速探测，运行中慢速探测，已停止的实例不探测。
+
+# 各状态下的探测间隔（秒）
+PROBE_INTERVALS = {"starting": 1.0, "running": 10.0}
+# 运行中探测失败后改用的快速间隔（秒）
+PROBE_RETRY_INTERVAL = 2.0
+# 单次探测超时（秒）
+PROBE_TIMEOUT = 3.0
+
+# 有实例进入启动状态时唤醒探测循环
+probe_wakeup = asyncio.Event()
+
+async def probe_upstream(url, launch=None):
+    """请求 /system_stats 判断 ComfyUI 是否就绪"""
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(2)
-        result = sock.connect_ex((host, port))
-        sock.close()
-        return result == 0
-    except:
+        response = await http_client.get(f"{url.rstrip('/')}/system_stats", timeout=PROBE_TIMEOUT)
+    except httpx.ConnectError:
         return False
+    except Exception:
+        # 连接已建立但没有及时响应，说明端口已经绑定
+        mark_phase(launch, "port_bound")
+        return False
+    mark_phase(launch, "port_bound")
+    try:
+        return response.status_code == 200 and "system" in response.json()
+    except ValueError:
+        return False
+
+async def probe_instance(machine_id):
+    """探测实例是否就绪"""
+    inst = instances[machine_id]
+    return await probe_upstream(inst["url"], inst.get("launch"))
+
+def schedule_probe(inst, ok):
+    """根据状态和探测结果安排下一次探测"""
+    interval = PROBE_INTERVALS.get(inst["status"])
+    if interval is None:
+        return
+    if inst["status"] == "running" and not ok:
+        interval = PROBE_RETRY_INTERVAL
+    inst["next_probe"] = time.monotonic() + interval
 
 async def check_instance_status():
-    """定期检查实例状态并广播更新"""
+    """按需并发探测实例状态并广播更新"""
     while True:
-        for machine_id, inst in instances.items():
+        now = time.monotonic()
+        due = [
+            machine_id for machine_id, inst in instances.items()
+            if inst["status"] in PROBE_INTERVALS and not inst.get("node") and inst.get("next_probe", 0) <= now
+        ]
+        results = await asyncio.gather(*(probe_instance(machine_id) for machine_id in due))
+
+        for machine_id, ok in zip(due, results):
+            inst = instances.get(machine_id)
+            if inst is None or inst["process"] is None:
+                # 探测期间实例被删除或停止，结果已经过时
+                continue
             old_status = inst["status"]
-            
-            # 如果实例正在启动或运行中，检查端口状态
-            if inst["status"] in ["starting", "running"]:
-                if is_port_open("localhost", inst["port"]):
-                    inst["status"] = "running"
-                elif inst["status"] == "starting" and time.time() - inst.get("start_time", 0) > 30:
-                    # 如果启动超过30秒但端口仍未开放，标记为启动失败
-                    inst["status"] = "stopped"
-            
-            # 如果状态发生变化，广播给所有客户端
+            inst["last_probe"] = time.time()
+            inst["probe_failures"] = 0 if ok else inst.get("probe_failures", 0) + 1
+
+            if ok:
+                inst["status"] = "running"
+                if mark_phase(inst.get("launch"), "ready"):
+                    finish_launch(machine_id, inst["launch"], "ready")
+                    watchdog.monitor(machine_id, inst["process"])
+                    if drained_jobs:
+                        # 排空时没有实例可接收的任务，在有实例就绪后重新提交
+                        spawn_task(resubmit_drained())
+            elif inst["status"] == "starting" and time.time() - inst.get("start_time", 0) > startup_timeout(machine_id):
+                # 超过启动超时仍未就绪，标记为启动失败；不论看门狗是否开启都先结束进程树，
+                # 避免卡住的进程继续占着显卡和端口。先解除关联，监督者不把这次退出当成崩溃
+                process = inst["process"]
+                inst["process"] = None
+                get_log_buffer(machine_id).append("controller", "===== 启动超时，结束进程树 =====")
+                await kill_process_tree(process)
+                inst["status"] = "stopped"
+                save_process_state()
+                finish_launch(machine_id, inst.get("launch"), "timeout")
+                watchdog.trigger(machine_id, "启动超时")
+
+            schedule_probe(inst, ok)
+
+            # 状态或启动阶段变化时广播给所有客户端
+            await publish_state(machine_id)
             if old_status != inst["status"]:
-                await manager.broadcast({
-                    "type": "status_update",
-                    "machine": machine_id,
-                    "status": inst["status"]
-                })
                 inst["last_broadcast_status"] = inst["status"]
-        
-        await asyncio.sleep(2)  # 每2秒检查一次
 
-def monitor_instance(machine_id):
-    """监控实例进程状态"""
-    inst = instances[machine_id]
-    while True:
-        if inst["process"] is None:
-            inst["status"] = "stopped"
-            break
-            
-        # 检查进程是否还在运行
-        if inst["process"].poll() is not None:
-            inst["status"] = "stopped"
-            inst["process"] = None
-            break
-            
-        time.sleep(2)
+        # 看门狗检查运行中的实例是否卡死
+        reasons = await asyncio.gather(*(watchdog.inspect(machine_id) for machine_id in due))
+        for machine_id, reason in zip(due, reasons):
+            if reason:
+                watchdog.trigger(machine_id, reason)
+
+        # 睡到下一次有探测到期，或者被新启动的实例唤醒；没有需要探测的实例时一直等待
+        pending = [inst["next_probe"] for inst in instances.values()
+                   if inst["status"] in PROBE_INTERVALS and not inst.get("node") and "next_probe" in inst]
+        timeout = max(0.0, min(pending) - time.monotonic()) if pending else None
+        probe_wakeup.clear()
+        try:
+            await asyncio.wait_for(probe_wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+# ---------------- 实例日志 ----------------
+# 子进程的 stdout/stderr 写入运行目录下的文件（见进程监督），控制器跟随读取，写入每个实例固定大小的环形缓冲区。
+# 不用管道：控制器退出或重启时子进程的输出不会断，重启后的控制器从文件末尾接着读。
+# tqdm 用 \r 刷新的进度行原地覆盖，刷屏时内存也不会增长。配置了 "log_dir" 时另外写入按大小滚动的日志文件。
+
+# 每个实例在内存中保留的行数
+LOG_BUFFER_LINES = 2000
+# 单行最大长度，超过的部分截断成新行
+LOG_MAX_LINE_LENGTH = 4096
+# 每次从输出文件读取的字节数
+LOG_READ_CHUNK = 65536
+# 输出文件没有新内容时的轮询间隔（秒）
+LOG_POLL_INTERVAL = 0.1
+# 接管已在运行的进程时，从输出文件末尾回读的字节数
+LOG_ADOPT_TAIL_BYTES = 256 * 1024
+# 输出文件中已经读完的内容超过该大小时清空文件，子进程以追加方式写入，之后从头继续写
+LOG_TRUNCATE_BYTES = 4 * 1024 * 1024
+# 每个日志订阅者最多积压的行数，超过后丢弃并告知丢弃数量
+LOG_SUBSCRIBER_QUEUE = 1000
+# 进度行推送给订阅者的最小间隔（秒）
+LOG_PROGRESS_INTERVAL = 0.2
+# 滚动日志文件的大小和个数
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+LINE_BREAK = re.compile(r"\r\n|\n|\r")
+
+class LogSubscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=LOG_SUBSCRIBER_QUEUE)
+        self.dropped = 0
+
+class LogBuffer:
+    def __init__(self, machine_id):
+        self.machine_id = machine_id
+        self.lines = deque(maxlen=LOG_BUFFER_LINES)
+        self.seq = 0
+        # (boot, stream) -> 未换行的内容 / 增量解码器；热备重启时新旧进程同时输出，互不拼接
+        self.partial = {}
+        self.decoders = {}
+        self.subscribers = set()
+        self.spill = None
+        self.last_progress_push = 0
+
+    def open_spill(self, log_dir):
+        """打开滚动日志文件"""
+        if self.spill is not None or not log_dir:
+            return
+        os.makedirs(log_dir, exist_ok=True)
+        self.spill = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, f"{self.machine_id}.log"),
+            maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8",
+        )
+        self.spill.setFormatter(logging.Formatter("%(message)s"))
+
+    def close_spill(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+    def feed(self, stream, data, boot=None):
+        """写入从输出文件读到的原始字节"""
+        key = (boot, stream)
+        decoder = self.decoders.get(key)
+        if decoder is None:
+            decoder = self.decoders[key] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        text = self.partial.get(key, "") + decoder.decode(data)
+        # 结尾的 \r 可能是 \r\n 的前半截，留到下次再处理
+        hold_cr = text.endswith("\r")
+        if hold_cr:
+            text = text[:-1]
+        pos = 0
+        for match in LINE_BREAK.finditer(text):
+            self.append(stream, text[pos:match.start()], progress=match.group() == "\r")
+            pos = match.end()
+        rest = text[pos:]
+        while len(rest) > LOG_MAX_LINE_LENGTH:
+            self.append(stream, rest[:LOG_MAX_LINE_LENGTH])
+            rest = rest[LOG_MAX_LINE_LENGTH:]
+        self.partial[key] = rest + ("\r" if hold_cr else "")
+
+    def flush(self, boot=None):
+        """进程退出后把它未换行的内容写出"""
+        for key in [key for key in self.partial if key[0] == boot]:
+            rest = self.partial.pop(key)
+            if rest.strip("\r"):
+                self.append(key[1], rest.strip("\r"))
+        for key in [key for key in self.decoders if key[0] == boot]:
+            del self.decoders[key]
+
+    def append(self, stream, text, progress=False):
+        """追加一行；进度行会被同一输出流的下一行覆盖"""
+        if progress and not text.strip():
+            return
+        replace = bool(self.lines) and self.lines[-1]["progress"] and self.lines[-1]["stream"] == stream
+        if replace:
+            self.lines.pop()
+        self.seq += 1
+        line = {"seq": self.seq, "stream": stream, "text": text, "progress": progress, "replace": replace}
+        self.lines.append(line)
+        if self.spill is not None and not progress:
+            self.spill.emit(logging.makeLogRecord({"msg": f"[{stream}] {text}"}))
+        # 覆盖型的进度刷新限速推送，订阅者只需要看到最新进度
+        if progress and replace:
+            now = time.monotonic()
+            if now - self.last_progress_push < LOG_PROGRESS_INTERVAL:
+                return
+            self.last_progress_push = now
+        for subscriber in self.subscribers:
+            try:
+                subscriber.queue.put_nowait(line)
+            except asyncio.QueueFull:
+                subscriber.dropped += 1
+
+    def tail(self, count):
+        """最近的 count 行；缓冲区里的行已经是覆盖后的结果，去掉 replace 标记"""
+        count = max(0, min(count, len(self.lines)))
+        return [{**line, "replace": False} for line in list(self.lines)[len(self.lines) - count:]]
+
+    def subscribe(self):
+        subscriber = LogSubscriber()
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+# machine_id -> LogBuffer
+log_buffers = {}
+
+def get_log_buffer(machine_id):
+    buffer = log_buffers.get(machine_id)
+    if buffer is None:
+        buffer = log_buffers[machine_id] = LogBuffer(machine_id)
+    return buffer
+
+async def pump_output(machine_id, stream, path, process, launch=None, adopt=False):
+    """跟随子进程的输出文件，进程退出并读完后结束"""
+    buffer = get_log_buffer(machine_id)
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return
+    with f:
+        if adopt:
+            # 接管的进程只回读最后一段，丢掉不完整的第一行
+            size = os.fstat(f.fileno()).st_size
+            if size > LOG_ADOPT_TAIL_BYTES:
+                f.seek(size - LOG_ADOPT_TAIL_BYTES)
+                f.readline()
+        while True:
+            # 先看进程是否已退出再读：退出前写入的内容一定能读到
+            exited = process.returncode is not None
+            data = f.read(LOG_READ_CHUNK)
+            if not data:
+                if exited:
+                    break
+                if f.tell() >= LOG_TRUNCATE_BYTES:
+                    truncate_consumed(path, f)
+                await asyncio.sleep(LOG_POLL_INTERVAL)
+                continue
+            if mark_phase(launch, "first_output"):
+                await publish_state(machine_id)
+            touch_activity(machine_id)
+            buffer.feed(stream, data, launch["boot"] if launch else None)
+
+def truncate_consumed(path, f):
+    """输出文件已全部读完时清空它，长时间运行的实例（tqdm 进度刷屏）不会占满磁盘"""
+    try:
+        with open(path, "r+b") as w:
+            # 读完之后又有新内容就等下一次；检查和清空之间恰好写入的内容会丢失，窗口只有一次系统调用
+            if os.fstat(w.fileno()).st_size != f.tell():
+                return
+            w.truncate(0)
+    except OSError:
+        return
+    f.seek(0)
+
+def attach_output(machine_id, process, launch, adopt=False):
+    """为新进程开始采集输出"""
+    buffer = get_log_buffer(machine_id)
+    buffer.open_spill(config.get("log_dir"))
+    if adopt:
+        buffer.append("controller", f"===== {machine_id} 接管运行中的进程 (pid {process.pid}) =====")
+    else:
+        buffer.append("controller", f"===== {machine_id} 启动 (pid {process.pid}) =====")
+    stdout_path, stderr_path = output_paths(machine_id, launch["boot"])
+    return [
+        spawn_task(pump_output(machine_id, "stdout", stdout_path, process, launch, adopt)),
+        spawn_task(pump_output(machine_id, "stderr", stderr_path, process, launch, adopt)),
+    ]
+
+# ---------------- 进程监督 ----------------
+# 所有子进程由同一个监督者管理：进程退出由事件循环通知（Windows 上是 Proactor 的句柄等待，
+# Linux 上是 pidfd），崩溃后立即更新状态并广播，线程数不随实例数和重启次数增长。
+# 子进程放在独立的会话（Windows 上是独立的进程组且不挂控制台）中，输出写文件，控制器退出不会带走它们。
+# 运行中进程的 pid、创建时间和端口记录在运行目录的 processes.json 中，控制器重启或升级后
+# 用 psutil 核对仍然存活的进程并重新接管监督、日志和资源监控，不需要重新冷启动。
+
+# 运行目录：实例输出文件和进程记录
+RUN_DIR = STATE_DIR
+PROCESS_STATE_PATH = os.path.join(RUN_DIR, "processes.json")
+# 接管的进程不是本进程的子进程，只能轮询是否退出（秒）
+ADOPT_POLL_INTERVAL = 1.0
+
+if os.name == "nt":
+    DETACH_OPTIONS = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.DETACHED_PROCESS}
+else:
+    DETACH_OPTIONS = {"start_new_session": True}
+
+def open_output(path):
+    """以追加方式打开子进程的输出文件，子进程的每次写入都落在文件末尾，文件被清空后从头继续写"""
+    if os.name != "nt":
+        return open(path, "ab")
+    # Windows 的 "ab" 只在 C 运行库里模拟追加，子进程继承的句柄仍按自己的位置写，
+    # 清空文件后会在原位置留下一段空字节；只申请 FILE_APPEND_DATA 权限时由系统保证写到末尾
+    import _winapi
+    import msvcrt
+    FILE_APPEND_DATA, SYNCHRONIZE, OPEN_ALWAYS = 0x0004, 0x00100000, 4
+    # FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE：控制器要能同时读取和清空
+    handle = _winapi.CreateFile(path, FILE_APPEND_DATA | SYNCHRONIZE, 0x7, 0, OPEN_ALWAYS, 0x80, 0)
+    return open(msvcrt.open_osfhandle(handle, os.O_APPEND), "ab")
 
-def run_instance(machine_id):
+def output_paths(machine_id, boot_id):
+    """实例某次启动的 stdout、stderr 文件，热备时新旧进程各写各的"""
+    return tuple(os.path.join(RUN_DIR, f"{machine_id}-{boot_id}.{stream}.log") for stream in ("stdout", "stderr"))
+
+class AdoptedProcess:
+    """控制器重启后接管的实例进程，接口与 asyncio 的 Process 一致"""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.pid = proc.pid
+        # 不是本进程的子进程，拿不到真实的退出码，退出后记为 -1
+        self.returncode = None
+
+    async def wait(self):
+        while self.returncode is None:
+            try:
+                alive = self.proc.is_running() and self.proc.status() != psutil.STATUS_ZOMBIE
+            except psutil.NoSuchProcess:
+                alive = False
+            if not alive:
+                self.returncode = -1
+                break
+            await asyncio.sleep(ADOPT_POLL_INTERVAL)
+        return self.returncode
+
+    def terminate(self):
+        try:
+            self.proc.terminate()
+        except psutil.NoSuchProcess:
+            pass
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+class ProcessSupervisor:
+    def __init__(self):
+        self.watchers = {}
+
+    def watch(self, machine_id, process, launch, adopt=False):
+        """登记一个实例进程，同时开始采集它的输出"""
+        pumps = attach_output(machine_id, process, launch, adopt)
+        self.watchers[machine_id] = spawn_task(self._wait_exit(machine_id, process, launch, pumps))
+
+    async def _wait_exit(self, machine_id, process, launch, pumps):
+        returncode = await process.wait()
+        # 把输出文件里剩余的内容读完，之后文件就没用了
+        await asyncio.gather(*pumps, return_exceptions=True)
+        for path in output_paths(machine_id, launch["boot"]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        buffer = get_log_buffer(machine_id)
+        buffer.flush(launch["boot"])
+        buffer.append("controller", f"===== {machine_id} 已退出 (code {returncode}) =====")
+        inst = instances.get(machine_id)
+        # 已被停止或替换的进程由对应的操作自己处理状态
+        if inst is None or inst["process"] is not process:
+            return
+        inst["process"] = None
+        inst["status"] = "stopped"
+        inst["exit_code"] = returncode
+        save_process_state()
+        # 还没就绪就退出，记为启动失败
+        finish_launch(machine_id, inst.get("launch"), "exited")
+        await publish_state(machine_id)
+        if inst.get("desired") == "running":
+            watchdog.trigger(machine_id, f"进程意外退出 (code {returncode})")
+
+supervisor = ProcessSupervisor()
+
+def process_identity(process):
+    """进程号和创建时间，进程已退出时返回 None"""
+    if process is None or process.returncode is not None:
+        return None
+    try:
+        return {"pid": process.pid, "create_time": psutil.Process(process.pid).create_time()}
+    except psutil.NoSuchProcess:
+        return None
+
+def save_process_state():
+    """记录运行中的实例进程、热备重启后排空中的旧进程和空闲停止的实例，控制器重启后据此接管"""
+    state = {}
+    for machine_id, inst in instances.items():
+        if inst.get("node"):
+            continue
+        record = {}
+        identity = process_identity(inst["process"])
+        if identity is not None:
+            launch = inst.get("launch") or {}
+            record = dict(
+                identity,
+                port=inst["port"],
+                name=inst["name"],
+                gpu=inst["gpu"],
+                boot=inst.get("boot_id"),
+                started_at=launch.get("started_at", inst.get("start_time")),
+                desired=inst.get("desired"),
+            )
+        elif inst.get("desired") == "idle":
+            # 没有进程，只记下空闲停止，重启后收到请求仍会唤醒
+            record = {"desired": "idle"}
+        draining = []
+        for drain in inst.get("draining", []):
+            identity = process_identity(drain["process"])
+            if identity is not None:
+                draining.append(dict(identity, url=drain["url"], boot=drain["boot"], deadline=drain["deadline"]))
+        if draining:
+            record["draining"] = draining
+        if record:
+            state[machine_id] = record
+    tmp_path = PROCESS_STATE_PATH + ".tmp"
+    try:
+        os.makedirs(RUN_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, PROCESS_STATE_PATH)
+    except OSError:
+        pass
+
+def load_process_state():
+    try:
+        with open(PROCESS_STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def find_launch(machine_id, boot_id):
+    """按 boot 找到启动记录，接管后继续记录 first_prompt"""
+    for record in reversed(launch_history.get(machine_id, [])):
+        if record.get("boot") == boot_id:
+            return record
+    return None
+
+def find_process(record):
+    """按记录的 pid 和创建时间找回进程，已退出或 pid 被别的进程复用时返回 None"""
+    try:
+        proc = psutil.Process(record["pid"])
+        if abs(proc.create_time() - record["create_time"]) > 0.01:
+            return None
+    except (psutil.NoSuchProcess, KeyError, TypeError):
+        return None
+    return AdoptedProcess(proc)
+
+async def adopt_processes():
+    """控制器启动时接管上次留下的、仍在运行的实例进程"""
+    adopted = set()
+    for machine_id, record in load_process_state().items():
+        inst = instances.get(machine_id)
+        if inst is None or inst["process"] is not None:
+            continue
+        # 热备重启后还在排空的旧进程：继续采集输出，按原来的截止时间接着排空
+        for drain_record in record.get("draining", []):
+            process = find_process(drain_record)
+            if process is None:
+                continue
+            drain = {"process": process, "url": drain_record["url"], "boot": drain_record["boot"],
+                     "deadline": drain_record["deadline"]}
+            inst.setdefault("draining", []).append(drain)
+            launch = find_launch(machine_id, drain["boot"]) or begin_launch(drain["boot"])
+            supervisor.watch(machine_id, process, launch, adopt=True)
+            adopted.add(output_paths(machine_id, drain["boot"])[0])
+            spawn_task(drain_process(machine_id, drain))
+        if "pid" not in record:
+            if record.get("desired") == "idle":
+                inst["desired"] = "idle"
+                await publish_state(machine_id)
+            continue
+        # pid 可能已被别的进程复用，创建时间必须一致
+        process = find_process(record)
+        if process is None:
+            continue
+        launch = find_launch(machine_id, record["boot"])
+        if launch is None:
+            # 上次还没启动完成：接着计时
+            launch = dict(begin_launch(record["boot"]), started_at=record.get("started_at") or time.time())
+        ready = launch["outcome"] == "ready"
+        inst.update(
+            process=process, port=record["port"], url=f"http://{upstream_host()}:{record['port']}",
+            name=record.get("name", inst["name"]), gpu=record.get("gpu", inst["gpu"]),
+            status="running" if ready else "starting", desired=record.get("desired") or "running",
+            boot_id=record["boot"], launch=launch, start_time=launch["started_at"],
+            last_activity=time.monotonic(), last_used=time.monotonic(), next_probe=0,
+        )
+        supervisor.watch(machine_id, process, launch, adopt=True)
+        if ready:
+            watchdog.monitor(machine_id, process)
+        adopted.add(output_paths(machine_id, record["boot"])[0])
+        await publish_state(machine_id)
+    # 没有被接管的进程留下的输出文件
+    for path in glob.glob(os.path.join(RUN_DIR, "*.stdout.log")):
+        if path not in adopted:
+            for stale in (path, path[:-len(".stdout.log")] + ".stderr.log"):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+    save_process_state()
+    probe_wakeup.set()
+
+def install_child_watcher():
+    """Python 3.12 之前的 Linux 默认每个子进程一个等待线程，有 pidfd 时换成事件通知"""
+    if sys.platform.startswith("linux") and sys.version_info < (3, 12) and hasattr(os, "pidfd_open"):
+        try:
+            watcher = asyncio.PidfdChildWatcher()
+            watcher.attach_loop(asyncio.get_running_loop())
+            asyncio.set_child_watcher(watcher)
+        except Exception:
+            pass
+
+def build_command(inst, port=None):
+    """生成实例的启动命令"""
+    return [
+        config["python"], "-s", config["main"],
+        *config["args"],
+        "--listen", config["listen"],
+        "--cuda-device", str(inst["gpu"]),
+        "--port", str(port or inst["port"]),
+        *inst["spec"]["extra_args"],
+    ]
+
+def build_env(inst):
+    """生成实例进程的环境变量"""
+    env = dict(os.environ)
+    # 输出写入文件时保持实时刷新，并避免 Windows 控制台编码导致打印中文报错
+    env.setdefault("PYTHONUNBUFFERED", "1")
+    env.setdefault("PYTHONIOENCODING", "utf-8")
+    env.update(inst["spec"]["env"])
+    return env
+
+async def spawn_process(inst, boot_id, port=None):
+    """创建实例进程，输出写入运行目录，放在独立会话中；模型文件同时在后台预热"""
+    # 展开通配符要遍历目录，放到线程里做，不耽误进程启动，也不阻塞事件循环
+    spawn_task(prewarm_instance(prewarm_sources(inst)))
+    os.makedirs(RUN_DIR, exist_ok=True)
+    stdout_path, stderr_path = output_paths(inst["spec"]["id"], boot_id)
+    # 子进程继承文件句柄后，这里的句柄可以立即关闭
+    with open_output(stdout_path) as stdout, open_output(stderr_path) as stderr:
+        return await asyncio.create_subprocess_exec(
+            *build_command(inst, port), env=build_env(inst),
+            stdin=asyncio.subprocess.DEVNULL, stdout=stdout, stderr=stderr, **DETACH_OPTIONS,
+        )
+
+async def terminate_process_tree(process, timeout=10):
+    """先正常终止进程树，超时后强制结束"""
+    children = psutil.Process(process.pid).children(recursive=True)
+    for child in children:
+        try:
+            child.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    process.terminate()
+    
+    # 主进程的退出由事件循环通知；孙进程不是我们的子进程，在线程池中等待
+    try:
+        await asyncio.wait_for(process.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+    gone, alive = await asyncio.to_thread(psutil.wait_procs, children, timeout=5)
+    for child in alive:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+async def run_instance(machine_id):
     """启动实例"""
     inst = instances[machine_id]
     if inst["status"] == "running" or inst["status"] == "starting":
         return {"status": "error", "message": f"{machine_id} 已经在运行或启动中"}
+    if process_alive(inst):
+        return {"status": "error", "message": f"{machine_id} 上一个进程仍在运行，请先停止"}
     
     try:
-        PYTHON_EXE = r".\python_embeded\python.exe"
-        COMFYUI_MAIN = r".\ComfyUI\main.py"
-        CMD = [
-            PYTHON_EXE, "-s", COMFYUI_MAIN,
-            "--windows-standalone-build",
-            "--listen", "localhost",
-            "--multi-user",
-            "--cuda-device", str(inst["gpu"]),
-            "--port", str(inst["port"]),
-            "--disable-auto-launch",
-            "--disable-xformers"
-        ]
-        
-        inst["process"] = subprocess.Popen(CMD)
+        # 使用最新的实例定义
+        apply_spec(inst)
+        boot_id = uuid.uuid4().hex[:8]
+        launch = inst["launch"] = begin_launch(boot_id)
+        inst["process"] = await spawn_process(inst, boot_id)
+        mark_phase(launch, "spawn")
+        inst["desired"] = "running"
+        inst["last_activity"] = inst["last_used"] = time.monotonic()
         inst["status"] = "starting"
-        inst["start_time"] = time.time()
+        inst["boot_id"] = boot_id
+        inst["start_time"] = launch["started_at"]
+        inst["next_probe"] = time.monotonic() + PROBE_INTERVALS["starting"]
+        probe_wakeup.set()
         
-        # 启动监控线程
-        threading.Thread(target=monitor_instance, args=(machine_id,), daemon=True).start()
+        # 交给监督者等待进程退出
+        supervisor.watch(machine_id, inst["process"], launch)
+        save_process_state()
         
         return {"status": "success", "message": f"{machine_id} 启动中..."}
     except Exception as e:
         inst["status"] = "error"
+        finish_launch(machine_id, inst.get("launch"), "failed")
         return {"status": "error", "message": f"{machine_id} 启动失败: {str(e)}"}
 
-def stop_instance(machine_id):
+async def stop_instance(machine_id):
     """停止实例"""
     inst = instances[machine_id]
-    if inst["process"] is None or inst["status"] == "stopped":
+    inst["desired"] = "stopped"
+    if inst["process"] is None:
         return {"status": "error", "message": f"{machine_id} 未在运行"}
     
+    process = inst["process"]
     try:
         # 终止进程及其所有子进程
-        parent = psutil.Process(inst["process"].pid)
-        for child in parent.children(recursive=True):
-            child.terminate()
-        parent.terminate()
-        
-        # 等待进程结束
-        parent.wait(timeout=10)
+        await terminate_process_tree(process)
         
         inst["process"] = None
         inst["status"] = "stopped"
+        save_process_state()
         
+        return {"status": "success", "message": f"{machine_id} 已停止"}
+    except (psutil.NoSuchProcess, ProcessLookupError):
+        inst["process"] = None
+        inst["status"] = "stopped"
+        save_process_state()
         return {"status": "success", "message": f"{machine_id} 已停止"}
     except Exception as e:
         return {"status": "error", "message": f"{machine_id} 停止失败: {str(e)}"}
 
-def restart_instance(machine_id):
+async def restart_instance(machine_id):
     """重启实例"""
-    stop_result = stop_instance(machine_id)
-    if stop_result["status"] == "error":
-        return stop_result
-    
-    time.sleep(2)  # 等待一段时间再启动
-    return run_instance(machine_id)
+    inst = instances[machine_id]
+    if inst["status"] == "running" and standby_enabled(inst):
+        return await standby_restart(machine_id)
+    if inst["process"] is not None:
+        stop_result = await stop_instance(machine_id)
+        if stop_result["status"] == "error":
+            return stop_result
+        await publish_state(machine_id)
+        await asyncio.sleep(2)  # 等待一段时间再启动
+    return await run_instance(machine_id)
 
-@app.on_event("startup")
-async def startup_event():
-    """启动时创建状态检查任务"""
-    asyncio.create_task(check_instance_status())
+# ---------------- 热备重启 ----------------
+# 冷启动要花几十秒导入依赖和加载自定义节点，这段时间实例不可用。
+# 开启 standby 后，重启会在备用端口先启动新进程，旧进程继续服务；新进程就绪后一次性切换
+# 实例的端口和地址，代理随即指向新进程，旧进程排空队列后退出。感知到的停机只有切换那一刻。
+# 新进程启动时还没有加载模型，和旧进程同时占用显卡的只有 CUDA 上下文。
 
-@app.websocket("/ws/status")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+# 旧进程排空队列的最长等待时间（秒）
+STANDBY_DRAIN_TIMEOUT = 600
+# 排空期间检查旧进程队列的间隔（秒）
+STANDBY_DRAIN_POLL = 2.0
+
+def standby_enabled(inst):
+    return bool(inst["spec"].get("standby", config.get("standby", False)))
+
+def pick_standby_port(inst):
+    """热备进程使用的端口：优先回到实例定义的端口，被占用时由系统分配空闲端口"""
+    candidates = [inst["spec"]["port"]] if inst["port"] != inst["spec"]["port"] else []
+    for port in candidates + [0]:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            if os.name != "nt":
+                # 和 uvicorn 一致，刚释放处于 TIME_WAIT 的端口也可以使用（Windows 上该选项含义不同）
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((config["listen"], port))
+            except OSError:
+                continue
+            return sock.getsockname()[1]
+    raise OSError("没有可用的备用端口")
+
+async def standby_restart(machine_id):
+    """热备重启：新进程就绪后切换，旧进程排空后退出"""
+    inst = instances[machine_id]
+    buffer = get_log_buffer(machine_id)
+    # 热备进程使用最新的实例定义，端口单独分配
+    standby = dict(inst, name=inst["spec"]["name"], gpu=inst["spec"]["gpu"])
     try:
-        # 发送当前所有状态给新连接的客户端
-        for machine_id, inst in instances.items():
-            await websocket.send_json({
-                "type": "status_update",
-                "machine": machine_id,
-                "status": inst["status"]
-            })
-        
-        # 保持连接开放
+        port = pick_standby_port(inst)
+        boot_id = uuid.uuid4().hex[:8]
+        launch = begin_launch(boot_id)
+        process = await spawn_process(standby, boot_id, port)
+    except Exception as e:
+        return {"status": "error", "message": f"{machine_id} 热备进程启动失败: {str(e)}"}
+    mark_phase(launch, "spawn")
+    buffer.append("controller", f"===== 热备进程启动于端口 {port} =====")
+    supervisor.watch(machine_id, process, launch)
+
+    url = f"http://{upstream_host()}:{port}"
+    deadline = time.time() + startup_timeout(machine_id)
+    error = None
+    while True:
+        inst["standby"] = {"port": port, "phase": launch_phase(launch)}
+        await publish_state(machine_id)
+        if await probe_upstream(url, launch):
+            break
+        if process.returncode is not None:
+            error = f"热备进程已退出 (code {process.returncode})"
+        elif time.time() > deadline:
+            error = "热备进程启动超时"
+        elif inst.get("desired") != "running":
+            error = "实例已被停止，取消热备重启"
+        if error:
+            break
+        await asyncio.sleep(PROBE_INTERVALS["starting"])
+
+    inst["standby"] = None
+    if error is None and inst.get("desired") != "running":
+        error = "实例已被停止，取消热备重启"
+    if error:
+        finish_launch(machine_id, launch, "failed")
+        if process.returncode is None:
+            await kill_process_tree(process)
+        await publish_state(machine_id)
+        buffer.append("controller", f"===== {error}，保留原进程 =====")
+        return {"status": "error", "message": f"{machine_id} {error}"}
+
+    mark_phase(launch, "ready")
+    finish_launch(machine_id, launch, "ready")
+    # 一次性切换，之后的代理请求都发往新进程
+    old_process, old_url, old_boot = inst["process"], inst["url"], inst.get("boot_id")
+    watchdog.cancel(machine_id)
+    inst.update(
+        process=process, port=port, url=url, name=standby["name"], gpu=standby["gpu"],
+        status="running", boot_id=boot_id, launch=launch, start_time=launch["started_at"],
+        last_activity=time.monotonic(), probe_failures=0,
+        next_probe=time.monotonic() + PROBE_INTERVALS["running"],
+    )
+    drain = None
+    if old_process is not None:
+        # 排空中的旧进程也写进进程记录，控制器这期间重启后接着排空，不会丢下不管
+        drain = {"process": old_process, "url": old_url, "boot": old_boot,
+                 "deadline": time.time() + STANDBY_DRAIN_TIMEOUT}
+        inst.setdefault("draining", []).append(drain)
+    save_process_state()
+    await publish_state(machine_id)
+    watchdog.monitor(machine_id, process)
+    buffer.append("controller", f"===== 已切换到端口 {port}，旧进程排空后退出 =====")
+    if drain is not None:
+        spawn_task(drain_process(machine_id, drain))
+    return {"status": "success", "message": f"{machine_id} 已切换到新进程"}
+
+async def drain_process(machine_id, drain):
+    """等旧进程执行完队列中的任务后结束它"""
+    process = drain["process"]
+    while process.returncode is None and time.time() < drain["deadline"]:
+        try:
+            response = await http_client.get(f"{drain['url']}/queue", timeout=PROBE_TIMEOUT)
+            queue = response.json()
+        except Exception:
+            break
+        if not queue.get("queue_running") and not queue.get("queue_pending"):
+            break
+        await asyncio.sleep(STANDBY_DRAIN_POLL)
+    if process.returncode is None:
+        try:
+            await terminate_process_tree(process)
+        except (psutil.NoSuchProcess, ProcessLookupError):
+            pass
+    inst = instances.get(machine_id)
+    if inst is not None and drain in inst.get("draining", []):
+        inst["draining"].remove(drain)
+        save_process_state()
+
+# ---------------- 排空停止 ----------------
+# 直接停止会立即结束整个进程树：执行到一半的任务白跑，排队中的任务悄悄丢失。
+# 带 drain 停止或重启时先排空：实例不再接收新任务（分发绕开它；代理过来的 /prompt 在重启时
+# 暂存到新进程就绪再转发，停止时直接拒绝），排队中的任务迁移到负载最低的其他实例，
+# 没有可用实例时写入状态目录的 drained.json，等有实例就绪后重新提交；
+# 正在执行的任务完成后才结束进程，超过截止时间仍未完成则强制结束。进度通过 /ws/status 的 drain 字段推送。
+
+# 排空的默认截止时间（秒），实例可用 "drain_timeout" 覆盖
+DRAIN_TIMEOUT = 600
+# 排空期间检查队列的间隔（秒）
+DRAIN_POLL = 2.0
+# 没有实例可以接收时，排空的任务保存在这里
+DRAINED_JOBS_PATH = os.path.join(STATE_DIR, "drained.json")
+
+# [{"machine", "prompt_id", "prompt", "extra_data", "drained_at"}]
+drained_jobs = []
+# machine_id -> 排空结束时置位的事件，代理暂存的 /prompt 在上面等待
+drain_released = {}
+# 重新提交保存的任务时加锁，避免多个实例同时就绪时重复提交
+resubmit_lock = asyncio.Lock()
+
+def load_drained_jobs():
+    try:
+        with open(DRAINED_JOBS_PATH, "r", encoding="utf-8") as f:
+            drained_jobs.extend(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+def save_drained_jobs():
+    tmp_path = DRAINED_JOBS_PATH + ".tmp"
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(drained_jobs, f, ensure_ascii=False)
+        os.replace(tmp_path, DRAINED_JOBS_PATH)
+    except OSError:
+        pass
+
+load_drained_jobs()
+
+def drain_enabled(drain):
+    """请求没有指定时使用配置中的默认值"""
+    return bool(config.get("drain", False)) if drain is None else drain
+
+def drain_timeout(inst):
+    return float(inst["spec"].get("drain_timeout") or config.get("drain_timeout") or DRAIN_TIMEOUT)
+
+def resubmit_payload(item, prompt_id=None, front=False):
+    """用 /queue 中的一项构造重新提交的 /prompt 请求体，保留原 prompt_id 和 extra_data"""
+    extra = item[3] if isinstance(item[3], dict) else {}
+    payload = {"prompt": item[2], "prompt_id": prompt_id or item[1], "extra_data": extra}
+    if front:
+        payload["front"] = True
+    if extra.get("client_id"):
+        payload["client_id"] = extra["client_id"]
+    return payload
+
+async def submit_prompt(machine_id, payload):
+    """向实例提交 prompt，成功时返回实际的 prompt_id，失败时返回 None"""
+    try:
+        response = await http_client.post(upstream_url(instances[machine_id], "prompt", ""), json=payload, timeout=30)
+        result = response.json() if response.status_code == 200 else None
+    except (httpx.HTTPError, ValueError):
+        return None
+    if not result or not result.get("prompt_id"):
+        return None
+    remember_prompt_route(result["prompt_id"], machine_id)
+    invalidate_cache(machine_id)
+    mark_used(machine_id)
+    return result["prompt_id"]
+
+async def place_jobs(items):
+    """把任务提交到负载最低的可用实例，返回没能提交的任务"""
+    loads = await cluster_load()
+    failed = []
+    for item in items:
         while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
+            machine_id = pick_instance(loads)
+            if machine_id is None:
+                failed.append(item)
+                break
+            load = next(load for load in loads if load["machine"] == machine_id)
+            if await submit_prompt(machine_id, resubmit_payload(item)):
+                # 本地累加负载，一批任务按预计等待时间摊到各个实例
+                load["pending"] += 1
+                load["estimated_wait"] += load["avg_job_seconds"]
+                break
+            # 提交失败的实例本批不再使用
+            loads.remove(load)
+    return failed
 
-@app.get("/", response_class=HTMLResponse)
-def index(request: Request):
-    # 生成唯一的缓存破坏参数
-    cache_buster = str(uuid.uuid4())[:8]
-    
-    html_content = f"""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-<meta charset="UTF-8">
-<title>ComfyUI 多端口切换</title>
-<style>
-    html, body {{
+async def migrate_pending(machine_id):
+    """把实例排队中的任务迁到其他实例，迁不走的保存到文件；返回 (迁移数, 保存数)"""
+    inst = instances[machine_id]
+    queue = await fetch_json(upstream_url(inst, "queue", ""))
+    pending = [item for item in (queue or {}).get("queue_pending", []) if len(item) > 3]
+    if not pending:
+        return 0, 0
+    pending.sort(key=lambda item: item[0])
+    try:
+        await http_client.post(upstream_url(inst, "queue", ""),
+                               json={"delete": [item[1] for item in pending]}, timeout=5)
+    except httpx.HTTPError:
+        return 0, 0
+    invalidate_cache(machine_id)
+    # 删除前一刻开始执行的、或者没删掉的任务留在原实例
+    queue = await fetch_json(upstream_url(inst, "queue", "")) or {}
+    remaining = {job[1] for state in ("queue_running", "queue_pending") for job in queue.get(state, []) if len(job) > 1}
+    pending = [item for item in pending if item[1] not in remaining]
+
+    failed = await place_jobs(pending)
+    for item in failed:
+        drained_jobs.append({
+            "machine": machine_id,
+            "prompt_id": item[1],
+            "prompt": item[2],
+            "extra_data": item[3] if isinstance(item[3], dict) else {},
+            "drained_at": time.time(),
+        })
+    if failed:
+        save_drained_jobs()
+    return len(pending) - len(failed), len(failed)
+
+async def resubmit_drained():
+    """把保存的任务提交到当前可用的实例"""
+    async with resubmit_lock:
+        if not drained_jobs:
+            return 0
+        jobs = list(drained_jobs)
+        items = [[0, job["prompt_id"], job["prompt"], job["extra_data"]] for job in jobs]
+        failed = {item[1] for item in await place_jobs(items)}
+        drained_jobs[:] = [job for job in jobs if job["prompt_id"] in failed]
+        save_drained_jobs()
+        return len(jobs) - len(failed)
+
+async def drain_instance(machine_id, mode):
+    """排空实例：停止接收新任务，迁走排队的任务，等待执行中的任务完成；超时返回 False"""
+    inst = instances[machine_id]
+    buffer = get_log_buffer(machine_id)
+    deadline = time.time() + drain_timeout(inst)
+    drain = inst["drain"] = {"mode": mode, "phase": "migrating", "migrated": 0, "persisted": 0,
+                             "running": 0, "deadline": deadline}
+    drain_released[machine_id] = asyncio.Event()
+    buffer.append("controller", f"===== 开始排空，截止时间 {round(deadline - time.time())} 秒 =====")
+    while inst["process"] is not None and inst["process"].returncode is None:
+        # 排空期间直连实例提交的任务同样迁走
+        migrated, persisted = await migrate_pending(machine_id)
+        drain["migrated"] += migrated
+        drain["persisted"] += persisted
+        queue = await fetch_json(upstream_url(inst, "queue", ""))
+        if queue is None:
+            # 实例已经不响应，没有可等的任务
+            break
+        drain["running"] = len(queue.get("queue_running", []))
+        drain["phase"] = "waiting"
+        await publish_state(machine_id)
+        if not queue.get("queue_running") and not queue.get("queue_pending"):
+            break
+        if time.time() >= drain["deadline"]:
+            buffer.append("controller", "===== 排空超时，强制结束 =====")
+            return False
+        await asyncio.sleep(DRAIN_POLL)
+    buffer.append("controller",
+                  f"===== 排空完成：迁移 {drain['migrated']} 个任务，保存 {drain['persisted']} 个待重新提交 =====")
+    return True
+
+def end_drain(machine_id):
+    """结束排空，放行暂存的请求"""
+    inst = instances.get(machine_id)
+    if inst is not None:
+        inst["drain"] = None
+    event = drain_released.pop(machine_id, None)
+    if event is not None:
+        event.set()
+
+async def drain_stop_instance(machine_id, mode="stop"):
+    """排空后停止实例"""
+    inst = instances[machine_id]
+    if mode == "stop":
+        inst["desired"] = "stopped"
+    if inst["status"] != "running":
+        return await stop_instance(machine_id)
+    if not await drain_instance(machine_id, mode):
+        inst["desired"] = "stopped"
+        process = inst["process"]
+        if process is not None and process.returncode is None:
+            await kill_process_tree(process)
+    inst["drain"]["phase"] = "stopping"
+    await publish_state(machine_id)
+    return await stop_instance(machine_id)
+
+async def drain_restart_instance(machine_id):
+    """排空后重启实例，新进程就绪后再放行暂存的请求"""
+    inst = instances[machine_id]
+    if inst.get("drain"):
+        return {"status": "error", "message": f"{machine_id} 正在排空"}
+    if inst["status"] != "running" or standby_enabled(inst):
+        # 热备重启本身会等旧进程执行完队列再退出
+        return await restart_instance(machine_id)
+    try:
+        result = await drain_stop_instance(machine_id, "restart")
+        if result["status"] == "error":
+            return result
+        inst["drain"]["phase"] = "restarting"
+        await publish_state(machine_id)
+        await asyncio.sleep(2)
+        result = await run_instance(machine_id)
+        # 等新进程就绪（或启动失败）后再结束排空，暂存的 /prompt 随后转发给新进程
+        while result["status"] == "success" and inst["status"] == "starting":
+            await asyncio.sleep(PROBE_INTERVALS["starting"])
+        return result
+    finally:
+        inst["drain"] = None
+        # 没有其他实例可接收而保存下来的任务先提交，排在暂存的新请求前面
+        if drained_jobs and inst["status"] == "running":
+            await resubmit_drained()
+        end_drain(machine_id)
+
+async def stop_with_drain(machine_id):
+    """排空停止的操作入口"""
+    if instances[machine_id].get("drain"):
+        return {"status": "error", "message": f"{machine_id} 正在排空"}
+    try:
+        return await drain_stop_instance(machine_id)
+    finally:
+        end_drain(machine_id)
+
+async def hold_for_drain(machine_id):
+    """代理过来的 /prompt 遇到排空中的实例：重启时等到新进程就绪，返回是否可以转发"""
+    inst = instances[machine_id]
+    drain = inst.get("drain")
+    if not drain:
+        return True
+    event = drain_released.get(machine_id)
+    if drain["mode"] != "restart" or event is None:
+        return False
+    try:
+        await asyncio.wait_for(event.wait(), timeout=max(1.0, drain["deadline"] - time.time()) + startup_timeout(machine_id))
+    except asyncio.TimeoutError:
+        return False
+    return inst["status"] == "running" and not inst.get("drain")
+
+# ---------------- 看门狗 ----------------
+# 端口还开着不代表实例还活着。看门狗在健康探测的基础上判断两类卡死：
+#   1. 运行中的实例连续多次探测无响应；
+#   2. /queue 显示有任务在执行，但长时间没有任何活动（日志输出、/ws 消息都算活动）。
+# 卡死、启动超时或意外退出时杀掉整个进程树，按指数退避重新启动；
+# 一段时间内重启次数过多则熔断，停止自动重启，等待人工处理。每一步都通过 /ws/status 推送。
+
+# 运行中连续探测失败多少次判定为无响应
+WATCHDOG_PROBE_FAILURES = 3
+# 有任务执行时多久没有活动判定为卡死（秒），实例可用 "stall_timeout" 覆盖
+WATCHDOG_STALL_TIMEOUT = 600
+# 重启退避的初始值和上限（秒）
+WATCHDOG_BACKOFF_BASE = 5
+WATCHDOG_BACKOFF_MAX = 300
+# 熔断：窗口期内（秒）最多自动重启的次数
+WATCHDOG_MAX_RESTARTS = 5
+WATCHDOG_WINDOW = 1800
+# 看门狗订阅 /ws 时使用的 clientId
+WATCHDOG_CLIENT_ID = "comfy-web-watchdog"
+
+def touch_activity(machine_id):
+    """记录实例的最近一次活动"""
+    inst = instances.get(machine_id)
+    if inst is not None:
+        inst["last_activity"] = time.monotonic()
+
+async def kill_process_tree(process):
+    """立即杀掉进程树，卡死的进程不会响应正常退出"""
+    try:
+        children = psutil.Process(process.pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        children = []
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+class Watchdog:
+    def __init__(self):
+        # machine_id -> deque[自动重启时间]
+        self.restarts = {}
+        # machine_id -> 正在进行的恢复任务
+        self.pending = {}
+        # machine_id -> /ws 订阅任务
+        self.monitors = {}
+
+    def enabled(self, inst):
+        return bool(config.get("watchdog", True)) and bool(inst["spec"].get("watchdog", True))
+
+    def report(self, machine_id, state, reason=None, retry_at=None):
+        """更新看门狗状态，随机器状态一起推送"""
+        instances[machine_id]["watchdog"] = {
+            "state": state,
+            "reason": reason,
+            "restarts": len(self.restarts.get(machine_id, ())),
+            "retry_at": retry_at,
+        }
+
+    def log(self, machine_id, message):
+        get_log_buffer(machine_id).append("controller", f"[看门狗] {message}")
+
+    def monitor(self, machine_id, process):
+        """实例就绪后开始订阅它的 /ws，旧进程的订阅会自行退出"""
+        entry = self.monitors.get(machine_id)
+        if entry is None or entry[0] is not process or entry[1].done():
+            self.monitors[machine_id] = (process, spawn_task(self._monitor(machine_id, process)))
+
+    async def _monitor(self, machine_id, process):
+        # 进度、执行状态、队列变化等任何消息都算活动；进程被替换后退出
+        while True:
+            inst = instances.get(machine_id)
+            if inst is None or inst["process"] is not process:
+                return
+            target = upstream_url(inst, "ws", f"clientId={WATCHDOG_CLIENT_ID}", scheme="ws")
+            try:
+                async with websockets.connect(target, max_size=None, open_timeout=PROBE_TIMEOUT) as ws:
+                    async for _ in ws:
+                        inst["last_activity"] = time.monotonic()
+            except Exception:
+                pass
+            await asyncio.sleep(PROBE_RETRY_INTERVAL)
+
+    async def inspect(self, machine_id):
+        """检查运行中的实例是否卡死，返回原因；正常时返回 None"""
+        inst = instances.get(machine_id)
+        if inst is None or inst["status"] != "running" or not self.enabled(inst) or machine_id in self.pending:
+            return None
+        if inst.get("probe_failures", 0) >= WATCHDOG_PROBE_FAILURES:
+            return f"连续 {inst['probe_failures']} 次探测无响应"
+
+        stall_timeout = float(inst["spec"].get("stall_timeout") or WATCHDOG_STALL_TIMEOUT)
+        now = time.monotonic()
+        if now - inst.get("last_activity", 0) < stall_timeout:
+            return None
+        # 长时间没有活动，只有确实有任务在执行才算卡死
+        try:
+            response = await http_client.get(upstream_url(inst, "queue", ""), timeout=PROBE_TIMEOUT)
+            running = response.json().get("queue_running", [])
+        except Exception:
+            # 无响应由探测失败计数处理
+            return None
+        if not running:
+            inst.pop("watch_job", None)
+            return None
+        # 从第一次看到这个任务开始计时，避免空闲很久后刚提交的任务被误判
+        prompt_id = running[0][1] if len(running[0]) > 1 else None
+        job = inst.get("watch_job")
+        if job is None or job[0] != prompt_id:
+            inst["watch_job"] = (prompt_id, now)
+            return None
+        if now - max(job[1], inst.get("last_activity", 0)) < stall_timeout:
+            return None
+        return f"任务 {prompt_id} 执行中但 {int(stall_timeout)} 秒没有任何进度"
+
+    def trigger(self, machine_id, reason):
+        """开始恢复实例（已在恢复中则忽略）"""
+        inst = instances.get(machine_id)
+        if inst is None or not self.enabled(inst) or machine_id in self.pending:
+            return
+        self.pending[machine_id] = spawn_task(self.recover(machine_id, reason))
+
+    async def recover(self, machine_id, reason):
+        """杀掉进程树，按退避时间重新启动"""
+        try:
+            inst = instances[machine_id]
+            process = inst["process"]
+            self.log(machine_id, f"{reason}，结束进程树" if process is not None else reason)
+            # 先解除关联，监督者不再把这次退出当成崩溃
+            inst["process"] = None
+            inst["status"] = "stopped"
+            self.report(machine_id, "killing", reason)
+            await publish_state(machine_id)
+            if process is not None:
+                await kill_process_tree(process)
+
+            history = self.restarts.setdefault(machine_id, deque())
+            now = time.time()
+            while history and now - history[0] > WATCHDOG_WINDOW:
+                history.popleft()
+            if len(history) >= WATCHDOG_MAX_RESTARTS:
+                self.log(machine_id, f"{WATCHDOG_WINDOW} 秒内已自动重启 {len(history)} 次，暂停自动重启")
+                self.report(machine_id, "tripped", reason)
+                await publish_state(machine_id)
+                return
+
+            delay = min(WATCHDOG_BACKOFF_MAX, WATCHDOG_BACKOFF_BASE * 2 ** len(history))
+            history.append(now)
+            self.log(machine_id, f"{delay} 秒后第 {len(history)} 次自动重启")
+            self.report(machine_id, "backoff", reason, retry_at=now + delay)
+            await publish_state(machine_id)
+            await asyncio.sleep(delay)
+
+            # 等待期间被删除、手动停止或手动启动则放弃；与手动操作共用实例锁
+            async with lifecycle_lock(machine_id):
+                inst = instances.get(machine_id)
+                if inst is None or inst.get("desired") != "running" or inst["status"] != "stopped":
+                    return
+                result = await run_instance(machine_id)
+            self.log(machine_id, result["message"])
+            self.report(machine_id, "restarted" if result["status"] == "success" else "failed", reason)
+            await publish_state(machine_id)
+        finally:
+            self.pending.pop(machine_id, None)
+
+    def cancel(self, machine_id):
+        """取消等待中的自动重启"""
+        task = self.pending.pop(machine_id, None)
+        if task is not None:
+            task.cancel()
+
+    def reset(self, machine_id):
+        """手动启动或重启时清空熔断计数"""
+        self.cancel(machine_id)
+        self.restarts.pop(machine_id, None)
+        if machine_id in instances:
+            instances[machine_id]["watchdog"] = None
+
+watchdog = Watchdog()
+
+# ---------------- 生命周期操作 ----------------
+# 启动/停止/重启都作为后台任务执行，接口立即返回操作 id，
+# 进度通过 /ws/status 以 {"type": "operation"} 消息推送，多张卡的操作可以并行。
+
+# 最多保留多少条操作记录
+MAX_OPERATIONS = 200
+
+# op_id -> 操作记录
+operations = OrderedDict()
+# 保存后台任务的引用，防止被垃圾回收
+background_tasks = set()
+
+def spawn_task(coro):
+    """创建后台任务并保留引用"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def report_operation(op, state, message):
+    """更新操作进度并广播"""
+    op["state"] = state
+    op["message"] = message
+    if state in ("success", "error"):
+        op["finished_at"] = time.time()
+    await manager.broadcast({"type": "operation", **op})
+
+async def execute_operation(op, action):
+    """执行生命周期操作并汇报结果"""
+    machine_id = op["machine"]
+    await report_operation(op, "running", f"{machine_id} {op['action']}中...")
+    try:
+        result = await action(machine_id)
+    except Exception as e:
+        result = {"status": "error", "message": f"{machine_id} {op['action']}失败: {str(e)}"}
+    await publish_state(machine_id)
+    await report_operation(op, result["status"], result["message"])
+
+def create_operation(machine_id, action_name):
+    """登记一个生命周期操作"""
+    op = {
+        "id": uuid.uuid4().hex[:12],
+        "machine": machine_id,
+        "action": action_name,
+        "state": "pending",
+        "message": "",
+        "created_at": time.time(),
+        "finished_at": None,
+    }
+    operations[op["id"]] = op
+    while len(operations) > MAX_OPERATIONS:
+        operations.popitem(last=False)
+    return op
+
+# ---------------- 实例状态机 ----------------
+# 同一实例的启动、停止、重启在实例锁内依次执行，执行前按实例当前状态查表：
+#   allow  执行操作
+#   done   已经是目标状态，直接成功（重复点击、客户端重试不会再启动一个进程占满显存）
+#   reject 当前状态不能执行
+# 与最近一个进行中的操作相同的请求直接合并到该操作，返回同一个操作 id。
+# 停止优先：启动还在调度队列中等待时取消它，排空中则提前结束排空。
+
+# 实例状态 -> {操作: 处理方式}，表中没有的组合按 reject 处理
+LIFECYCLE_TRANSITIONS = {
+    "stopped": {"start": "allow", "stop": "done", "restart": "allow"},
+    "error": {"start": "allow", "stop": "done", "restart": "allow"},
+    "starting": {"start": "done", "stop": "allow", "restart": "allow"},
+    "running": {"start": "done", "stop": "allow", "restart": "allow"},
+    # 状态已是停止或出错、进程却还活着（启动失败后没结束掉等）：停止和重启会先结束它，
+    # 启动拒绝，否则同一张卡、同一个端口上会出现第二个进程
+    "lingering": {"start": "reject", "stop": "allow", "restart": "allow"},
+}
+
+# machine_id -> asyncio.Lock
+lifecycle_locks = {}
+# machine_id -> [(操作记录, 任务)]，按提交顺序排列，包括等待实例锁的操作
+active_operations = {}
+
+def lifecycle_lock(machine_id):
+    lock = lifecycle_locks.get(machine_id)
+    if lock is None:
+        lock = lifecycle_locks[machine_id] = asyncio.Lock()
+    return lock
+
+def process_alive(inst):
+    process = inst["process"]
+    return process is not None and process.returncode is None
+
+def transition_verdict(inst, action):
+    """按实例当前状态决定操作的处理方式；远程实例由所在节点判断"""
+    if inst.get("node"):
+        return "allow"
+    status = inst["status"]
+    if status in ("stopped", "error") and process_alive(inst):
+        status = "lingering"
+    return LIFECYCLE_TRANSITIONS.get(status, {}).get(action, "reject")
+
+def preempt_for_stop(machine_id):
+    """停止请求到达时，取消排队中的启动、让排空立即到期、放弃启动中的热备进程"""
+    launch_scheduler.cancel(machine_id, f"{machine_id} 启动已被停止取消")
+    inst = instances[machine_id]
+    drain = inst.get("drain")
+    if drain:
+        drain["deadline"] = time.time()
+    if inst.get("standby"):
+        # 热备重启在实例锁内等待新进程就绪，看到 desired 变化后放弃，停止随后执行
+        inst["desired"] = "stopped"
+
+async def execute_lifecycle(op, action, func):
+    """在实例锁内检查状态转换并执行操作"""
+    machine_id = op["machine"]
+    try:
+        async with lifecycle_lock(machine_id):
+            inst = instances.get(machine_id)
+            if inst is None:
+                await report_operation(op, "error", f"实例 {machine_id} 已删除")
+                return
+            verdict = transition_verdict(inst, action)
+            if verdict == "allow":
+                await execute_operation(op, func)
+            elif verdict == "done":
+                if action == "stop":
+                    # 手动停止空闲停止的实例后不再自动唤醒
+                    inst["desired"] = "stopped"
+                    save_process_state()
+                await report_operation(op, "success", f"{machine_id} 已经{'停止' if action == 'stop' else '在运行'}")
+            else:
+                state = "进程仍在运行" if process_alive(inst) else f"当前状态 {inst['status']}"
+                await report_operation(op, "error", f"{machine_id} {state}，不能{op['action']}")
+    finally:
+        entries = active_operations.get(machine_id, [])
+        entries[:] = [entry for entry in entries if entry[0] is not op]
+        if not entries:
+            active_operations.pop(machine_id, None)
+
+def submit_lifecycle(machine_id, action, drain=None):
+    """提交生命周期操作，返回 (操作记录, 任务, 是否合并到已有操作)"""
+    action_name, func = resolve_lifecycle(machine_id, action, drain)
+    entries = active_operations.setdefault(machine_id, [])
+    if entries and entries[-1][0]["action"] == action_name:
+        # 合并的重复请求不再重置看门狗、抢占进行中的操作
+        return (*entries[-1], True)
+    begin_lifecycle(machine_id, action)
+    if action == "stop" and action_name == LIFECYCLE_ACTIONS[("stop", False)][0]:
+        preempt_for_stop(machine_id)
+    op = create_operation(machine_id, action_name)
+    task = spawn_task(execute_lifecycle(op, action, func))
+    entries.append((op, task))
+    return op, task, False
+
+# ---------------- 启动调度 ----------------
+# 几个实例同时冷启动时，每个 Python 进程都在导入 torch、从同一块盘读取模型，互相争抢，
+# 总耗时反而比依次启动更长。手动启动和批量启动都先进入调度队列，按顺序放行：
+#   1. 同时冷启动（starting）的本机实例数不超过 "launch_concurrency"；
+#   2. 已有实例在冷启动时，磁盘读取速度低于 "launch_disk_mb" 才放行下一个；
+#   3. 可用内存不低于 "launch_min_free_mb"。
+# 磁盘和内存两项最多等待 LAUNCH_GATE_MAX_WAIT 秒，避免被其他负载一直卡住。
+# 看门狗的自动重启是故障恢复，不经过调度。
+
+# 检查放行条件的间隔（秒）
+LAUNCH_GATE_POLL = 1.0
+# 磁盘和内存条件最多等待的时间（秒）
+LAUNCH_GATE_MAX_WAIT = 60
+
+class LaunchScheduler:
+    def __init__(self):
+        # [(machine_id, future)]，先到先放行
+        self.queue = deque()
+        self.task = None
+        # 队首实例还在等待的原因
+        self.reason = None
+        self.disk_sample = None
+        self.disk_rate = 0.0
+
+    async def start(self, machine_id):
+        """排队等待放行后启动实例，返回 run_instance 的结果"""
+        for queued, future in self.queue:
+            if queued == machine_id:
+                return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((machine_id, future))
+        if self.task is None or self.task.done():
+            self.task = spawn_task(self.run())
+        return await asyncio.shield(future)
+
+    def cancel(self, machine_id, message):
+        """取消排队中的启动"""
+        for entry in list(self.queue):
+            if entry[0] == machine_id:
+                self.queue.remove(entry)
+                entry[1].set_result({"status": "error", "message": message})
+
+    def position(self, machine_id):
+        """实例在队列中的位置，不在队列中时为 None"""
+        for i, (queued, _) in enumerate(self.queue):
+            if queued == machine_id:
+                return i
+        return None
+
+    def sample_disk(self):
+        """更新磁盘读取速度（字节/秒）"""
+        try:
+            counters = psutil.disk_io_counters()
+        except Exception:
+            counters = None
+        if counters is None:
+            return
+        now = time.monotonic()
+        if self.disk_sample is not None and now > self.disk_sample[0]:
+            self.disk_rate = (counters.read_bytes - self.disk_sample[1]) / (now - self.disk_sample[0])
+        self.disk_sample = (now, counters.read_bytes)
+
+    def blocked(self, waited):
+        """返回不能放行的原因，可以放行时返回 None"""
+        cold = sum(1 for inst in instances.values() if inst["status"] == "starting" and not inst.get("node"))
+        limit = int(config.get("launch_concurrency") or 0)
+        if limit and cold >= limit:
+            return f"{cold} 个实例正在冷启动"
+        if waited >= LAUNCH_GATE_MAX_WAIT:
+            return None
+        disk_limit = float(config.get("launch_disk_mb") or 0) * 1024 * 1024
+        if cold and disk_limit and self.disk_rate > disk_limit:
+            return f"磁盘读取 {self.disk_rate / 1024 / 1024:.0f} MB/s"
+        min_free = float(config.get("launch_min_free_mb") or 0) * 1024 * 1024
+        available = psutil.virtual_memory().available
+        if min_free and available < min_free:
+            return f"可用内存 {available / 1024 / 1024:.0f} MB"
+        return None
+
+    async def run(self):
+        """依次放行队列中的启动"""
+        self.sample_disk()
+        since = time.monotonic()
+        while self.queue:
+            machine_id, future = self.queue[0]
+            reason = self.blocked(time.monotonic() - since)
+            if reason != self.reason:
+                self.reason = reason
+                await manager.broadcast({"type": "launch_queue", **self.report()})
+            if reason is not None:
+                await asyncio.sleep(LAUNCH_GATE_POLL)
+                self.sample_disk()
+                continue
+            self.queue.popleft()
+            try:
+                result = await run_instance(machine_id) if machine_id in instances else \
+                    {"status": "error", "message": f"未知实例 {machine_id}"}
+            except Exception as e:
+                result = {"status": "error", "message": f"{machine_id} 启动失败: {str(e)}"}
+            future.set_result(result)
+            await manager.broadcast({"type": "launch_queue", **self.report()})
+            # 留出时间让新进程开始读盘，下一次判断才看得到它的影响
+            await asyncio.sleep(LAUNCH_GATE_POLL)
+            self.sample_disk()
+            since = time.monotonic()
+        self.reason = None
+
+    def report(self):
+        return {
+            "queue": [machine_id for machine_id, _ in self.queue],
+            "reason": self.reason,
+            "disk_read_mb": round(self.disk_rate / 1024 / 1024, 1),
+        }
+
+launch_scheduler = LaunchScheduler()
+
+async def scheduled_start(machine_id):
+    """经过启动调度的 run_instance"""
+    inst = instances[machine_id]
+    if inst["status"] in ("running", "starting"):
+        return {"status": "error", "message": f"{machine_id} 已经在运行或启动中"}
+    return await launch_scheduler.start(machine_id)
+
+# 最多保留多少条批量操作记录
+MAX_BULK_RUNS = 50
+# 批量操作跟踪实例状态的间隔（秒）
+BULK_POLL = 0.5
+
+# bulk_id -> 批量操作记录
+bulk_runs = OrderedDict()
+
+def bulk_targets(action, machines):
+    """批量操作的目标：指定的实例，或者所有处于对应状态的实例"""
+    if machines:
+        return [machine_id for machine_id in machines.split(",") if machine_id in instances]
+    if action == "start":
+        return [machine_id for machine_id, inst in instances.items() if inst["status"] == "stopped"]
+    return [machine_id for machine_id, inst in instances.items() if inst["status"] in ("running", "starting")]
+
+def submit_bulk(action, machine_ids, drain=None):
+    """为每个实例提交生命周期操作，并在后台跟踪到全部完成"""
+    bulk = {
+        "id": uuid.uuid4().hex[:12],
+        "action": action,
+        "started_at": time.time(),
+        "finished_at": None,
+        # 从提交到最后一个实例就绪（或停止）的总耗时（秒）
+        "elapsed": None,
+        "machines": {},
+    }
+    for machine_id in machine_ids:
+        response = lifecycle_response(machine_id, action, drain)
+        bulk["machines"][machine_id] = {
+            "operation": response.get("operation"),
+            "state": "pending" if response["status"] == "success" else "failed",
+            "elapsed": None,
+        }
+    bulk_runs[bulk["id"]] = bulk
+    while len(bulk_runs) > MAX_BULK_RUNS:
+        bulk_runs.popitem(last=False)
+    spawn_task(track_bulk(bulk))
+    return bulk
+
+def bulk_machine_state(bulk, machine_id, entry):
+    """根据实例状态和操作结果判断单个实例的进度"""
+    inst = instances.get(machine_id)
+    op = operations.get(entry["operation"]) or {}
+    if inst is None or op.get("state") == "error":
+        return "failed"
+    if bulk["action"] == "stop":
+        return "stopped" if inst["status"] == "stopped" else "stopping"
+    if inst["status"] == "running" and op.get("state") == "success":
+        return "ready"
+    if launch_scheduler.position(machine_id) is not None:
+        return "queued"
+    if op.get("state") == "success" and inst["status"] == "stopped":
+        # 启动后又退出了（启动超时或崩溃）
+        return "failed"
+    return "starting"
+
+async def track_bulk(bulk):
+    """跟踪批量操作直到每个实例都有结果，记录总耗时"""
+    final = ("ready", "stopped", "failed")
+    while True:
+        changed = False
+        for machine_id, entry in bulk["machines"].items():
+            if entry["state"] in final:
+                continue
+            state = bulk_machine_state(bulk, machine_id, entry)
+            if state != entry["state"]:
+                entry["state"] = state
+                changed = True
+                if state in final:
+                    entry["elapsed"] = round(time.time() - bulk["started_at"], 2)
+        if all(entry["state"] in final for entry in bulk["machines"].values()):
+            bulk["finished_at"] = time.time()
+            bulk["elapsed"] = round(bulk["finished_at"] - bulk["started_at"], 2)
+            await manager.broadcast({"type": "bulk", **bulk})
+            return
+        if changed:
+            await manager.broadcast({"type": "bulk", **bulk})
+        await asyncio.sleep(BULK_POLL)
+
+# ---------------- 空闲停止 ----------------
+# 几个小时没人用的实例白白占着显存和电。设置 "idle_timeout"（秒）后，最近一次提交任务之后
+# 超过该时间、队列也为空的实例会被自动停止，标记为空闲停止（desired 为 "idle"）。
+# 之后经控制器访问它（打开页面、调用接口）时自动启动，请求暂存到实例就绪再转发，超时返回 503；
+# /dispatch 没有运行中的实例时同样唤醒一个。始终保留至少 "min_warm" 个运行中的实例。
+# 手动停止的实例不会被唤醒；远程实例由所在节点按自己的配置处理。
+
+# 检查空闲实例的间隔（秒）
+IDLE_CHECK_INTERVAL = 30
+# 等待唤醒的实例就绪时检查状态的间隔（秒）
+WAKE_POLL = 0.5
+
+def idle_timeout(inst):
+    return float(inst["spec"].get("idle_timeout", config.get("idle_timeout", 0)) or 0)
+
+def mark_used(machine_id):
+    """记录实例最近一次接收任务"""
+    inst = instances.get(machine_id)
+    if inst is not None:
+        inst["last_used"] = time.monotonic()
+
+def idle_candidates():
+    """空闲时间超过设置的运行中本机实例，空闲最久的在前"""
+    now = time.monotonic()
+    candidates = []
+    for machine_id, inst in instances.items():
+        timeout = idle_timeout(inst)
+        if not timeout or inst.get("node") or inst["status"] != "running" or inst.get("drain") \
+                or inst.get("standby") or machine_id in active_operations:
+            continue
+        idle = now - inst.get("last_used", inst.get("last_activity", now))
+        if idle >= timeout:
+            candidates.append((idle, machine_id))
+    return [machine_id for _, machine_id in sorted(candidates, reverse=True)]
+
+async def idle_stop(machine_id):
+    """队列为空时停止实例并标记为空闲停止，返回是否停止"""
+    inst = instances[machine_id]
+    queue = await fetch_json(upstream_url(inst, "queue", ""))
+    if queue is None or queue.get("queue_running") or queue.get("queue_pending"):
+        # 还有任务（可能是直连实例提交的），重新计时
+        mark_used(machine_id)
+        return False
+    async with lifecycle_lock(machine_id):
+        if instances.get(machine_id) is not inst or inst["status"] != "running":
+            return False
+        idle = round(time.monotonic() - inst.get("last_used", inst.get("last_activity", 0)))
+        watchdog.cancel(machine_id)
+        result = await stop_instance(machine_id)
+        if result["status"] != "success":
+            return False
+        inst["desired"] = "idle"
+        save_process_state()
+    get_log_buffer(machine_id).append("controller", f"===== 空闲 {idle} 秒，自动停止 =====")
+    await publish_state(machine_id)
+    return True
+
+async def check_idle():
+    """定期停止空闲的实例，保留 min_warm 个"""
+    while True:
+        await asyncio.sleep(IDLE_CHECK_INTERVAL)
+        warm = sum(1 for inst in instances.values() if inst["status"] in ("running", "starting") and not inst.get("node"))
+        for machine_id in idle_candidates():
+            if warm <= int(config.get("min_warm") or 0):
+                break
+            try:
+                if await idle_stop(machine_id):
+                    warm -= 1
+            except Exception:
+                pass
+
+def wake_wanted(inst):
+    """请求到达时是否应该等待实例：空闲停止的需要唤醒，启动中的等它就绪"""
+    if inst.get("node"):
+        return False
+    return inst["status"] == "starting" or (inst["status"] == "stopped" and inst.get("desired") == "idle")
+
+async def wake_instance(machine_id):
+    """唤醒空闲停止的实例并等待就绪，返回是否就绪；并发的唤醒合并为一次启动"""
+    inst = instances[machine_id]
+    if inst["status"] == "stopped" and inst.get("desired") == "idle":
+        get_log_buffer(machine_id).append("controller", "===== 收到请求，唤醒空闲实例 =====")
+        submit_lifecycle(machine_id, "start")
+    # 启动调度排队的时间也算在内
+    deadline = time.monotonic() + startup_timeout(machine_id) + LAUNCH_GATE_MAX_WAIT
+    while time.monotonic() < deadline:
+        if instances.get(machine_id) is not inst:
+            return False
+        if inst["status"] == "running":
+            mark_used(machine_id)
+            return True
+        if inst["status"] not in ("starting", "stopped") or \
+                (inst["status"] == "stopped" and machine_id not in active_operations):
+            # 启动失败，或者被手动停止
+            return False
+        await asyncio.sleep(WAKE_POLL)
+    return False
+
+# ---------------- 反向代理 ----------------
+# 所有实例统一挂在 /m/{machine_id}/ 下，只需对外开放 8000 端口。
+# 性能目标：相对直连，/prompt、/view、/object_info 额外增加的延迟不超过几毫秒，
+# 因此上游连接走 keep-alive 连接池，请求体和响应体都按块流式转发，不在内存中整体缓存。
+# 用 python bench/run_bench.py --only proxy_overhead 对比直连和经代理的延迟。
+
+# 逐跳头部，不能原样转发
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "trailers", "transfer-encoding", "upgrade",
+}
+
+# 共享的上游连接池，在 startup 中创建
+http_client = None
+
+def create_http_client():
+    """创建带 keep-alive 连接池的上游 HTTP 客户端"""
+    return httpx.AsyncClient(
+        # 读超时不设上限：/view 大文件和长时间生成都需要
+        timeout=httpx.Timeout(connect=5.0, read=None, write=None, pool=10.0),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60),
+        follow_redirects=False,
+    )
+
+def filter_headers(headers):
+    """去掉逐跳头部以及 Connection 中声明的头部"""
+    extra = {v.strip().lower() for v in headers.get("connection", "").split(",") if v.strip()}
+    return [
+        (k, v) for k, v in headers.items()
+        if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() not in extra
+    ]
+
+def upstream_url(inst, path, query, scheme="http"):
+    """拼接实例的上游地址"""
+    base = inst["url"].rstrip("/")
+    if scheme == "ws":
+        base = "ws" + base[len("http"):]
+    url = f"{base}/{path}"
+    if query:
+        url += "?" + query
+    return url
+
+@app.get("/m/{machine_id}")
+async def proxy_root_redirect(machine_id: str):
+    # ComfyUI 前端使用相对路径，必须带结尾斜杠
+    return RedirectResponse(f"/m/{machine_id}/", status_code=308)
+
+@app.api_route("/m/{machine_id}/{path:path}",
+               methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
+async def proxy_http(machine_id: str, path: str, request: Request):
+    """流式 HTTP 反向代理"""
+    inst = instances.get(machine_id)
+    if inst is None:
+        return JSONResponse({"status": "error", "message": f"未知实例 {machine_id}"}, status_code=404)
+
+    headers = filter_headers(request.headers)
+    client_host = request.client.host if request.client else ""
+    forwarded_for = request.headers.get("x-forwarded-for")
+    headers.append(("x-forwarded-for", f"{forwarded_for}, {client_host}" if forwarded_for else client_host))
+    headers.append(("x-forwarded-proto", request.url.scheme))
+    headers.append(("x-forwarded-prefix", f"/m/{machine_id}"))
+
+    # 不需要转换的 /view 由控制器直接返回文件
+    if request.method in ("GET", "HEAD") and path in VIEW_PATHS and config.get("direct_view", True) and not inst.get("node"):
+        response = await serve_view(request, inst)
+        if response is not None:
+            return response
+
+    # 空闲停止的实例先唤醒，启动中的实例等它就绪，请求暂存到这时再转发
+    if wake_wanted(inst) and not await wake_instance(machine_id):
+        return JSONResponse({"status": "error", "message": f"{machine_id} 启动超时或启动失败"}, status_code=503)
+
+    # /object_info 和带哈希的前端资源走缓存，取不到时按普通请求转发
+    cache_key = response_cache.key(machine_id, inst, path) if request.method == "GET" and not request.url.query else None
+    if cache_key is not None:
+        asset = response_cache.get(cache_key)
+        if asset is not None:
+            response_cache.hits += 1
+        else:
+            asset = await response_cache.fetch(cache_key, upstream_url(inst, path, ""), headers)
+        if asset is not None:
+            return serve_asset(request, asset)
+
+    # 排空中的实例不接收新任务：重启时暂存到新进程就绪，停止时拒绝（远程实例由节点处理）
+    if request.method == "POST" and path == "prompt" and inst.get("drain") and not inst.get("node") \
+            and not await hold_for_drain(machine_id):
+        return JSONResponse({"status": "error", "message": f"{machine_id} 正在排空，不再接收新任务"}, status_code=503)
+
+    # 只有真正带请求体的请求才流式转发，避免 GET 变成 chunked
+    has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+    upstream_request = http_client.build_request(
+        request.method,
+        upstream_url(inst, path, request.url.query),
+        headers=headers,
+        content=request.stream() if has_body else None,
+    )
+    try:
+        upstream = await http_client.send(upstream_request, stream=True)
+    except httpx.HTTPError as e:
+        return JSONResponse({"status": "error", "message": f"{machine_id} 无法连接: {str(e)}"}, status_code=502)
+
+    if request.method == "POST" and path == "prompt" and upstream.status_code == 200:
+        record_first_prompt(machine_id)
+        mark_used(machine_id)
+
+    raw_headers = []
+    for k, v in filter_headers(upstream.headers):
+        if k.lower() == "location" and v.startswith(inst["url"]):
+            # 上游的绝对跳转改写回代理路径
+            v = f"/m/{machine_id}" + v[len(inst["url"].rstrip("/")):]
+        raw_headers.append((k.lower().encode("latin-1"), v.encode("latin-1")))
+
+    # aiter_raw 保留上游的压缩编码和 Content-Length，不做解压再压缩
+    response = StreamingResponse(
+        upstream.aiter_raw(),
+        status_code=upstream.status_code,
+        background=BackgroundTask(upstream.aclose),
+    )
+    response.raw_headers = raw_headers
+    return response
+
+@app.websocket("/m/{machine_id}/{path:path}")
+async def proxy_websocket(websocket: WebSocket, machine_id: str, path: str):
+    """双向转发 ComfyUI 的 /ws"""
+    inst = instances.get(machine_id)
+    if inst is None:
+        await websocket.close(code=4404)
+        return
+
+    target = upstream_url(inst, path, websocket.url.query, scheme="ws")
+    subprotocols = websocket.scope.get("subprotocols") or None
+    try:
+        upstream = await websockets.connect(
+            target, subprotocols=subprotocols, max_size=None, ping_interval=None, open_timeout=10
+        )
+    except Exception:
+        await websocket.close(code=1011)
+        return
+
+    await websocket.accept(subprotocol=upstream.subprotocol)
+
+    async def client_to_upstream():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("text") is not None:
+                await upstream.send(message["text"])
+            elif message.get("bytes") is not None:
+                await upstream.send(message["bytes"])
+
+    async def upstream_to_client():
+        async for message in upstream:
+            touch_activity(machine_id)
+            if isinstance(message, str):
+                await websocket.send_text(message)
+            else:
+                await websocket.send_bytes(message)
+
+    tasks = [asyncio.create_task(client_to_upstream()), asyncio.create_task(upstream_to_client())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await upstream.close()
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+# ---------------- 上游响应缓存 ----------------
+# /object_info 有几 MB，装了很多自定义节点时生成很慢；前端的 JS/CSS 每个实例都要重新下载一遍。
+# 这些响应缓存在控制器内存里，预先压缩好，按内容哈希去重：所有实例共用同一份 ComfyUI 时只存一份。
+# /object_info 按 (实例, boot) 索引，每个实例每次启动只向上游请求一次，重启后重新验证；
+# 文件名带内容哈希的前端资源内容不会变，所有实例直接共用。总大小超过上限时淘汰最久未用的。
+
+# 需要按实例缓存的路径
+CACHED_INSTANCE_PATHS = {"object_info", "api/object_info"}
+# 文件名带内容哈希的前端资源，如 assets/index-BQ3c9x2T.js
+HASHED_ASSET_PATTERN = re.compile(r"^(?:.+/)?assets/[^/]+[-.][A-Za-z0-9_-]{8,}\.(?:js|mjs|css|woff2?|ttf|svg|png|webp|wasm)$")
+# /object_info 每次由浏览器带 ETag 验证，实例重启后内容可能变化
+INSTANCE_CACHE_CONTROL = "no-cache"
+# 缓存条目的压缩等级：条目很大且在请求路径上生成，不用最高等级
+CACHE_GZIP_LEVEL = 6
+CACHE_BROTLI_QUALITY = 5
+# 不向上游转发的请求头：由缓存自己处理协商和压缩
+CACHE_SKIP_HEADERS = {"accept-encoding", "if-none-match", "if-modified-since", "range"}
+
+class ResponseCache:
+    def __init__(self):
+        # 内容哈希(ETag) -> StaticAsset，按最近使用排序
+        self.entries = OrderedDict()
+        self.size = 0
+        # 索引键 -> 内容哈希；键为 (machine_id, boot, path) 或 ("assets", path)
+        self.index = {}
+        # 索引键 -> 正在向上游请求的任务
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, machine_id, inst, path):
+        """可缓存的请求返回索引键，否则返回 None"""
+        if path in CACHED_INSTANCE_PATHS:
+            return (machine_id, inst.get("boot_id"), path)
+        if HASHED_ASSET_PATTERN.match(path):
+            return ("assets", path)
+        return None
+
+    def get(self, key):
+        digest = self.index.get(key)
+        asset = self.entries.get(digest) if digest is not None else None
+        if asset is not None:
+            self.entries.move_to_end(digest)
+        return asset
+
+    def put(self, key, asset):
+        if asset.etag not in self.entries:
+            self.entries[asset.etag] = asset
+            self.size += sum(len(body) for body in asset.bodies.values())
+            limit = float(config.get("response_cache_mb", 256)) * 1024 * 1024
+            while self.size > limit and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= sum(len(body) for body in evicted.bodies.values())
+        if key[0] != "assets":
+            # 同一实例旧 boot 的索引作废
+            for stale in [k for k in self.index if k[0] == key[0] and k[1] != key[1]]:
+                del self.index[stale]
+        self.index[key] = asset.etag
+
+    async def fetch(self, key, url, headers):
+        """向上游取完整响应并放入缓存，非 200 时返回 None；并发的相同请求只取一次"""
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = spawn_task(self._fetch(key, url, headers))
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, url, headers):
+        self.misses += 1
+        headers = [(k, v) for k, v in headers if k.lower() not in CACHE_SKIP_HEADERS]
+        try:
+            response = await http_client.get(url, headers=headers)
+        except httpx.HTTPError:
+            return None
+        if response.status_code != 200:
+            return None
+        cache_control = STATIC_CACHE_CONTROL if key[0] == "assets" else INSTANCE_CACHE_CONTROL
+        media_type = response.headers.get("content-type", "application/octet-stream")
+        # 压缩几 MB 的内容比较耗时，放到线程中
+        asset = await asyncio.to_thread(
+            StaticAsset, response.content, media_type, cache_control, CACHE_GZIP_LEVEL, CACHE_BROTLI_QUALITY
+        )
+        self.put(key, asset)
+        return asset
+
+response_cache = ResponseCache()
+
+# ---------------- 输出文件直出 ----------------
+# 生成的图片和视频原本要经过 ComfyUI 进程的 /view，再经代理逐字节复制一遍。
+# 对不需要转换的 /view 请求，控制器直接从实例的 output/input/temp 目录返回文件：
+# 支持 Range（视频拖动进度）、强 ETag 和 304；服务器支持 pathsend 扩展时由服务器直接发送文件。
+# 路径解析后必须仍在对应目录之内，否则拒绝；文件不存在时仍交给实例处理。
+
+# 直出的路径
+VIEW_PATHS = {"view", "api/view"}
+# type 参数对应的 ComfyUI 目录参数
+VIEW_DIR_FLAGS = {"output": "--output-directory", "input": "--input-directory", "temp": "--temp-directory"}
+# 浏览器可能执行的类型按二进制返回，与 ComfyUI 一致
+VIEW_UNSAFE_TYPES = {"text/html", "text/html-sandboxed", "application/xhtml+xml", "text/javascript", "text/css"}
+VIEW_CACHE_CONTROL = "no-cache"
+
+def command_flag(args, name):
+    """取命令行参数的值，同一参数出现多次时以最后一次为准"""
+    value = None
+    for i, arg in enumerate(args):
+        if arg == name and i + 1 < len(args):
+            value = args[i + 1]
+        elif arg.startswith(name + "="):
+            value = arg.split("=", 1)[1]
+    return value
+
+def instance_dir(inst, kind):
+    """实例的 output/input/temp 目录，与 ComfyUI 的命令行参数一致"""
+    args = [*config["args"], *inst["spec"]["extra_args"]]
+    base = command_flag(args, "--base-directory") or os.path.dirname(os.path.abspath(config["main"]))
+    return os.path.realpath(command_flag(args, VIEW_DIR_FLAGS[kind]) or os.path.join(base, kind))
+
+def resolve_view_path(inst, params):
+    """解析 /view 参数对应的文件，返回 (路径, stat)；越界时返回 "forbidden"，无法直出时返回 None"""
+    filename = params.get("filename", "")
+    subfolder = params.get("subfolder", "")
+    kind = params.get("type") or "output"
+    # 与 ComfyUI 一致，文件名可以带 " [output]" 这样的目录标注
+    for name in VIEW_DIR_FLAGS:
+        if filename.endswith(f" [{name}]"):
+            filename, kind = filename[:-len(name) - 3], name
+    if not filename or kind not in VIEW_DIR_FLAGS or "\x00" in filename + subfolder:
+        return None
+    root = instance_dir(inst, kind)
+    path = os.path.realpath(os.path.join(root, subfolder, filename))
+    try:
+        inside = os.path.normcase(os.path.commonpath([root, path])) == os.path.normcase(root) and path != root
+    except ValueError:
+        # Windows 上不同盘符
+        inside = False
+    if not inside:
+        return "forbidden"
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return path, st
+
+async def serve_view(request, inst):
+    """直接返回 /view 请求的文件；需要交给实例处理时返回 None"""
+    params = request.query_params
+    # 预览和通道转换需要 ComfyUI 处理图片
+    if "preview" in params or params.get("channel", "rgba") != "rgba":
+        return None
+    resolved = await asyncio.to_thread(resolve_view_path, inst, params)
+    if resolved is None:
+        return None
+    if resolved == "forbidden":
+        return JSONResponse({"status": "error", "message": "路径不在允许的目录中"}, status_code=403)
+    path, st = resolved
+    etag = '"' + hashlib.sha256(f"{st.st_ino}-{st.st_size}-{st.st_mtime_ns}".encode()).hexdigest()[:20] + '"'
+    headers = {"ETag": etag, "Cache-Control": VIEW_CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if media_type in VIEW_UNSAFE_TYPES:
+        media_type = "application/octet-stream"
+    return FileResponse(
+        path, media_type=media_type, headers=headers, stat_result=st,
+        filename=os.path.basename(path), content_disposition_type="inline",
+    )
+
+# ---------------- 资源监控 ----------------
+# 每秒采样一次各实例进程树的 CPU、内存、句柄数和显卡占用，写入按列存储的定长数组环形缓冲区。
+# 进程对象跨采样复用（cpu_percent 依赖上一次的计数），子进程列表每隔几次才重新枚举，
+# 16 个实例每秒采样的开销在单核 1% 以内。显卡数据来自可替换的后端，没有 NVML 时为空。
+
+# 采样间隔（秒）
+METRICS_INTERVAL = 1.0
+# 每个实例保留的采样点数（1 秒一次即 1 小时）
+METRICS_HISTORY = 3600
+# 每隔多少次采样重新枚举一次子进程
+METRICS_CHILDREN_REFRESH = 10
+METRIC_FIELDS = ("time", "cpu_percent", "rss_bytes", "handles", "gpu_memory_bytes", "gpu_utilization")
+
+class MetricRing:
+    """按列存储的定长时间序列，写满后覆盖最旧的数据"""
+
+    def __init__(self, capacity=METRICS_HISTORY):
+        self.capacity = capacity
+        self.columns = {name: array("d", [0.0]) * capacity for name in METRIC_FIELDS}
+        self.start = 0
+        self.count = 0
+
+    def append(self, sample):
+        index = (self.start + self.count) % self.capacity
+        for name in METRIC_FIELDS:
+            value = sample.get(name)
+            self.columns[name][index] = float("nan") if value is None else value
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def row(self, offset):
+        index = (self.start + offset) % self.capacity
+        return [self.columns[name][index] for name in METRIC_FIELDS]
+
+    def latest(self):
+        if self.count == 0:
+            return None
+        return dict(zip(METRIC_FIELDS, self.row(self.count - 1)))
+
+    def downsample(self, points, seconds=None):
+        """把最近 seconds 秒的数据平均成最多 points 个点"""
+        first = 0
+        if seconds is not None:
+            cutoff = time.time() - seconds
+            while first < self.count and self.row(first)[0] < cutoff:
+                first += 1
+        total = self.count - first
+        if total <= 0 or points <= 0:
+            return []
+        bucket = max(1, -(-total // points))
+        result = []
+        for begin in range(first, self.count, bucket):
+            rows = [self.row(offset) for offset in range(begin, min(begin + bucket, self.count))]
+            averaged = []
+            for column in zip(*rows):
+                values = [v for v in column if not math.isnan(v)]
+                averaged.append(round(sum(values) / len(values), 2) if values else None)
+            result.append(averaged)
+        return result
+
+class NullGpuBackend:
+    """没有显卡监控时使用"""
+    name = "none"
+
+    def sample(self, gpu_index, pids):
+        return {}
+
+class NvmlGpuBackend:
+    """通过 NVML 读取显存和利用率（需要 nvidia-ml-py）"""
+    name = "nvml"
+
+    def __init__(self):
+        pynvml.nvmlInit()
+        self.handles = {}
+
+    def sample(self, gpu_index, pids):
+        handle = self.handles.get(gpu_index)
+        if handle is None:
+            handle = self.handles[gpu_index] = pynvml.nvmlDeviceGetHandleByIndex(gpu_index)
+        result = {"gpu_utilization": pynvml.nvmlDeviceGetUtilizationRates(handle).gpu}
+        used = None
+        try:
+            for proc in pynvml.nvmlDeviceGetComputeRunningProcesses(handle):
+                # Windows WDDM 下拿不到单进程显存
+                if proc.pid in pids and proc.usedGpuMemory is not None:
+                    used = (used or 0) + proc.usedGpuMemory
+        except pynvml.NVMLError:
+            pass
+        if used is None:
+            # 退回到整张卡的已用显存
+            used = pynvml.nvmlDeviceGetMemoryInfo(handle).used
+        result["gpu_memory_bytes"] = used
+        return result
+
+def create_gpu_backend():
+    if pynvml is not None:
+        try:
+            return NvmlGpuBackend()
+        except Exception:
+            pass
+    return NullGpuBackend()
+
+# 首次采样时自动选择
+gpu_backend = None
+
+def set_gpu_backend(backend):
+    """替换显卡监控后端，backend.sample(gpu_index, pids) 返回 gpu_memory_bytes / gpu_utilization"""
+    global gpu_backend
+    gpu_backend = backend
+
+# machine_id -> MetricRing
+metric_rings = {}
+# machine_id -> {"root": pid, "procs": {pid: psutil.Process}, "age": int}
+metric_procs = {}
+
+def process_tree(machine_id, pid):
+    """复用进程对象，定期刷新子进程列表"""
+    entry = metric_procs.get(machine_id)
+    if entry is None or entry["root"] != pid:
+        entry = metric_procs[machine_id] = {"root": pid, "procs": {}, "age": METRICS_CHILDREN_REFRESH}
+    if entry["age"] >= METRICS_CHILDREN_REFRESH:
+        entry["age"] = 0
+        root = entry["procs"].get(pid) or psutil.Process(pid)
+        current = {pid: root}
+        for child in root.children(recursive=True):
+            current[child.pid] = entry["procs"].get(child.pid, child)
+        entry["procs"] = current
+    entry["age"] += 1
+    return entry["procs"]
+
+def sample_instance(machine_id, pid, gpu_index):
+    """采样一个实例的进程树"""
+    sample = {"time": time.time(), "cpu_percent": 0.0, "rss_bytes": 0, "handles": 0}
+    procs = process_tree(machine_id, pid)
+    for child_pid, proc in list(procs.items()):
+        try:
+            with proc.oneshot():
+                sample["cpu_percent"] += proc.cpu_percent(None)
+                sample["rss_bytes"] += proc.memory_info().rss
+                sample["handles"] += proc.num_handles() if sys.platform == "win32" else proc.num_fds()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            procs.pop(child_pid, None)
+    try:
+        if gpu_backend is not None:
+            sample.update(gpu_backend.sample(gpu_index, set(procs)))
+    except Exception:
+        pass
+    return sample
+
+def sample_all(targets):
+    """在工作线程中采样所有运行中的实例"""
+    samples = {}
+    for machine_id, pid, gpu_index in targets:
+        try:
+            samples[machine_id] = sample_instance(machine_id, pid, gpu_index)
+        except psutil.NoSuchProcess:
+            metric_procs.pop(machine_id, None)
+    return samples
+
+async def collect_metrics():
+    """定期采样资源占用"""
+    global gpu_backend
+    if gpu_backend is None:
+        gpu_backend = await asyncio.to_thread(create_gpu_backend)
+    while True:
+        targets = [
+            (machine_id, inst["process"].pid, inst["gpu"])
+            for machine_id, inst in instances.items() if inst["process"] is not None
+        ]
+        for machine_id in list(metric_procs):
+            if machine_id not in instances or instances[machine_id]["process"] is None:
+                metric_procs.pop(machine_id, None)
+        if targets:
+            samples = await asyncio.to_thread(sample_all, targets)
+            for machine_id, sample in samples.items():
+                metric_rings.setdefault(machine_id, MetricRing()).append(sample)
+        await asyncio.sleep(METRICS_INTERVAL)
+
+# 事件循环延迟的采样间隔（秒）
+LOOP_LAG_INTERVAL = 0.1
+# 事件循环延迟直方图的分桶上限（秒）
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# 各桶的计数（不累计，最后一个为 +Inf），以及总和与次数
+loop_lag = {"buckets": [0] * (len(LOOP_LAG_BUCKETS) + 1), "sum": 0.0, "count": 0}
+
+async def monitor_loop_lag():
+    """定时睡眠，实际多睡的时间就是事件循环被阻塞的时间"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        loop_lag["buckets"][bisect.bisect_left(LOOP_LAG_BUCKETS, lag)] += 1
+        loop_lag["sum"] += lag
+        loop_lag["count"] += 1
+
+def prometheus_metrics():
+    """生成 Prometheus 文本格式"""
+    gauges = [
+        ("comfy_instance_up", "实例是否在运行", None),
+        ("comfy_instance_cpu_percent", "进程树 CPU 占用（单核百分比）", "cpu_percent"),
+        ("comfy_instance_rss_bytes", "进程树常驻内存", "rss_bytes"),
+        ("comfy_instance_open_handles", "进程树打开的句柄或文件描述符数", "handles"),
+        ("comfy_instance_gpu_memory_bytes", "显存占用", "gpu_memory_bytes"),
+        ("comfy_instance_gpu_utilization_percent", "显卡利用率", "gpu_utilization"),
+    ]
+    lines = []
+    for metric, help_text, field in gauges:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for machine_id, inst in instances.items():
+            label = f'{{machine="{machine_id}",gpu="{inst["gpu"]}"}}'
+            if field is None:
+                lines.append(f"{metric}{label} {1 if inst['status'] == 'running' else 0}")
+                continue
+            ring = metric_rings.get(machine_id)
+            latest = ring.latest() if ring is not None and (inst["process"] is not None or inst.get("node")) else None
+            if latest is not None and not math.isnan(latest[field]):
+                lines.append(f"{metric}{label} {latest[field]!r}")
+    lines.append("# HELP comfy_controller_ws_clients 状态 WebSocket 连接数")
+    lines.append("# TYPE comfy_controller_ws_clients gauge")
+    lines.append(f"comfy_controller_ws_clients {len(manager.active_connections)}")
+    lines.append("# HELP comfy_controller_response_cache_bytes 上游响应缓存占用（含压缩版本）")
+    lines.append("# TYPE comfy_controller_response_cache_bytes gauge")
+    lines.append(f"comfy_controller_response_cache_bytes {response_cache.size}")
+    lines.append("# HELP comfy_controller_response_cache_requests_total 可缓存请求的命中和未命中次数")
+    lines.append("# TYPE comfy_controller_response_cache_requests_total counter")
+    lines.append(f'comfy_controller_response_cache_requests_total{{result="hit"}} {response_cache.hits}')
+    lines.append(f'comfy_controller_response_cache_requests_total{{result="miss"}} {response_cache.misses}')
+    lines.append("# HELP comfy_controller_loop_lag_seconds 事件循环调度延迟")
+    lines.append("# TYPE comfy_controller_loop_lag_seconds histogram")
+    cumulative = 0
+    for bound, count in zip(LOOP_LAG_BUCKETS + ("+Inf",), loop_lag["buckets"]):
+        cumulative += count
+        lines.append(f'comfy_controller_loop_lag_seconds_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f"comfy_controller_loop_lag_seconds_sum {loop_lag['sum']!r}")
+    lines.append(f"comfy_controller_loop_lag_seconds_count {loop_lag['count']}")
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(prometheus_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/metrics/history/{machine_id}")
+async def get_metrics_history(machine_id: str, points: int = 60, seconds: int = 300):
+    """降采样后的历史数据，供面板绘制迷你折线图"""
+    if machine_id not in instances:
+        return JSONResponse({"status": "error", "message": f"未知实例 {machine_id}"}, status_code=404)
+    ring = metric_rings.get(machine_id)
+    samples = ring.downsample(min(points, 600), seconds) if ring is not None else []
+    return {"status": "success", "fields": list(METRIC_FIELDS), "samples": samples}
+
+# ---------------- 模型预热 ----------------
+# 冷启动的大头是从 ComfyUI/models 读取几个 GB 的模型文件，两张卡同时启动时同一个文件会被读两遍。
+# 启动实例时在后台把模型文件顺序读一遍装进系统页缓存，与 ComfyUI 的导入和节点加载同时进行。
+# 所有实例共用一个预热器：同一时间只顺序读一个文件，每个文件只读一次，读取速度有上限。
+# 文件列表来自配置的 "prewarm"（可用通配符，相对路径以 ComfyUI 目录为准），
+# 以及运行期间定期采样实例打开和映射的模型文件学到的列表（保存在状态目录的 prewarm.json）。
+# Linux/macOS 上用 mincore 测量文件有多少已在页缓存中，其他平台按本进程的读取记录估计。
+
+# 视为模型文件的扩展名
+PREWARM_EXTENSIONS = (".safetensors", ".sft", ".ckpt", ".pt", ".pth", ".bin", ".gguf", ".onnx")
+PREWARM_LEARNED_PATH = os.path.join(STATE_DIR, "prewarm.json")
+# 每个实例最多记住的模型文件数
+PREWARM_MAX_LEARNED = 32
+# 采样实例打开文件的间隔（秒）
+PREWARM_SAMPLE_INTERVAL = 10
+# 每次读取的块大小
+PREWARM_CHUNK = 8 * 1024 * 1024
+# 已缓存比例超过该值的文件不再读取
+PREWARM_RESIDENT_SKIP = 0.95
+# 单个文件不超过可用内存的这个比例才预热，避免把正在用的内存挤出去
+PREWARM_MEMORY_FRACTION = 0.8
+# 无法测量时，本进程读过的文件在这段时间内（秒）视为仍在缓存中
+PREWARM_ESTIMATE_TTL = 3600
+
+# machine_id -> [模型文件路径]，最近用到的在前
+learned_files = {}
+
+def load_learned_files():
+    try:
+        with open(PREWARM_LEARNED_PATH, "r", encoding="utf-8") as f:
+            learned_files.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+def save_learned_files():
+    tmp_path = PREWARM_LEARNED_PATH + ".tmp"
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(learned_files, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, PREWARM_LEARNED_PATH)
+    except OSError:
+        pass
+
+load_learned_files()
+
+def load_libc():
+    """加载带 mincore 的 libc，Windows 上返回 None"""
+    if sys.platform == "win32":
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+libc = load_libc()
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+def resident_fraction(path, size):
+    """用 mincore 测量文件在页缓存中的比例，无法测量时返回 None"""
+    if libc is None:
+        return None
+    if size == 0:
+        return 1.0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr is None or addr == MAP_FAILED:
+            return None
+        try:
+            pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+            vec = (ctypes.c_ubyte * pages)()
+            if libc.mincore(addr, size, vec) != 0:
+                return None
+            return (pages - bytes(vec).count(0)) / pages
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+class PageCacheWarmer:
+    def __init__(self):
+        # 同一时间只顺序读一个文件，多张卡同时启动时磁盘不来回寻道
+        self.lock = asyncio.Lock()
+        # 路径 -> 预热任务，正在预热的文件被再次请求时复用同一个任务
+        self.tasks = {}
+        # 路径 -> 预热记录
+        self.files = {}
+        # 控制器退出时中止后台读取
+        self.closing = False
+
+    def warm(self, paths):
+        """在后台预热一组文件"""
+        tasks = []
+        for path in paths:
+            task = self.tasks.get(path)
+            if task is None or task.done():
+                task = self.tasks[path] = spawn_task(self._warm_file(path))
+            tasks.append(task)
+        return tasks
+
+    def residency(self, path, st):
+        """返回 (已缓存比例, 是否为估计值)"""
+        try:
+            fraction = resident_fraction(path, st.st_size)
+        except OSError:
+            fraction = None
+        if fraction is not None:
+            return fraction, False
+        entry = self.files.get(path)
+        if entry and entry.get("warmed_at") and entry.get("mtime") == st.st_mtime \
+                and time.time() - entry["warmed_at"] < PREWARM_ESTIMATE_TTL:
+            return 1.0, True
+        return 0.0, True
+
+    async def _warm_file(self, path):
+        entry = self.files.setdefault(path, {"state": "pending", "read": 0})
+        try:
+            st = os.stat(path)
+        except OSError:
+            entry["state"] = "missing"
+            return
+        entry["size"] = st.st_size
+        async with self.lock:
+            fraction, _ = await asyncio.to_thread(self.residency, path, st)
+            if fraction >= PREWARM_RESIDENT_SKIP:
+                entry["state"] = "cached"
+                return
+            if st.st_size > psutil.virtual_memory().available * PREWARM_MEMORY_FRACTION:
+                entry["state"] = "skipped"
+                return
+            entry["state"] = "reading"
+            try:
+                await asyncio.to_thread(self._read, path, entry)
+            except OSError:
+                entry["state"] = "error"
+                return
+            entry["state"] = "done" if not self.closing else "pending"
+            entry["warmed_at"] = time.time()
+            entry["mtime"] = st.st_mtime
+
+    def _read(self, path, entry):
+        """在线程中大块顺序读取文件，按配置的速度限流"""
+        rate = float(config.get("prewarm_rate_mb") or 0) * 1024 * 1024
+        view = memoryview(bytearray(PREWARM_CHUNK))
+        entry["read"] = 0
+        started = time.monotonic()
+        with open(path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while not self.closing:
+                n = f.readinto(view)
+                if not n:
+                    break
+                entry["read"] += n
+                if rate:
+                    ahead = entry["read"] / rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def report(self, paths):
+        """各文件的大小、预热状态和已缓存比例"""
+        result = []
+        for path in paths:
+            entry = self.files.get(path, {})
+            item = {"path": path, "state": entry.get("state", "idle"), "read": entry.get("read", 0)}
+            try:
+                st = os.stat(path)
+            except OSError:
+                item.update(state="missing", size=0, resident=0.0, estimated=False)
+            else:
+                fraction, estimated = self.residency(path, st)
+                item.update(size=st.st_size, resident=round(fraction, 4), estimated=estimated)
+            result.append(item)
+        return result
+
+prewarmer = PageCacheWarmer()
+
+def prewarm_sources(inst):
+    """实例的预热来源：配置的通配符（换成绝对路径）和学到的文件"""
+    base = os.path.dirname(os.path.abspath(config["main"]))
+    patterns = []
+    for pattern in list(config.get("prewarm") or []) + list(inst["spec"].get("prewarm") or []):
+        patterns.append(pattern if os.path.isabs(pattern) else os.path.join(base, pattern))
+    return patterns, list(learned_files.get(inst["spec"]["id"], []))
+
+def expand_prewarm(patterns, learned):
+    """实例需要预热的模型文件：配置的在前，学到的在后。要遍历目录，在线程中调用"""
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern, recursive=True)))
+    paths.extend(learned)
+    # 去重并只保留存在的文件
+    return [path for path in dict.fromkeys(os.path.normpath(p) for p in paths) if os.path.isfile(path)]
+
+async def prewarm_instance(sources):
+    """展开预热列表并开始预热，返回文件列表"""
+    paths = await asyncio.to_thread(expand_prewarm, *sources)
+    prewarmer.warm(paths)
+    return paths
+
+def opened_model_files(pid):
+    """进程树当前打开或映射的模型文件"""
+    try:
+        root = psutil.Process(pid)
+        procs = [root] + root.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+    found = []
+    for proc in procs:
+        try:
+            paths = [f.path for f in proc.open_files()]
+            # safetensors 用 mmap 读取，文件句柄可能已经关闭，只剩映射
+            paths += [m.path for m in proc.memory_maps(grouped=True)]
+        except (psutil.NoSuchProcess, psutil.AccessDenied, OSError):
+            continue
+        found.extend(os.path.normpath(p) for p in paths if p.lower().endswith(PREWARM_EXTENSIONS))
+    return list(dict.fromkeys(found))
+
+async def learn_model_files():
+    """定期采样实例用到的模型文件，更新学到的预热列表"""
+    while True:
+        await asyncio.sleep(PREWARM_SAMPLE_INTERVAL)
+        targets = {machine_id: inst["process"].pid for machine_id, inst in instances.items() if inst["process"] is not None}
+        changed = False
+        for machine_id, pid in targets.items():
+            found = await asyncio.to_thread(opened_model_files, pid)
+            if not found:
+                continue
+            known = learned_files.get(machine_id, [])
+            merged = list(dict.fromkeys(found + known))[:PREWARM_MAX_LEARNED]
+            if merged != known:
+                learned_files[machine_id] = merged
+                changed = True
+        if changed:
+            await asyncio.to_thread(save_learned_files)
+
+@app.get("/prewarm/{machine_id}")
+async def get_prewarm(machine_id: str):
+    if machine_id not in instances:
+        return JSONResponse({"status": "error", "message": f"未知实例 {machine_id}"}, status_code=404)
+    paths = await asyncio.to_thread(expand_prewarm, *prewarm_sources(instances[machine_id]))
+    files = await asyncio.to_thread(prewarmer.report, paths)
+    return {"status": "success", "measured": libc is not None, "files": files}
+
+@app.post("/prewarm/{machine_id}")
+async def start_prewarm(machine_id: str):
+    if machine_id not in instances:
+        return JSONResponse({"status": "error", "message": f"未知实例 {machine_id}"}, status_code=404)
+    if instances[machine_id].get("node"):
+        return JSONResponse({"status": "error", "message": f"{machine_id} 是远程实例，请在所在节点上预热"}, status_code=400)
+    paths = await prewarm_instance(prewarm_sources(instances[machine_id]))
+    return {"status": "success", "message": f"{machine_id} 开始预热 {len(paths)} 个文件"}
+
+# ---------------- 任务分发 ----------------
+# 统一的提交入口：把 prompt 发给预计最早空闲的实例。
+# 预计等待时间 = 未完成任务数（/queue 中运行+排队） × 该实例最近单任务平均耗时
+
+# 没有历史数据时假设的单任务耗时（秒）
+DEFAULT_JOB_SECONDS = 30.0
+# 单任务耗时的指数滑动平均系数
+JOB_TIME_ALPHA = 0.3
+# 每个实例的 /history 统计刷新间隔（秒）
+JOB_STATS_INTERVAL = 30
+# 最多记住多少条 prompt_id -> 实例 的映射
+MAX_PROMPT_ROUTES = 10000
+
+# prompt_id -> machine_id
+prompt_routes = OrderedDict()
+# machine_id -> {"avg_job_seconds", "seen", "updated"}
+job_stats = {}
+
+def remember_prompt_route(prompt_id, machine_id):
+    """记录 prompt 被分发到哪个实例"""
+    prompt_routes[prompt_id] = machine_id
+    prompt_routes.move_to_end(prompt_id)
+    while len(prompt_routes) > MAX_PROMPT_ROUTES:
+        prompt_routes.popitem(last=False)
+
+def job_times(entry):
+    """从 ComfyUI 历史记录的状态消息中取出开始和结束时间戳（毫秒）"""
+    started = finished = None
+    for message in entry.get("status", {}).get("messages", []):
+        if len(message) < 2 or not isinstance(message[1], dict):
+            continue
+        name, data = message[0], message[1]
+        if name == "execution_start":
+            started = data.get("timestamp")
+        elif name in ("execution_success", "execution_error", "execution_interrupted"):
+            finished = data.get("timestamp")
+    return started, finished
+
+def job_duration(entry):
+    """从 ComfyUI 历史记录的状态消息中取出执行耗时（秒）"""
+    started, finished = job_times(entry)
+    if started is None or finished is None or finished < started:
+        return None
+    return (finished - started) / 1000.0
+
+async def refresh_job_stats(machine_id):
+    """根据实例最近的 /history 更新单任务平均耗时"""
+    inst = instances[machine_id]
+    stats = job_stats.setdefault(machine_id, {"avg_job_seconds": None, "seen": set(), "updated": 0})
+    stats["updated"] = time.time()
+    try:
+        response = await http_client.get(upstream_url(inst, "history", "max_items=20"), timeout=5)
+        history = response.json()
+    except Exception:
+        return
+    for prompt_id, entry in history.items():
+        if prompt_id in stats["seen"]:
+            continue
+        stats["seen"].add(prompt_id)
+        duration = job_duration(entry)
+        if duration is None:
+            continue
+        if stats["avg_job_seconds"] is None:
+            stats["avg_job_seconds"] = duration
+        else:
+            stats["avg_job_seconds"] += JOB_TIME_ALPHA * (duration - stats["avg_job_seconds"])
+    # 只保留最近一批，防止集合无限增长
+    if len(stats["seen"]) > 1000:
+        stats["seen"] = set(history.keys())
+
+async def instance_load(machine_id):
+    """查询实例的队列深度并估算预计等待时间，不可用时返回 None"""
+    inst = instances[machine_id]
+    try:
+        response = await http_client.get(upstream_url(inst, "queue", ""), timeout=2)
+        queue = response.json()
+    except Exception:
+        return None
+
+    stats = job_stats.get(machine_id)
+    if stats is None or time.time() - stats["updated"] > JOB_STATS_INTERVAL:
+        # 后台刷新耗时统计，不拖慢本次分发
+        spawn_task(refresh_job_stats(machine_id))
+    avg = (stats or {}).get("avg_job_seconds") or DEFAULT_JOB_SECONDS
+
+    running = len(queue.get("queue_running", []))
+    pending = len(queue.get("queue_pending", []))
+    return {
+        "machine": machine_id,
+        "running": running,
+        "pending": pending,
+        "avg_job_seconds": round(avg, 2),
+        "estimated_wait": round((running + pending) * avg, 2),
+    }
+
+async def cluster_load():
+    """并发查询所有运行中实例的负载"""
+    # 排空中的实例不再接收新任务
+    candidates = [mid for mid, inst in instances.items() if inst["status"] == "running" and not inst.get("drain")]
+    loads = await asyncio.gather(*(instance_load(mid) for mid in candidates))
+    return [load for load in loads if load is not None]
+
+def pick_instance(loads):
+    """选出预计等待时间最短的实例"""
+    if not loads:
+        return None
+    best = min(loads, key=lambda l: (l["estimated_wait"], l["running"] + l["pending"], l["machine"]))
+    return best["machine"]
+
+@app.get("/dispatch/load")
+async def get_dispatch_load():
+    return {"status": "success", "instances": await cluster_load()}
+
+@app.post("/dispatch/prompt")
+async def dispatch_prompt(request: Request):
+    """把 ComfyUI prompt 分发给负载最低的实例"""
+    try:
+        payload = await request.json()
+    except Exception:
+        return JSONResponse({"status": "error", "message": "请求体不是合法的 JSON"}, status_code=400)
+
+    loads = await cluster_load()
+    machine_id = pick_instance(loads)
+    if machine_id is None:
+        # 都被空闲停止时唤醒一个
+        idle = [machine_id for machine_id, inst in instances.items() if wake_wanted(inst)]
+        if idle and await wake_instance(idle[0]):
+            machine_id = idle[0]
+    if machine_id is None:
+        return JSONResponse({"status": "error", "message": "没有可用的运行中实例"}, status_code=503)
+
+    inst = instances[machine_id]
+    try:
+        response = await http_client.post(upstream_url(inst, "prompt", ""), json=payload, timeout=30)
+        result = response.json()
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": f"{machine_id} 提交失败: {str(e)}"}, status_code=502)
+
+    if response.status_code != 200:
+        # 节点校验错误等原样返回，并注明实例
+        return JSONResponse({"status": "error", "machine": machine_id, **result}, status_code=response.status_code)
+
+    prompt_id = result.get("prompt_id")
+    if prompt_id:
+        remember_prompt_route(prompt_id, machine_id)
+    record_first_prompt(machine_id)
+    mark_used(machine_id)
+    return {
+        "status": "success",
+        "machine": machine_id,
+        "prompt_id": prompt_id,
+        "number": result.get("number"),
+        "node_errors": result.get("node_errors", {}),
+        "ws": f"/m/{machine_id}/ws",
+        "history": f"/m/{machine_id}/history/{prompt_id}",
+    }
+
+@app.get("/dispatch/prompt/{prompt_id}")
+async def get_dispatched_prompt(prompt_id: str):
+    """查询 prompt 所在实例及其历史记录"""
+    machine_id = prompt_routes.get(prompt_id)
+    if machine_id is None or machine_id not in instances:
+        return JSONResponse({"status": "error", "message": f"未知 prompt {prompt_id}"}, status_code=404)
+    history = {}
+    try:
+        response = await http_client.get(upstream_url(instances[machine_id], f"history/{prompt_id}", ""), timeout=5)
+        history = response.json().get(prompt_id, {})
+    except Exception:
+        pass
+    return {"status": "success", "machine": machine_id, "prompt_id": prompt_id, "history": history}
+
+# ---------------- 集群队列与历史 ----------------
+# 把所有运行中实例的 /queue 和 /history 并发拉取后合并成一个视图，每条记录注明所在实例。
+# 上游结果按实例缓存很短的时间，同一时刻的并发请求合并为一次上游请求，
+# 几十个面板同时轮询时每个实例每个周期只会被请求一次。取消和插队不需要知道任务在哪张卡上。
+
+# 上游 /queue、/history 结果的缓存时间（秒）
+CLUSTER_CACHE_TTL = 1.0
+# 合并历史时每个实例最多取多少条
+CLUSTER_HISTORY_ITEMS = 50
+
+# (machine_id, path, query) -> {"boot", "started", "task"}
+upstream_cache = {}
+
+async def fetch_json(url):
+    """GET 上游 JSON，失败时返回 None"""
+    try:
+        response = await http_client.get(url, timeout=5)
+        return response.json() if response.status_code == 200 else None
+    except Exception:
+        return None
+
+async def cached_json(machine_id, path, query=""):
+    """带 TTL 缓存的上游 GET，缓存过期前和请求进行中的调用共用同一个结果"""
+    inst = instances[machine_id]
+    key = (machine_id, path, query)
+    entry = upstream_cache.get(key)
+    # 实例重启后（boot 变化）旧结果作废
+    if entry is None or entry["boot"] != inst.get("boot_id") or time.monotonic() - entry["started"] > CLUSTER_CACHE_TTL:
+        entry = upstream_cache[key] = {
+            "boot": inst.get("boot_id"),
+            "started": time.monotonic(),
+            "task": spawn_task(fetch_json(upstream_url(inst, path, query))),
+        }
+    # shield：某个调用方断开不会取消其他人在等的请求
+    return await asyncio.shield(entry["task"])
+
+def invalidate_cache(machine_id):
+    """实例队列被修改后丢弃它的缓存"""
+    for key in [key for key in upstream_cache if key[0] == machine_id]:
+        upstream_cache.pop(key, None)
+
+def running_instances():
+    return [machine_id for machine_id, inst in instances.items() if inst["status"] == "running"]
+
+def queue_job(machine_id, state, item, position, avg):
+    """把 /queue 中的一项转换为合并视图中的任务"""
+    extra = item[3] if len(item) > 3 and isinstance(item[3], dict) else {}
+    return {
+        "machine": machine_id,
+        "state": state,
+        "prompt_id": item[1],
+        "number": item[0],
+        "client_id": extra.get("client_id"),
+        "position": position,
+        # 按该实例单任务平均耗时估计的开始时间（秒后）
+        "estimated_start": round(position * avg, 2),
+    }
+
+@app.get("/cluster/queue")
+async def get_cluster_queue():
+    """所有实例的队列，按预计开始时间排序"""
+    machine_ids = running_instances()
+    queues = await asyncio.gather(*(cached_json(mid, "queue") for mid in machine_ids))
+    summary = {}
+    jobs = []
+    for machine_id, queue in zip(machine_ids, queues):
+        if queue is None:
+            summary[machine_id] = {"ok": False, "running": 0, "pending": 0}
+            continue
+        avg = (job_stats.get(machine_id) or {}).get("avg_job_seconds") or DEFAULT_JOB_SECONDS
+        running = queue.get("queue_running", [])
+        pending = sorted(queue.get("queue_pending", []), key=lambda item: item[0])
+        summary[machine_id] = {"ok": True, "running": len(running), "pending": len(pending)}
+        jobs += [queue_job(machine_id, "running", item, 0, avg) for item in running]
+        jobs += [queue_job(machine_id, "pending", item, len(running) + i, avg) for i, item in enumerate(pending)]
+    jobs.sort(key=lambda job: (job["state"] != "running", job["estimated_start"], job["machine"], job["number"]))
+    return {"status": "success", "instances": summary, "jobs": jobs}
+
+def history_job(machine_id, prompt_id, entry):
+    """把 /history 中的一项转换为合并视图中的记录"""
+    started, finished = job_times(entry)
+    status = entry.get("status", {})
+    return {
+        "machine": machine_id,
+        "prompt_id": prompt_id,
+        "status": status.get("status_str"),
+        "completed": status.get("completed"),
+        "started": started,
+        "finished": finished,
+        "duration": job_duration(entry),
+        "outputs": list(entry.get("outputs", {}).keys()),
+    }
+
+@app.get("/cluster/history")
+async def get_cluster_history(max_items: int = CLUSTER_HISTORY_ITEMS):
+    """所有实例最近的历史记录，按完成时间倒序"""
+    max_items = max(1, min(max_items, 500))
+    machine_ids = running_instances()
+    histories = await asyncio.gather(*(cached_json(mid, "history", f"max_items={max_items}") for mid in machine_ids))
+    jobs = []
+    for machine_id, history in zip(machine_ids, histories):
+        for prompt_id, entry in (history or {}).items():
+            jobs.append(history_job(machine_id, prompt_id, entry))
+    jobs.sort(key=lambda job: job["finished"] or job["started"] or 0, reverse=True)
+    return {"status": "success", "jobs": jobs[:max_items]}
+
+async def locate_prompt(prompt_id):
+    """查找任务所在实例，返回 (machine_id, "running"|"pending", 队列项)；找不到时返回 None"""
+    # 分发过的任务先查记录下来的实例，其余的直接查所有实例的最新队列
+    hint = prompt_routes.get(prompt_id)
+    machine_ids = running_instances()
+    if hint in machine_ids:
+        machine_ids.remove(hint)
+        machine_ids.insert(0, hint)
+    queues = await asyncio.gather(*(fetch_json(upstream_url(instances[mid], "queue", "")) for mid in machine_ids))
+    for machine_id, queue in zip(machine_ids, queues):
+        for state in ("running", "pending"):
+            for item in (queue or {}).get(f"queue_{state}", []):
+                if len(item) > 1 and item[1] == prompt_id:
+                    return machine_id, state, item
+    return None
+
+@app.post("/cluster/cancel/{prompt_id}")
+async def cancel_cluster_prompt(prompt_id: str):
+    """取消任务：排队中的从队列删除，执行中的中断"""
+    found = await locate_prompt(prompt_id)
+    if found is None:
+        return JSONResponse({"status": "error", "message": f"队列中没有 {prompt_id}"}, status_code=404)
+    machine_id, state, _ = found
+    inst = instances[machine_id]
+    try:
+        if state == "pending":
+            await http_client.post(upstream_url(inst, "queue", ""), json={"delete": [prompt_id]}, timeout=5)
+        else:
+            # 带上 prompt_id，较新的 ComfyUI 只在该任务仍在执行时才中断
+            await http_client.post(upstream_url(inst, "interrupt", ""), json={"prompt_id": prompt_id}, timeout=5)
+    except httpx.HTTPError as e:
+        return JSONResponse({"status": "error", "message": f"{machine_id} 取消失败: {str(e)}"}, status_code=502)
+    invalidate_cache(machine_id)
+    return {"status": "success", "machine": machine_id, "message": f"已取消 {prompt_id}（{machine_id}）"}
+
+@app.post("/cluster/prioritize/{prompt_id}")
+async def prioritize_cluster_prompt(prompt_id: str):
+    """把排队中的任务移到所在实例队首"""
+    found = await locate_prompt(prompt_id)
+    if found is None:
+        return JSONResponse({"status": "error", "message": f"队列中没有 {prompt_id}"}, status_code=404)
+    machine_id, state, item = found
+    if state == "running":
+        return {"status": "success", "machine": machine_id, "message": f"{prompt_id} 已在执行"}
+    if len(item) < 4:
+        return JSONResponse({"status": "error", "message": f"{machine_id} 的队列项缺少 prompt 内容"}, status_code=502)
+
+    # ComfyUI 没有调整顺序的接口：先删除，再用同一个 prompt_id 以 front 方式重新提交
+    inst = instances[machine_id]
+    payload = resubmit_payload(item, prompt_id, front=True)
+    try:
+        await http_client.post(upstream_url(inst, "queue", ""), json={"delete": [prompt_id]}, timeout=5)
+        # 删除前一刻可能已经开始执行，此时不能再重新提交
+        queue = await fetch_json(upstream_url(inst, "queue", ""))
+        if any(len(job) > 1 and job[1] == prompt_id for job in (queue or {}).get("queue_running", [])):
+            invalidate_cache(machine_id)
+            return {"status": "success", "machine": machine_id, "message": f"{prompt_id} 已在执行"}
+        response = await http_client.post(upstream_url(inst, "prompt", ""), json=payload, timeout=30)
+    except httpx.HTTPError as e:
+        return JSONResponse({"status": "error", "message": f"{machine_id} 插队失败: {str(e)}"}, status_code=502)
+    invalidate_cache(machine_id)
+    if response.status_code != 200:
+        return JSONResponse({"status": "error", "machine": machine_id, "message": response.text}, status_code=response.status_code)
+    return {"status": "success", "machine": machine_id, "message": f"{prompt_id} 已移到 {machine_id} 队首"}
+
+# ---------------- 远程节点 ----------------
+# 每台显卡机器运行一份同样的程序作为节点代理（配置 "agent_token" 后开放 /ws/agent），
+# 中心控制器按 "nodes" 配置主动连接各个节点，一条带令牌认证的长连接上同时跑多路请求和推送：
+#   控制器 -> 节点：{"type": "call", "id", "method", "params"}，节点并发处理，按 id 回复 {"type": "result"}
+#   节点 -> 控制器：状态增量（与 /ws/status 相同）、日志行、资源采样
+# 节点上的实例以 "节点id.实例id" 并入控制器的注册表，面板、日志、监控、分发和集群视图都和本机实例一样使用；
+# 启动停止转发给节点执行，HTTP 和 WebSocket 经节点自己的 /m/ 代理访问，ComfyUI 仍只监听节点本机。
+# 连接断开时节点上的实例显示为 offline，按指数退避自动重连，重连后补发断开期间的日志。
+
+# 节点推送日志和资源采样的间隔（秒）
+AGENT_PUSH_INTERVAL = 0.5
+# 长连接的心跳间隔（秒）
+AGENT_PING_INTERVAL = 20
+# 重连退避的初始值和上限（秒）
+NODE_RECONNECT_BASE = 1
+NODE_RECONNECT_MAX = 30
+# 查询类调用的超时（秒），启动停止等生命周期操作不设超时
+NODE_CALL_TIMEOUT = 30
+
+# 连接到本节点的控制器，复用状态推送的有界发送队列
+agent_links = ConnectionManager()
+# websocket -> 推送日志和采样的任务
+agent_pumps = {}
+
+def agent_token_valid(websocket):
+    token = config.get("agent_token") or ""
+    supplied = websocket.headers.get("authorization", "")
+    return bool(token) and hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode())
+
+def agent_snapshot():
+    """本节点的实例列表，远程实例不再向上转发"""
+    return [
+        {"id": machine_id, "spec": inst["spec"], "state": state_store.machine_state(machine_id),
+         "log_seq": get_log_buffer(machine_id).seq}
+        for machine_id, inst in instances.items() if not inst.get("node")
+    ]
+
+async def agent_pump(websocket, since):
+    """定期推送新的日志行和资源采样"""
+    sent_logs = dict(since)
+    sent_metrics = {}
+    while True:
+        for machine_id, inst in list(instances.items()):
+            if inst.get("node"):
+                continue
+            buffer = log_buffers.get(machine_id)
+            if buffer is not None and buffer.seq != sent_logs.get(machine_id, 0):
+                last = sent_logs.get(machine_id, 0)
+                if last > buffer.seq:
+                    # 节点重启过，序号从头开始
+                    last = 0
+                lines = [[line["stream"], line["text"], line["progress"]] for line in buffer.lines if line["seq"] > last]
+                sent_logs[machine_id] = buffer.seq
+                if lines:
+                    agent_links.send(websocket, {"type": "logs", "machine": machine_id, "seq": buffer.seq, "lines": lines})
+            ring = metric_rings.get(machine_id)
+            latest = ring.latest() if ring is not None and inst["process"] is not None else None
+            if latest is not None and latest["time"] != sent_metrics.get(machine_id):
+                sent_metrics[machine_id] = latest["time"]
+                agent_links.send(websocket, {"type": "metrics", "machine": machine_id, "sample": latest})
+        await asyncio.sleep(AGENT_PUSH_INTERVAL)
+
+async def agent_hello(websocket, params):
+    """控制器连上后的第一个调用：返回实例列表并开始推送"""
+    since = {str(k): int(v) for k, v in (params.get("since") or {}).items()}
+    if websocket not in agent_pumps:
+        agent_pumps[websocket] = spawn_task(agent_pump(websocket, since))
+    return {"instances": agent_snapshot()}
+
+async def agent_list(websocket, params):
+    return {"instances": agent_snapshot()}
+
+async def agent_lifecycle(websocket, params):
+    """执行启动、停止、重启，操作结束后才回复"""
+    machine_id = params.get("machine")
+    if machine_id not in instances or instances[machine_id].get("node"):
+        raise ValueError(f"未知实例 {machine_id}")
+    op, task, _ = submit_lifecycle(machine_id, params.get("action"), params.get("drain"))
+    await asyncio.shield(task)
+    return {"status": op["state"], "message": op["message"]}
+
+AGENT_METHODS = {"hello": agent_hello, "list": agent_list, "lifecycle": agent_lifecycle}
+
+async def answer_agent_call(websocket, message):
+    """处理控制器的一个调用，多个调用并发执行"""
+    reply = {"type": "result", "id": message.get("id")}
+    try:
+        handler = AGENT_METHODS.get(message.get("method"))
+        if handler is None:
+            raise ValueError(f"未知方法 {message.get('method')}")
+        reply["result"] = await handler(websocket, message.get("params") or {})
+    except Exception as e:
+        reply["error"] = str(e)
+    agent_links.send(websocket, reply)
+
+@app.websocket("/ws/agent")
+async def websocket_agent(websocket: WebSocket):
+    """节点代理入口：中心控制器通过这里管理本机实例"""
+    if not agent_token_valid(websocket):
+        await websocket.close(code=4401)
+        return
+    await agent_links.connect(websocket)
+    try:
+        while True:
+            message = await websocket.receive_json()
+            if message.get("type") == "call":
+                spawn_task(answer_agent_call(websocket, message))
+    except (WebSocketDisconnect, ValueError):
+        pass
+    finally:
+        agent_links.disconnect(websocket)
+        pump = agent_pumps.pop(websocket, None)
+        if pump is not None:
+            pump.cancel()
+
+def remote_state(inst):
+    """远程实例对外公开的状态，离线时只保留名称"""
+    return {**inst["remote_state"], "name": inst["name"], "node": inst["node"]}
+
+class NodeLink:
+    """到一个节点代理的长连接"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.id = spec["id"]
+        self.websocket = None
+        self.calls = {}
+        self.counter = 0
+        self.synced = False
+        self.task = None
+
+    def machine_id(self, remote_id):
+        return f"{self.id}.{remote_id}"
+
+    def machines(self):
+        return [machine_id for machine_id, inst in instances.items() if inst.get("node") == self.id]
+
+    def start(self):
+        self.task = spawn_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.remove(self.machines())
+
+    async def run(self):
+        """保持连接，断开后退避重连"""
+        url = "ws" + self.spec["url"][len("http"):] + "/ws/agent"
+        headers = {"Authorization": f"Bearer {self.spec['token']}"}
+        delay = NODE_RECONNECT_BASE
+        while True:
+            try:
+                async with websockets.connect(url, additional_headers=headers, max_size=None,
+                                              ping_interval=AGENT_PING_INTERVAL, open_timeout=10) as websocket:
+                    self.websocket = websocket
+                    hello = spawn_task(self.hello(websocket))
+                    try:
+                        async for text in websocket:
+                            await self.handle(json.loads(text))
+                            delay = NODE_RECONNECT_BASE
+                    finally:
+                        hello.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            finally:
+                self.websocket = None
+                self.synced = False
+                for future in self.calls.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError(f"节点 {self.id} 连接断开"))
+                self.calls.clear()
+                await self.mark_offline()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, NODE_RECONNECT_MAX)
+
+    async def call(self, method, params=None, timeout=NODE_CALL_TIMEOUT):
+        """发起一个调用并等待回复"""
+        if self.websocket is None:
+            raise ConnectionError(f"节点 {self.id} 未连接")
+        self.counter += 1
+        call_id = self.counter
+        future = self.calls[call_id] = asyncio.get_running_loop().create_future()
+        try:
+            await self.websocket.send(json.dumps({"type": "call", "id": call_id, "method": method, "params": params or {}}))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.calls.pop(call_id, None)
+
+    async def hello(self, websocket):
+        since = {instances[machine_id]["remote_id"]: instances[machine_id].get("log_seq", 0) for machine_id in self.machines()}
+        try:
+            result = await self.call("hello", {"since": since})
+        except Exception:
+            # 握手失败时断开重连
+            await websocket.close()
+            return
+        await self.sync(result["instances"])
+
+    async def handle(self, message):
+        kind = message.get("type")
+        if kind == "result":
+            future = self.calls.get(message.get("id"))
+            if future is not None and not future.done():
+                if "error" in message:
+                    future.set_exception(RuntimeError(message["error"]))
+                else:
+                    future.set_result(message.get("result"))
+        elif not self.synced:
+            # 连接刚建立，实例列表同步之前的推送以同步结果为准
+            return
+        elif kind == "delta":
+            machine_id = self.machine_id(message["machine"])
+            if message["state"] is None:
+                await self.remove([machine_id])
+            elif machine_id in instances:
+                inst = instances[machine_id]
+                self.apply(inst, message["state"])
+                await publish_state(machine_id)
+                if inst["name"] != f"{message['state']['name']}@{self.id}":
+                    # 节点上改了实例名称
+                    spawn_task(self.refresh())
+            else:
+                # 节点上新增了实例
+                spawn_task(self.refresh())
+        elif kind == "logs":
+            machine_id = self.machine_id(message["machine"])
+            if machine_id in instances:
+                buffer = get_log_buffer(machine_id)
+                for stream, text, progress in message["lines"]:
+                    buffer.append(stream, text, progress=progress)
+                instances[machine_id]["log_seq"] = message["seq"]
+        elif kind == "metrics":
+            machine_id = self.machine_id(message["machine"])
+            if machine_id in instances:
+                metric_rings.setdefault(machine_id, MetricRing()).append(message["sample"])
+
+    async def refresh(self):
+        try:
+            result = await self.call("list")
+        except Exception:
+            return
+        await self.sync(result["instances"])
+
+    def apply(self, inst, state):
+        """把节点推送的状态同步到本地记录"""
+        inst["remote_state"] = state
+        inst["status"] = state["status"]
+        inst["boot_id"] = state.get("boot")
+        inst["drain"] = state.get("drain")
+
+    async def sync(self, items):
+        """按节点的实例列表增删改本地注册表"""
+        global registry_version
+        changed = False
+        seen = set()
+        for item in items:
+            machine_id = self.machine_id(item["id"])
+            seen.add(machine_id)
+            name = f"{item['spec']['name']}@{self.id}"
+            inst = instances.get(machine_id)
+            if inst is None:
+                inst = instances[machine_id] = {
+                    "process": None,
+                    "last_broadcast_status": None,
+                    "node": self.id,
+                    "remote_id": item["id"],
+                    # 新连上的节点从当前位置开始接收日志
+                    "log_seq": item.get("log_seq", 0),
+                }
+                changed = True
+            elif inst["name"] != name:
+                changed = True
+            inst.update(
+                spec={**item["spec"], "id": machine_id}, name=name,
+                port=item["spec"]["port"], gpu=item["spec"]["gpu"],
+                url=f"{self.spec['url']}/m/{item['id']}",
+            )
+            self.apply(inst, item["state"])
+        removed = [machine_id for machine_id in self.machines() if machine_id not in seen]
+        if changed:
+            registry_version += 1
+        self.synced = True
+        for machine_id in seen:
+            await publish_state(machine_id)
+        await self.remove(removed)
+
+    async def remove(self, machine_ids):
+        global registry_version
+        for machine_id in machine_ids:
+            instances.pop(machine_id, None)
+            registry_version += 1
+            await publish_state(machine_id)
+
+    async def mark_offline(self):
+        for machine_id in self.machines():
+            inst = instances[machine_id]
+            self.apply(inst, {**inst["remote_state"], "status": "offline", "drain": None})
+            await publish_state(machine_id)
+
+# node_id -> NodeLink
+nodes = {}
+
+async def sync_nodes():
+    """按配置连接新增的节点，断开删除或修改过的节点"""
+    wanted = {spec["id"]: spec for spec in node_specs(config)}
+    for node_id, link in list(nodes.items()):
+        if wanted.get(node_id) != link.spec:
+            del nodes[node_id]
+            await link.stop()
+    for node_id, spec in wanted.items():
+        if node_id not in nodes:
+            nodes[node_id] = NodeLink(spec)
+            nodes[node_id].start()
+
+async def node_lifecycle(machine_id, action, drain):
+    """把生命周期操作转发给实例所在的节点"""
+    inst = instances[machine_id]
+    link = nodes.get(inst["node"])
+    if link is None:
+        return {"status": "error", "message": f"{machine_id} 所在节点未配置"}
+    return await link.call("lifecycle", {"machine": inst["remote_id"], "action": action, "drain": drain}, timeout=None)
+
+@app.on_event("startup")
+async def startup_event():
+    """启动时创建状态检查任务"""
+    global http_client
+    install_child_watcher()
+    http_client = create_http_client()
+    await adopt_processes()
+    asyncio.create_task(check_instance_status())
+    asyncio.create_task(collect_metrics())
+    asyncio.create_task(learn_model_files())
+    asyncio.create_task(monitor_loop_lag())
+    asyncio.create_task(check_idle())
+    await sync_nodes()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭上游连接池"""
+    prewarmer.closing = True
+    for link in list(nodes.values()):
+        await link.stop()
+    if http_client is not None:
+        await http_client.aclose()
+
+@app.websocket("/ws/status")
+async def websocket_endpoint(websocket: WebSocket, epoch: str = "", since: int = -1):
+    # 先把所有机器的最新状态发布出去，保证快照与其他客户端看到的一致
+    for machine_id in instances:
+        await publish_state(machine_id)
+    await manager.connect(websocket)
+    try:
+        # 能续传就只补发缺失的增量，否则发送全量快照
+        deltas = state_store.deltas_since(epoch, since) if epoch else None
+        if deltas is None:
+            manager.send(websocket, state_store.snapshot())
+        else:
+            for delta in deltas:
+                manager.send(websocket, delta)
+        
+        # 保持连接开放
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(websocket)
+
+# ---------------- 控制面板页面 ----------------
+# 页面外壳只依赖注册表，每个注册表版本渲染一次；CSS/JS 拆成独立静态资源，
+# URL 带内容哈希可以长期缓存。所有资源预先压缩好 gzip（以及可用时的 brotli），
+# 带强 ETag，浏览器重新验证时直接返回 304。
+
+DASHBOARD_CSS = """    html, body {
         margin: 0;
         padding: 0;
         height: 100%;
@@ -217,13 +3786,13 @@ def index(request: Request):
         overflow: hidden;
         font-family: Arial, sans-serif;
         background-color: #000;
-    }}
-    iframe {{
+    }
+    iframe {
         width: 100%;
         height: 100%;
         border: none;
-    }}
-    .buttons {{
+    }
+    .buttons {
         position: fixed;
         bottom: 40px;
         right: 20px;
@@ -236,8 +3805,8 @@ def index(request: Request):
         display: flex;
         align-items: center;
         user-select: none;
-    }}
-    .drag-handle {{
+    }
+    .drag-handle {
         width: 14px;
         height: 20px;
         display: grid;
@@ -246,16 +3815,16 @@ def index(request: Request):
         gap: 2px;
         margin-right: 1px;
         cursor: grab;
-    }}
-    .drag-handle div {{
+    }
+    .drag-handle div {
         width: 4px;
         height: 4px;
         border-radius: 50%;
         background-color: #333;
         justify-self: center;
         align-self: center;
-    }}
-    .buttons button {{
+    }
+    .buttons button {
         margin: 0 4px;
         padding: 10px 10px;
         cursor: pointer;
@@ -265,45 +3834,103 @@ def index(request: Request):
         color: white;
         font-size:13px;
         transition: background-color 0.3s;
-    }}
-    .buttons button:hover {{
+    }
+    .buttons button:hover {
         background-color: #ab8ed7 !important;
-    }}
-    .buttons button.selected {{
+    }
+    .buttons button.selected {
         background-color: #6f40b5;
-    }}
-    .buttons button:disabled {{
+    }
+    .buttons button:disabled {
         cursor: not-allowed;
-    }}
-    .status {{
+    }
+    .status {
         margin: 0 2px;
         font-weight: bold;
         color: #333;
         min-width: 20px;
-    }}
-    .status-indicator {{
+    }
+    .status-indicator {
         display: inline-block;
         width: 10px;
         height: 10px;
         border-radius: 50%;
         margin-right: 5px;
-    }}
-    .status-stopped {{
+    }
+    .status-stopped {
         background-color: #999;
-    }}
-    .status-starting {{
+    }
+    .status-starting {
         background-color: #fd7e14;
         animation: pulse 1.5s infinite;
-    }}
-    .status-running {{
+    }
+    .status-running {
         background-color: #28a745;
-    }}
-    @keyframes pulse {{
-        0% {{ opacity: 1; }}
-        50% {{ opacity: 0.5; }}
-        100% {{ opacity: 1; }}
-    }}
-    #drag-mask {{
+    }
+    .status-offline {
+        background-color: #dc3545;
+    }
+    @keyframes pulse {
+        0% { opacity: 1; }
+        50% { opacity: 0.5; }
+        100% { opacity: 1; }
+    }
+    #log-panel {
+        position: fixed;
+        left: 20px;
+        right: 20px;
+        bottom: 110px;
+        height: 40vh;
+        background: rgba(0, 0, 0, 0.92);
+        border: 1px solid #333;
+        border-radius: 8px;
+        z-index: 998;
+        display: none;
+        overflow: auto;
+    }
+    #log-content {
+        padding: 10px;
+        color: #ccc;
+        font: 12px/1.4 Consolas, monospace;
+        white-space: pre-wrap;
+        word-break: break-all;
+    }
+    #log-content .log-stderr {
+        color: #e0a0a0;
+    }
+    #log-content .log-controller {
+        color: #ab8ed7;
+    }
+    #metrics-panel {
+        position: fixed;
+        right: 20px;
+        bottom: 110px;
+        width: 320px;
+        padding: 10px;
+        background: rgba(0, 0, 0, 0.92);
+        border: 1px solid #333;
+        border-radius: 8px;
+        z-index: 998;
+        display: none;
+        color: #ccc;
+        font-size: 12px;
+    }
+    .metric-row {
+        display: flex;
+        align-items: center;
+        justify-content: space-between;
+        margin: 4px 0;
+    }
+    .metric-row svg {
+        width: 160px;
+        height: 24px;
+    }
+    .metric-row polyline {
+        fill: none;
+        stroke: #ab8ed7;
+        stroke-width: 1.5;
+    }
+    #drag-mask {
         position: fixed;
         top: 0;
         left: 0;
@@ -313,8 +3940,8 @@ def index(request: Request):
         display: none;
         background: transparent;
         cursor: grabbing;
-    }}
-    .status-overlay {{
+    }
+    .status-overlay {
         position: fixed;
         top: 50%;
         left: 50%;
@@ -325,8 +3952,8 @@ def index(request: Request):
         text-align: center;
         display: none;
         font-size: 20px;
-    }}
-    .loader {{
+    }
+    .loader {
         border: 5px solid #f3f3f3;
         border-top: 5px solid #3498db;
         border-radius: 50%;
@@ -334,101 +3961,158 @@ def index(request: Request):
         height: 50px;
         animation: spin 1s linear infinite;
         margin: 0 auto 15px;
-    }}
-    @keyframes spin {{
-        0% {{ transform: rotate(0deg); }}
-        100% {{ transform: rotate(360deg); }}
-    }}
-</style>
-</head>
-<body>
-<!-- 状态覆盖层 -->
-<div class="status-overlay" id="status-overlay">
-    <div class="loader" id="overlay-loader"></div>
-    <div id="overlay-text">程序未启动</div>
-</div>
-
-<!-- iframe 容器 -->
-<div id="iframe-container" style="width: 100%; height: 100%;">
-    <iframe id="iframe-5090" style="display: none;" src="http://localhost:5090?cb={cache_buster}"></iframe>
-    <iframe id="iframe-4090" style="display: none;" src="http://localhost:4090?cb={cache_buster}"></iframe>
-</div>
-
-<!-- 悬浮按钮 -->
-<div class="buttons" id="floating-buttons">
-    <div class="drag-handle" id="drag-handle">
-        <div></div><div></div>
-        <div></div><div></div>
-    </div>
-    
-    <button id="btn-5090" onclick="selectMachine('5090')" class="selected" style="font-size: 15px;font-weight: bold; width:90px;">
-        <span id="status-indicator-5090" class="status-indicator status-stopped"></span>&ensp;5090 
-    </button>
-    <button id="btn-4090" onclick="selectMachine('4090')" style="font-size: 15px;font-weight: bold; width:90px;">
-        <span id="status-indicator-4090" class="status-indicator status-stopped"></span>&ensp; 4090
-    </button>
-
-    <button id="btn-start" onclick="startInstance()" style="width:50px;">启动</button>
-    <button id="btn-stop" onclick="stopInstance()" style="width:50px;">关闭</button>
-    <button id="btn-restart" onclick="restartInstance()" style="width:50px;">重启</button>
-</div>
-
-<div id="drag-mask"></div>
+    }
+    @keyframes spin {
+        0% { transform: rotate(0deg); }
+        100% { transform: rotate(360deg); }
+    }
+"""
 
-<script>
-let currentMachine = '5090';
-let statusCheckInterval;
-let machineLoaded = {{
-    '5090': false,
-    '4090': false
-}};
+DASHBOARD_JS = """let currentMachine = localStorage.getItem('current-machine') || '';
+// 每台机器的 iframe 已加载的启动批次
+let machineLoaded = {};
+// 服务端推送的机器状态，页面只根据它渲染
+let machineStates = {};
+let stateEpoch = null;
+let stateSeq = 0;
 
-// WebSocket连接
+// WebSocket连接：首次连接收到全量快照，之后只收增量，重连时从上次的序号续传
 let socket = null;
-function connectWebSocket() {{
+let reconnectDelay = 1000;
+function connectWebSocket() {
     if (socket) return;
     
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = protocol + '//' + window.location.host + '/ws/status';
+    let wsUrl = protocol + '//' + window.location.host + '/ws/status';
+    if (stateEpoch) {
+        wsUrl += '?epoch=' + stateEpoch + '&since=' + stateSeq;
+    }
     
-    try {{
+    try {
         socket = new WebSocket(wsUrl);
         
-        socket.onmessage = function(event) {{
+        socket.onopen = function() {
+            reconnectDelay = 1000;
+        };
+        
+        socket.onmessage = function(event) {
             const data = JSON.parse(event.data);
-            if (data.type === 'status_update') {{
-                updateStatusIndicator(data.machine, data.status);
-                if (data.machine === currentMachine) {{
+            if (data.type === 'snapshot') {
+                stateEpoch = data.epoch;
+                stateSeq = data.seq;
+                machineStates = data.machines;
+                // 删除快照中已不存在的机器
+                document.querySelectorAll('.machine-btn').forEach(btn => {
+                    const machine = btn.id.substring(4);
+                    if (!(machine in machineStates)) removeMachine(machine);
+                });
+                for (const machine in machineStates) {
+                    ensureMachine(machine, machineStates[machine]);
+                }
+                if (!(currentMachine in machineStates)) {
+                    currentMachine = Object.keys(machineStates)[0] || '';
+                }
+                selectMachine(currentMachine);
+            } else if (data.type === 'delta') {
+                if (data.seq <= stateSeq) return;
+                stateSeq = data.seq;
+                if (data.state === null) {
+                    // 实例已从注册表删除
+                    delete machineStates[data.machine];
+                    removeMachine(data.machine);
+                    if (data.machine === currentMachine) {
+                        selectMachine(Object.keys(machineStates)[0] || '');
+                    }
+                    return;
+                }
+                machineStates[data.machine] = data.state;
+                ensureMachine(data.machine, data.state);
+                if (data.machine === currentMachine) {
                     updateUI();
-                }}
-            }}
-        }};
+                }
+            } else if (data.type === 'operation' && data.state === 'error' && data.machine === currentMachine) {
+                // 操作失败时在覆盖层显示原因
+                const overlay = document.getElementById('status-overlay');
+                overlay.style.display = 'block';
+                document.getElementById('overlay-text').textContent = data.message;
+                document.getElementById('overlay-loader').style.display = 'none';
+            }
+        };
         
-        socket.onclose = function() {{
+        socket.onclose = function() {
             socket = null;
-            // 尝试重新连接
-            setTimeout(connectWebSocket, 3000);
-        }};
-    }} catch (error) {{
+            // 尝试重新连接，失败越多等待越久
+            setTimeout(connectWebSocket, reconnectDelay);
+            reconnectDelay = Math.min(reconnectDelay * 2, 30000);
+        };
+    } catch (error) {
         console.error('WebSocket连接失败:', error);
-    }}
-}}
+    }
+}
+
+function ensureMachine(machine, state) {
+    // 按需创建机器按钮和 iframe，结构与服务端 render_machine_button 一致
+    let btn = document.getElementById('btn-' + machine);
+    if (!btn) {
+        btn = document.createElement('button');
+        btn.id = 'btn-' + machine;
+        btn.className = 'machine-btn';
+        btn.style.cssText = 'font-size: 15px;font-weight: bold; width:90px;';
+        btn.onclick = () => clickMachine(machine);
+        btn.innerHTML = '<span class="status-indicator"></span>&ensp;<span class="machine-name"></span>';
+        btn.firstChild.id = 'status-indicator-' + machine;
+        document.getElementById('machine-buttons').appendChild(btn);
+        
+        const iframe = document.createElement('iframe');
+        iframe.id = 'iframe-' + machine;
+        iframe.style.display = 'none';
+        iframe.src = 'about:blank';
+        document.getElementById('iframe-container').appendChild(iframe);
+    }
+    btn.querySelector('.machine-name').textContent = state.name;
+    updateStatusIndicator(machine, state.status);
+}
+
+function removeMachine(machine) {
+    ['btn-', 'iframe-'].forEach(prefix => {
+        const el = document.getElementById(prefix + machine);
+        if (el) el.remove();
+    });
+    delete machineLoaded[machine];
+}
 
-function selectMachine(machine) {{
+// 用户点击机器按钮：切换过去，空闲停止的实例顺便唤醒。
+// 快照和重连时也会调用 selectMachine，不能在那里唤醒，否则开着的页面会让空闲停止失效
+function clickMachine(machine) {
+    selectMachine(machine);
+    const state = machineStates[machine];
+    if (state && state.status === 'stopped' && state.idle) {
+        startInstance();
+    }
+}
+
+function selectMachine(machine) {
     currentMachine = machine;
+    localStorage.setItem('current-machine', machine);
+    
+    document.querySelectorAll('.machine-btn').forEach(btn => btn.classList.remove('selected'));
+    const btn = document.getElementById('btn-' + machine);
+    if (btn) btn.classList.add('selected');
     
-    document.getElementById('btn-5090').classList.remove('selected');
-    document.getElementById('btn-4090').classList.remove('selected');
-    document.getElementById('btn-' + machine).classList.add('selected');
+    // 日志面板打开时跟随切换
+    if (logMachine !== null && logMachine !== machine) {
+        openLogs(machine);
+    }
     
     updateUI();
-}}
+}
 
-function updateStatusIndicator(machine, status) {{
+function updateStatusIndicator(machine, status) {
     const indicator = document.getElementById('status-indicator-' + machine);
+    if (!indicator) return;
     indicator.className = 'status-indicator';
     
-    switch(status) {{
+    switch(status) {
         case 'stopped':
             indicator.classList.add('status-stopped');
             break;
@@ -438,67 +4122,87 @@ function updateStatusIndicator(machine, status) {{
         case 'running':
             indicator.classList.add('status-running');
             break;
-    }}
-}}
-
-function updateUI() {{
-    fetch('/status/' + currentMachine)
-        .then(response => response.json())
-        .then(data => {{
-            const status = data.status;
-            const overlay = document.getElementById('status-overlay');
-            const overlayText = document.getElementById('overlay-text');
-            const overlayLoader = document.getElementById('overlay-loader');
-            const iframe5090 = document.getElementById('iframe-5090');
-            const iframe4090 = document.getElementById('iframe-4090');
-            
-            // 隐藏所有iframe
-            iframe5090.style.display = 'none';
-            iframe4090.style.display = 'none';
+        case 'offline':
+            indicator.classList.add('status-offline');
+            break;
+    }
+}
+
+function updateUI() {
+    const state = machineStates[currentMachine];
+    const overlay = document.getElementById('status-overlay');
+    const overlayText = document.getElementById('overlay-text');
+    const overlayLoader = document.getElementById('overlay-loader');
+    
+    // 隐藏所有iframe
+    document.querySelectorAll('#iframe-container iframe').forEach(iframe => iframe.style.display = 'none');
+    
+    if (!state) {
+        overlay.style.display = 'block';
+        overlayText.textContent = '没有可用实例';
+        overlayLoader.style.display = 'none';
+        return;
+    }
+    const status = state.status;
+    
+    switch(status) {
+        case 'stopped':
+            overlay.style.display = 'block';
+            overlayText.textContent = watchdogText(state.watchdog) || (state.idle ? '空闲已自动停止，打开时自动启动' : '程序未启动');
+            overlayLoader.style.display = 'none';
+            break;
+        case 'starting':
+            overlay.style.display = 'block';
+            overlayText.textContent = state.phase ? '启动中... (' + state.phase + ')' : '启动中...';
+            overlayLoader.style.display = 'block';
+            break;
+        case 'offline':
+            overlay.style.display = 'block';
+            overlayText.textContent = '节点 ' + state.node + ' 离线，正在重连...';
+            overlayLoader.style.display = 'none';
+            break;
+        case 'running':
+            overlay.style.display = 'none';
+            // 显示当前机器的iframe
+            const iframeId = 'iframe-' + currentMachine;
+            const iframeElement = document.getElementById(iframeId);
             
-            switch(status) {{
-                case 'stopped':
-                    overlay.style.display = 'block';
-                    overlayText.textContent = '程序未启动';
-                    overlayLoader.style.display = 'none';
-                    machineLoaded[currentMachine] = false;
-                    break;
-                case 'starting':
-                    overlay.style.display = 'block';
-                    overlayText.textContent = '启动中...';
-                    overlayLoader.style.display = 'block';
-                    machineLoaded[currentMachine] = false;
-                    break;
-                case 'running':
-                    overlay.style.display = 'none';
-                    // 显示当前机器的iframe
-                    const iframeId = 'iframe-' + currentMachine;
-                    const iframeElement = document.getElementById(iframeId);
-                    
-                    // 如果iframe尚未加载，强制重新加载
-                    if (!machineLoaded[currentMachine]) {{
-                        // 添加时间戳参数防止缓存
-                        const timestamp = new Date().getTime();
-                        const newUrl = iframeElement.src.split('?')[0] + '?cb=' + timestamp;
-                        iframeElement.src = newUrl;
-                        machineLoaded[currentMachine] = true;
-                    }}
-                    
-                    iframeElement.style.display = 'block';
-                    break;
-            }}
+            // 只有实例真正重新启动过（boot 变化）才重新加载 iframe
+            if (machineLoaded[currentMachine] !== state.boot) {
+                iframeElement.src = '/m/' + currentMachine + '/?boot=' + state.boot;
+                machineLoaded[currentMachine] = state.boot;
+            }
             
-            // 更新按钮状态
-            updateButtonStatus(status);
-        }});
-}}
+            iframeElement.style.display = 'block';
+            break;
+    }
+    
+    // 更新按钮状态
+    updateButtonStatus(status);
+}
+
+function watchdogText(wd) {
+    if (!wd) return '';
+    switch(wd.state) {
+        case 'killing':
+            return '看门狗: ' + wd.reason + '，正在结束进程...';
+        case 'backoff':
+            const seconds = Math.max(0, Math.round(wd.retry_at - Date.now() / 1000));
+            return '看门狗: ' + wd.reason + '，约 ' + seconds + ' 秒后自动重启（第 ' + wd.restarts + ' 次）';
+        case 'tripped':
+            return '看门狗: 频繁崩溃，已暂停自动重启（' + wd.reason + '）';
+        case 'failed':
+            return '看门狗: 自动重启失败（' + wd.reason + '）';
+    }
+    return '';
+}
 
-function updateButtonStatus(status) {{
+function updateButtonStatus(status) {
     const startBtn = document.getElementById('btn-start');
     const stopBtn = document.getElementById('btn-stop');
     const restartBtn = document.getElementById('btn-restart');
     
-    switch(status) {{
+    switch(status) {
         case 'stopped':
             startBtn.disabled = false;
             stopBtn.disabled = true;
@@ -514,10 +4218,15 @@ function updateButtonStatus(status) {{
             stopBtn.disabled = false;
             restartBtn.disabled = false;
             break;
-    }}
-}}
+        case 'offline':
+            startBtn.disabled = true;
+            stopBtn.disabled = true;
+            restartBtn.disabled = true;
+            break;
+    }
+}
 
-async function startInstance() {{
+async function startInstance() {
     const overlay = document.getElementById('status-overlay');
     const overlayText = document.getElementById('overlay-text');
     const overlayLoader = document.getElementById('overlay-loader');
@@ -526,16 +4235,15 @@ async function startInstance() {{
     overlayText.textContent = '启动中...';
     overlayLoader.style.display = 'block';
     
-    try {{
+    try {
         await fetch('/start/' + currentMachine);
-        startStatusCheck();
-    }} catch (error) {{
+    } catch (error) {
         overlayText.textContent = '启动失败: ' + error;
         overlayLoader.style.display = 'none';
-    }}
-}}
+    }
+}
 
-async function stopInstance() {{
+async function stopInstance() {
     const overlay = document.getElementById('status-overlay');
     const overlayText = document.getElementById('overlay-text');
     const overlayLoader = document.getElementById('overlay-loader');
@@ -544,18 +4252,151 @@ async function stopInstance() {{
     overlayText.textContent = '停止中...';
     overlayLoader.style.display = 'block';
     
-    try {{
+    try {
         await fetch('/stop/' + currentMachine);
-        // 重置加载状态
-        machineLoaded[currentMachine] = false;
-        startStatusCheck();
-    }} catch (error) {{
+    } catch (error) {
         overlayText.textContent = '停止失败: ' + error;
         overlayLoader.style.display = 'none';
-    }}
-}}
+    }
+}
+
+// 批量启动和停止，实例状态通过 /ws/status 更新
+async function startAll() {
+    await fetch('/start_all');
+}
+
+async function stopAll() {
+    if (confirm('确定停止所有实例？')) {
+        await fetch('/stop_all');
+    }
+}
+
+// 日志面板：通过 /ws/logs 跟随当前机器的输出
+const MAX_LOG_LINES = 2000;
+let logSocket = null;
+let logMachine = null;
 
-async function restartInstance() {{
+function toggleLogs() {
+    const panel = document.getElementById('log-panel');
+    if (panel.style.display === 'block') {
+        panel.style.display = 'none';
+        closeLogs();
+        return;
+    }
+    panel.style.display = 'block';
+    openLogs(currentMachine);
+}
+
+function closeLogs() {
+    if (logSocket) {
+        logSocket.onclose = null;
+        logSocket.close();
+        logSocket = null;
+    }
+    logMachine = null;
+}
+
+function openLogs(machine) {
+    closeLogs();
+    if (!machine) return;
+    logMachine = machine;
+    document.getElementById('log-content').textContent = '';
+    
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    logSocket = new WebSocket(protocol + '//' + window.location.host + '/ws/logs/' + machine + '?tail=500');
+    logSocket.onmessage = function(event) {
+        const data = JSON.parse(event.data);
+        const panel = document.getElementById('log-panel');
+        const atBottom = panel.scrollTop + panel.clientHeight >= panel.scrollHeight - 5;
+        if (data.type === 'dropped') {
+            appendLogLine({stream: 'controller', text: '... 跳过 ' + data.count + ' 行 ...'});
+        } else if (data.type === 'lines') {
+            data.lines.forEach(appendLogLine);
+        }
+        if (atBottom) {
+            panel.scrollTop = panel.scrollHeight;
+        }
+    };
+    logSocket.onclose = function() {
+        // 连接断开后稍后重连，重连会重新发送尾部
+        const machine = logMachine;
+        logSocket = null;
+        setTimeout(() => {
+            if (logMachine === machine && !logSocket) openLogs(machine);
+        }, 3000);
+    };
+}
+
+function appendLogLine(line) {
+    const content = document.getElementById('log-content');
+    if (line.replace && content.lastChild) {
+        content.lastChild.remove();
+    }
+    const div = document.createElement('div');
+    div.className = 'log-' + line.stream;
+    div.textContent = line.text;
+    content.appendChild(div);
+    while (content.childNodes.length > MAX_LOG_LINES) {
+        content.firstChild.remove();
+    }
+}
+
+// 资源监控面板：打开时每 5 秒拉取一次降采样后的历史
+const METRIC_ROWS = [
+    ['cpu_percent', 'CPU', v => v.toFixed(0) + '%'],
+    ['rss_bytes', '内存', v => (v / 1073741824).toFixed(2) + ' GB'],
+    ['gpu_memory_bytes', '显存', v => (v / 1073741824).toFixed(2) + ' GB'],
+    ['gpu_utilization', 'GPU', v => v.toFixed(0) + '%'],
+    ['handles', '句柄', v => v.toFixed(0)],
+];
+let metricsTimer = null;
+
+function toggleMetrics() {
+    const panel = document.getElementById('metrics-panel');
+    if (panel.style.display === 'block') {
+        panel.style.display = 'none';
+        clearInterval(metricsTimer);
+        metricsTimer = null;
+        return;
+    }
+    panel.style.display = 'block';
+    refreshMetrics();
+    metricsTimer = setInterval(refreshMetrics, 5000);
+}
+
+async function refreshMetrics() {
+    const machine = currentMachine;
+    if (!machine) return;
+    const response = await fetch('/metrics/history/' + machine + '?points=60&seconds=300');
+    const data = await response.json();
+    const panel = document.getElementById('metrics-panel');
+    panel.textContent = '';
+    const title = document.createElement('div');
+    title.textContent = (machineStates[machine] ? machineStates[machine].name : machine) + ' · 最近 5 分钟';
+    panel.appendChild(title);
+    for (const [field, label, format] of METRIC_ROWS) {
+        const column = data.fields.indexOf(field);
+        const values = (data.samples || []).map(row => row[column]).filter(v => v !== null);
+        if (!values.length) continue;
+        const row = document.createElement('div');
+        row.className = 'metric-row';
+        row.innerHTML = '<span></span><svg viewBox="0 0 100 24" preserveAspectRatio="none"><polyline></polyline></svg><span></span>';
+        row.children[0].textContent = label;
+        row.children[2].textContent = format(values[values.length - 1]);
+        row.querySelector('polyline').setAttribute('points', sparklinePoints(values));
+        panel.appendChild(row);
+    }
+}
+
+function sparklinePoints(values) {
+    const max = Math.max(...values);
+    const min = Math.min(...values);
+    const range = max - min || 1;
+    const step = values.length > 1 ? 100 / (values.length - 1) : 0;
+    return values.map((v, i) => (i * step).toFixed(1) + ',' + (22 - (v - min) / range * 20).toFixed(1)).join(' ');
+}
+
+async function restartInstance() {
     const overlay = document.getElementById('status-overlay');
     const overlayText = document.getElementById('overlay-text');
     const overlayLoader = document.getElementById('overlay-loader');
@@ -564,63 +4405,19 @@ async function restartInstance() {{
     overlayText.textContent = '重启中...';
     overlayLoader.style.display = 'block';
     
-    try {{
-        // 重置加载状态
-        machineLoaded[currentMachine] = false;
+    try {
         await fetch('/restart/' + currentMachine);
-        startStatusCheck();
-    }} catch (error) {{
+    } catch (error) {
         overlayText.textContent = '重启失败: ' + error;
         overlayLoader.style.display = 'none';
-    }}
-}}
-
-function startStatusCheck() {{
-    if (statusCheckInterval) {{
-        clearInterval(statusCheckInterval);
-    }}
-    
-    statusCheckInterval = setInterval(() => {{
-        updateUI();
-        
-        // 更新所有机器的状态指示器
-        fetch('/status/5090')
-            .then(response => response.json())
-            .then(data => updateStatusIndicator('5090', data.status));
-            
-        fetch('/status/4090')
-            .then(response => response.json())
-            .then(data => updateStatusIndicator('4090', data.status));
-            
-        fetch('/status/' + currentMachine)
-            .then(response => response.json())
-            .then(data => {{
-                if (data.status === 'running') {{
-                    clearInterval(statusCheckInterval);
-                }}
-            }});
-    }}, 1000);
-}}
+    }
+}
 
 // 初始化页面
-document.addEventListener('DOMContentLoaded', function() {{
-    // 连接WebSocket
+document.addEventListener('DOMContentLoaded', function() {
+    // 所有状态都来自 WebSocket 推送，不再轮询
     connectWebSocket();
-    
-    updateUI();
-    
-    // 初始获取所有机器的状态
-    fetch('/status/5090')
-        .then(response => response.json())
-        .then(data => updateStatusIndicator('5090', data.status));
-        
-    fetch('/status/4090')
-        .then(response => response.json())
-        .then(data => updateStatusIndicator('4090', data.status));
-        
-    // 启动状态检查
-    startStatusCheck();
-}});
+});
 
 // 拖动逻辑
 const dragElement = document.getElementById("floating-buttons");
@@ -630,14 +4427,14 @@ let isDragging = false, offsetX = 0, offsetY = 0;
 
 const savedLeft = localStorage.getItem("floating-left");
 const savedTop = localStorage.getItem("floating-top");
-if (savedLeft && savedTop) {{
+if (savedLeft && savedTop) {
     dragElement.style.left = savedLeft + "px";
     dragElement.style.top = savedTop + "px";
     dragElement.style.bottom = "auto";
     dragElement.style.right = "auto";
-}}
+}
 
-handle.addEventListener("mousedown", function(e) {{
+handle.addEventListener("mousedown", function(e) {
     if (e.button !== 0) return;
     isDragging = true;
     const rect = dragElement.getBoundingClientRect();
@@ -651,9 +4448,9 @@ handle.addEventListener("mousedown", function(e) {{
     document.addEventListener("mouseup", onMouseUp);
 
     e.preventDefault();
-}});
+});
 
-function onMouseMove(e) {{
+function onMouseMove(e) {
     if (!isDragging) return;
     let left = e.clientX - offsetX;
     let top = e.clientY - offsetY;
@@ -667,9 +4464,9 @@ function onMouseMove(e) {{
     dragElement.style.top = top + "px";
     dragElement.style.bottom = "auto";
     dragElement.style.right = "auto";
-}}
+}
 
-function onMouseUp() {{
+function onMouseUp() {
     if (!isDragging) return;
     isDragging = false;
     dragMask.style.display = "none";
@@ -680,46 +4477,397 @@ function onMouseUp() {{
 
     document.removeEventListener("mousemove", onMouseMove);
     document.removeEventListener("mouseup", onMouseUp);
-}}
-</script>
+}
+"""
+
+class StaticAsset:
+    """内存中的静态资源，预先计算 ETag 和压缩版本"""
+
+    def __init__(self, body, media_type, cache_control, gzip_level=9, brotli_quality=11):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:20] + '"'
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=gzip_level, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=brotli_quality)
+
+    @property
+    def version(self):
+        return self.etag.strip('"')[:12]
+
+def accepted_encoding(request, available):
+    """从 Accept-Encoding 中选出最合适的编码"""
+    accepted = {}
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ("br", "gzip"):
+        if encoding in available and accepted.get(encoding, 0) > 0:
+            return encoding
+    return "identity"
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get("if-none-match", "")
+    return if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]
+
+def serve_asset(request, asset):
+    """按协商结果返回资源，未变化时返回 304"""
+    headers = {"ETag": asset.etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+    if etag_matches(request, asset.etag):
+        return Response(status_code=304, headers=headers)
+    encoding = accepted_encoding(request, asset.bodies)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(asset.bodies[encoding], media_type=asset.media_type, headers=headers)
+
+# 带哈希的 URL 内容不会变，可以长期缓存
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+static_assets = {
+    "dashboard.css": StaticAsset(DASHBOARD_CSS, "text/css; charset=utf-8", STATIC_CACHE_CONTROL),
+    "dashboard.js": StaticAsset(DASHBOARD_JS, "application/javascript; charset=utf-8", STATIC_CACHE_CONTROL),
+}
+
+# 已渲染的页面外壳：(注册表版本, StaticAsset)
+page_cache = {"version": None, "asset": None}
+
+def render_machine_button(machine_id, inst):
+    """生成机器切换按钮，结构与页面脚本中的 ensureMachine 一致"""
+    return (
+        f'    <button id="btn-{machine_id}" class="machine-btn" onclick="clickMachine(\'{machine_id}\')" '
+        f'style="font-size: 15px;font-weight: bold; width:90px;">\n'
+        f'        <span id="status-indicator-{machine_id}" class="status-indicator status-stopped"></span>'
+        f'&ensp;<span class="machine-name">{html.escape(inst["name"])}</span>\n'
+        f'    </button>'
+    )
+
+def render_page():
+    """渲染页面外壳（状态由 WebSocket 快照填充，不写进页面）"""
+    # 按注册表生成机器按钮和 iframe，iframe 在实例运行后才加载
+    buttons_html = "\n".join(render_machine_button(machine_id, inst) for machine_id, inst in instances.items())
+    iframes_html = "\n".join(
+        f'    <iframe id="iframe-{machine_id}" style="display: none;" src="about:blank"></iframe>'
+        for machine_id in instances
+    )
+    css_url = f"/static/dashboard.css?v={static_assets['dashboard.css'].version}"
+    js_url = f"/static/dashboard.js?v={static_assets['dashboard.js'].version}"
+    
+    return f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<title>ComfyUI 多端口切换</title>
+<link rel="stylesheet" href="{css_url}">
+</head>
+<body>
+<!-- 状态覆盖层 -->
+<div class="status-overlay" id="status-overlay">
+    <div class="loader" id="overlay-loader"></div>
+    <div id="overlay-text">程序未启动</div>
+</div>
+
+<!-- iframe 容器 -->
+<div id="iframe-container" style="width: 100%; height: 100%;">
+{iframes_html}
+</div>
+
+<!-- 悬浮按钮 -->
+<div class="buttons" id="floating-buttons">
+    <div class="drag-handle" id="drag-handle">
+        <div></div><div></div>
+        <div></div><div></div>
+    </div>
+    
+    <div id="machine-buttons" style="display: contents;">
+{buttons_html}
+    </div>
+
+    <button id="btn-start" onclick="startInstance()" style="width:50px;">启动</button>
+    <button id="btn-stop" onclick="stopInstance()" style="width:50px;">关闭</button>
+    <button id="btn-restart" onclick="restartInstance()" style="width:50px;">重启</button>
+    <button id="btn-start-all" onclick="startAll()" style="width:50px;">全开</button>
+    <button id="btn-stop-all" onclick="stopAll()" style="width:50px;">全关</button>
+    <button id="btn-logs" onclick="toggleLogs()" style="width:50px;">日志</button>
+    <button id="btn-metrics" onclick="toggleMetrics()" style="width:50px;">监控</button>
+</div>
+
+<!-- 资源监控面板 -->
+<div id="metrics-panel"></div>
+
+<!-- 日志面板 -->
+<div id="log-panel"><div id="log-content"></div></div>
+
+<div id="drag-mask"></div>
+
+<script src="{js_url}"></script>
 </body>
 </html>
-    """
-    return HTMLResponse(content=html_content)
+"""
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    if page_cache["version"] != registry_version:
+        # 页面每次都重新验证，注册表未变化时返回 304
+        page_cache["asset"] = StaticAsset(render_page(), "text/html; charset=utf-8", "no-cache")
+        page_cache["version"] = registry_version
+    return serve_asset(request, page_cache["asset"])
+
+@app.get("/static/{name}")
+async def static_file(name: str, request: Request):
+    asset = static_assets.get(name)
+    if asset is None:
+        return JSONResponse({"status": "error", "message": f"未知资源 {name}"}, status_code=404)
+    return serve_asset(request, asset)
 
 # API 路由
+# (操作, 是否排空) -> (名称, 执行函数)
+LIFECYCLE_ACTIONS = {
+    ("start", False): ("启动", scheduled_start),
+    ("stop", False): ("停止", stop_instance),
+    ("stop", True): ("排空停止", stop_with_drain),
+    ("restart", False): ("重启", restart_instance),
+    ("restart", True): ("排空重启", drain_restart_instance),
+}
+
+def resolve_lifecycle(machine_id, action, drain=None):
+    """返回 (操作名称, 执行函数)，没有副作用；远程实例转发给所在节点"""
+    drain = action != "start" and drain_enabled(drain)
+    if (action, drain) not in LIFECYCLE_ACTIONS:
+        raise ValueError(f"未知操作 {action}")
+    action_name, func = LIFECYCLE_ACTIONS[(action, drain)]
+    if instances[machine_id].get("node"):
+        return action_name, lambda machine_id: node_lifecycle(machine_id, action, drain)
+    return action_name, func
+
+def begin_lifecycle(machine_id, action):
+    """手动启动停止前处理看门狗（远程实例由所在节点处理）"""
+    if instances[machine_id].get("node"):
+        return
+    if action == "stop":
+        watchdog.cancel(machine_id)
+    else:
+        watchdog.reset(machine_id)
+
+def lifecycle_response(machine_id, action, drain=None):
+    """提交生命周期操作并立即返回操作 id"""
+    if machine_id not in instances:
+        return {"status": "error", "message": f"未知实例 {machine_id}"}
+    op, _, joined = submit_lifecycle(machine_id, action, drain)
+    message = f"{machine_id} {op['action']}{'已在进行中' if joined else '已提交'}"
+    return {"status": "success", "message": message, "operation": op["id"], "joined": joined}
+
 @app.get("/start/{machine_id}")
 async def start_machine(machine_id: str):
-    result = run_instance(machine_id)
-    # 广播状态更新
-    await manager.broadcast({
-        "type": "status_update",
-        "machine": machine_id,
-        "status": instances[machine_id]["status"]
-    })
-    return result
+    return lifecycle_response(machine_id, "start")
 
 @app.get("/stop/{machine_id}")
-async def stop_machine(machine_id: str):
-    result = stop_instance(machine_id)
-    # 广播状态更新
-    await manager.broadcast({
-        "type": "status_update",
-        "machine": machine_id,
-        "status": instances[machine_id]["status"]
-    })
-    return result
+async def stop_machine(machine_id: str, drain: Optional[bool] = None):
+    return lifecycle_response(machine_id, "stop", drain)
 
 @app.get("/restart/{machine_id}")
-async def restart_machine(machine_id: str):
-    result = restart_instance(machine_id)
-    # 广播状态更新
-    await manager.broadcast({
-        "type": "status_update",
-        "machine": machine_id,
-        "status": instances[machine_id]["status"]
-    })
-    return result
+async def restart_machine(machine_id: str, drain: Optional[bool] = None):
+    return lifecycle_response(machine_id, "restart", drain)
+
+@app.get("/start_all")
+async def start_all_machines(machines: str = ""):
+    """批量启动：默认所有已停止的实例，经启动调度错开冷启动"""
+    bulk = submit_bulk("start", bulk_targets("start", machines))
+    return {"status": "success", "message": f"批量启动 {len(bulk['machines'])} 个实例已提交", "bulk": bulk["id"]}
+
+@app.get("/stop_all")
+async def stop_all_machines(machines: str = "", drain: Optional[bool] = None):
+    """批量停止：默认所有运行中和启动中的实例"""
+    bulk = submit_bulk("stop", bulk_targets("stop", machines), drain)
+    return {"status": "success", "message": f"批量停止 {len(bulk['machines'])} 个实例已提交", "bulk": bulk["id"]}
+
+@app.get("/bulk/{bulk_id}")
+async def get_bulk(bulk_id: str):
+    if bulk_id in bulk_runs:
+        return {"status": "success", "bulk": bulk_runs[bulk_id]}
+    return JSONResponse({"status": "error", "message": f"未知批量操作 {bulk_id}"}, status_code=404)
+
+@app.get("/launch_queue")
+async def get_launch_queue():
+    """启动调度队列和当前等待的原因"""
+    return {"status": "success", **launch_scheduler.report()}
+
+@app.get("/drained")
+async def get_drained_jobs():
+    """排空时没有实例接收、等待重新提交的任务"""
+    jobs = [{key: job[key] for key in ("machine", "prompt_id", "drained_at")} for job in drained_jobs]
+    return {"status": "success", "jobs": jobs}
+
+@app.post("/drained/resubmit")
+async def resubmit_drained_jobs():
+    """把保存的任务立即提交到当前可用的实例"""
+    submitted = await resubmit_drained()
+    return {"status": "success", "message": f"已重新提交 {submitted} 个任务，剩余 {len(drained_jobs)} 个"}
+
+@app.get("/operations/{operation_id}")
+async def get_operation(operation_id: str):
+    if operation_id in operations:
+        return {"status": "success", "operation": operations[operation_id]}
+    return JSONResponse({"status": "error", "message": f"未知操作 {operation_id}"}, status_code=404)
+
+@app.get("/logs/{machine_id}")
+async def get_logs(machine_id: str, lines: int = 200):
+    if machine_id not in instances:
+        return JSONResponse({"status": "error", "message": f"未知实例 {machine_id}"}, status_code=404)
+    return {"status": "success", "lines": get_log_buffer(machine_id).tail(lines)}
+
+@app.websocket("/ws/logs/{machine_id}")
+async def websocket_logs(websocket: WebSocket, machine_id: str, tail: int = 200):
+    """推送日志尾部并持续跟随；客户端跟不上时丢弃并告知丢弃的行数"""
+    if machine_id not in instances:
+        await websocket.close(code=4404)
+        return
+    await websocket.accept()
+    buffer = get_log_buffer(machine_id)
+    subscriber = buffer.subscribe()
+
+    async def drain_client():
+        # 只为及时发现断开，客户端发来的内容忽略
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    async def forward_lines():
+        await websocket.send_json({"type": "lines", "lines": buffer.tail(tail)})
+        while True:
+            batch = [await subscriber.queue.get()]
+            # 把已积压的行合并成一条消息发送
+            while not subscriber.queue.empty() and len(batch) < 500:
+                batch.append(subscriber.queue.get_nowait())
+            if subscriber.dropped:
+                await websocket.send_json({"type": "dropped", "count": subscriber.dropped})
+                subscriber.dropped = 0
+            await asyncio.wait_for(websocket.send_json({"type": "lines", "lines": batch}), timeout=SEND_TIMEOUT)
+
+    tasks = [asyncio.create_task(drain_client()), asyncio.create_task(forward_lines())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        buffer.unsubscribe(subscriber)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# 实例注册表管理
+def instance_info(machine_id):
+    inst = instances[machine_id]
+    return {**inst["spec"], "status": inst["status"], "url": f"/m/{machine_id}/", "node": inst.get("node")}
+
+async def add_instance(spec):
+    """运行时新增实例"""
+    global registry_version
+    spec = normalize_spec(spec, len(instances))
+    if spec["id"] in instances:
+        raise ValueError(f"实例 {spec['id']} 已存在")
+    check_port_conflict(spec)
+    instances[spec["id"]] = make_instance(spec)
+    registry_version += 1
+    await publish_state(spec["id"])
+
+async def remove_instance(machine_id):
+    """运行时删除实例，运行中的先停止"""
+    global registry_version
+    inst = instances[machine_id]
+    watchdog.cancel(machine_id)
+    preempt_for_stop(machine_id)
+    async with lifecycle_lock(machine_id):
+        if inst["process"] is not None:
+            await stop_instance(machine_id)
+        instances.pop(machine_id, None)
+    lifecycle_locks.pop(machine_id, None)
+    registry_version += 1
+    save_process_state()
+    await publish_state(machine_id)
+
+def replace_spec(spec):
+    """替换实例定义，运行中的实例在下次启动时生效"""
+    inst = instances[spec["id"]]
+    inst["spec"] = spec
+    if inst["process"] is None:
+        apply_spec(inst)
+
+async def update_instance(spec):
+    """运行时修改实例定义"""
+    global registry_version
+    spec = normalize_spec(spec)
+    check_port_conflict(spec)
+    replace_spec(spec)
+    registry_version += 1
+    await publish_state(spec["id"])
+
+@app.get("/instances")
+async def list_instances():
+    return {
+        "status": "success",
+        "version": registry_version,
+        "instances": [instance_info(machine_id) for machine_id in instances],
+    }
+
+@app.post("/instances")
+async def create_instance(request: Request):
+    try:
+        await add_instance(await request.json())
+        save_config()
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": f"新增实例失败: {str(e)}"}, status_code=400)
+    return {"status": "success", "message": "实例已添加", "version": registry_version}
+
+@app.delete("/instances/{machine_id}")
+async def delete_instance(machine_id: str):
+    if machine_id not in instances:
+        return JSONResponse({"status": "error", "message": f"未知实例 {machine_id}"}, status_code=404)
+    if instances[machine_id].get("node"):
+        return JSONResponse({"status": "error", "message": f"{machine_id} 是远程实例，请在所在节点上删除"}, status_code=400)
+    await remove_instance(machine_id)
+    save_config()
+    return {"status": "success", "message": f"{machine_id} 已删除", "version": registry_version}
+
+@app.post("/instances/reload")
+async def reload_instances():
+    """重新读取配置文件，只增删改有变化的实例，其他实例不受影响"""
+    global config, registry_version
+    # 先完整校验，任何一项不通过都不改动当前配置和注册表
+    try:
+        new_config = await asyncio.to_thread(load_config)
+        specs = await asyncio.to_thread(instance_specs, new_config)
+        node_specs(new_config)
+        wanted = {spec["id"]: spec for spec in specs}
+        if len(wanted) != len(specs):
+            raise ValueError("实例 id 重复")
+        check_registry_ports(specs)
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": f"读取配置失败: {str(e)}"}, status_code=400)
+
+    removed = [machine_id for machine_id, inst in instances.items() if machine_id not in wanted and not inst.get("node")]
+    for machine_id in removed:
+        await remove_instance(machine_id)
+    # 新配置和注册表的增改一起生效，中间没有 await
+    old_config, config = config, new_config
+    added, updated = [], []
+    for machine_id, spec in wanted.items():
+        if machine_id not in instances:
+            instances[machine_id] = make_instance(spec)
+            added.append(machine_id)
+        elif instances[machine_id]["spec"] != spec:
+            replace_spec(spec)
+            updated.append(machine_id)
+    if added or removed or updated or old_config != new_config:
+        registry_version += 1
+    for machine_id in added + updated:
+        await publish_state(machine_id)
+    await sync_nodes()
+    return {"status": "success", "added": added, "removed": removed, "updated": updated, "version": registry_version}
 
 @app.get("/status/{machine_id}")
 async def get_status(machine_id: str):
@@ -729,4 +4877,5 @@ async def get_status(machine_id: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("comfy_web:app", host="0.0.0.0", port=8000, reload=True, access_log=False)
\ No newline at end of file
+    # 不使用 reload：Windows 上 uvicorn 的 reload 模式使用 SelectorEventLoop，无法创建异步子进程
+    uvicorn.run("comfy_web:app", host="0.0.0.0", port=int(config.get("port", 8000)), access_log=False)
\ No newline at end of file